@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks on random ontologies (see random_ontology.create_random), e.g.:
+#
+#   python -m semantic2sql.benchmark --sizes 100 1000 10000 --output bench.json
+#   python -m semantic2sql.benchmark --sizes 100 1000 10000 --baseline bench.json
+#
+# Each point runs in a fresh process, so as peak RSS is the one of this point only.
+# With --baseline, the exit status is 1 if a point is slower, bigger or times out compared to the baseline.
+
+import sys, os, os.path, json, time, hashlib, platform, sqlite3, argparse, multiprocessing
+import owlready2
+from owlready2 import *
+
+
+CONSTRUCTS     = ["some", "only", "and", "or", "not"]
+DEFAULT_SIZES  = [100, 1000, 10000, 100000, 1000000]
+DEFAULT_RATIOS = [0.0, 0.1, 0.5, 1.0] # nb_<construct> / nb_class
+METRICS        = [("reason_time", "s"), ("peak_rss", "bytes"), ("page_count", "pages")]
+
+
+def _peak_rss():
+  import resource
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == "darwin": return rss # Bytes on macOS, kilobytes elsewhere
+  return rss * 1024
+
+def _run_point(params, rule_set):
+  from semantic2sql.random_ontology import create_random
+  from semantic2sql.reasoned_model import ReasonedModel
+
+  world = World()
+  t = time.time()
+  create_random(world = world, **params)
+  create_time = time.time() - t
+
+  rm = ReasonedModel(world, rule_set = rule_set)
+  t = time.time()
+  rm.reason()
+  reason_time = time.time() - t
+
+  page_size       = rm.cursor.execute("""PRAGMA page_size""").fetchone()[0]
+  main_page_count = rm.cursor.execute("""PRAGMA main.page_count""").fetchone()[0]
+  temp_page_count = rm.cursor.execute("""PRAGMA temp.page_count""").fetchone()[0]
+  return {
+    "create_time"     : create_time,
+    "reason_time"     : reason_time,
+    "peak_rss"        : _peak_rss(),
+    "page_size"       : page_size,
+    "main_page_count" : main_page_count,
+    "temp_page_count" : temp_page_count,
+    "page_count"      : main_page_count + temp_page_count,
+    "usage"           : rm.rule_usage(),
+  }
+
+def run_point(name, params, rule_set = "rules.txt", timeout = None):
+  result = { "name" : name, "params" : params }
+  pool = multiprocessing.get_context("spawn").Pool(1)
+  try:
+    result.update(pool.apply_async(_run_point, (params, rule_set)).get(timeout))
+  except multiprocessing.TimeoutError:
+    result["timeout"] = timeout
+  finally:
+    pool.terminate()
+    pool.join()
+  return result
+
+
+def points(sizes = DEFAULT_SIZES, ratios = DEFAULT_RATIOS, ratio_size = 1000, constructs = CONSTRUCTS, seed = 0):
+  # Yields (name, params) for a sweep over nb_class, then a sweep over the ratio of each construct
+  for nb_class in sizes:
+    yield "nb_class=%s" % nb_class, { "nb_class" : nb_class, "seed" : seed }
+  for construct in constructs:
+    for ratio in ratios:
+      nb = int(ratio * ratio_size)
+      yield "nb_class=%s,nb_%s=%s" % (ratio_size, construct, nb), { "nb_class" : ratio_size, "nb_%s" % construct : nb, "seed" : seed }
+
+def run(points, rule_set = "rules.txt", timeout = None, verbose = True):
+  with open(os.path.join(os.path.dirname(__file__), rule_set), "rb") as f: rules_sha1 = hashlib.sha1(f.read()).hexdigest()
+  results = {
+    "meta" : {
+      "date"       : time.strftime("%Y-%m-%d %H:%M:%S"),
+      "python"     : platform.python_version(),
+      "platform"   : platform.platform(),
+      "owlready2"  : owlready2.VERSION,
+      "sqlite"     : sqlite3.sqlite_version,
+      "rule_set"   : rule_set,
+      "rules_sha1" : rules_sha1,
+    },
+    "runs" : [],
+  }
+  for name, params in points:
+    result = run_point(name, params, rule_set, timeout)
+    results["runs"].append(result)
+    if verbose:
+      if "timeout" in result: print("%-40s timeout after %ss" % (name, timeout), file = sys.stderr)
+      else:                   print("%-40s %9.3fs %8.1f MB %9s pages" % (name, result["reason_time"], result["peak_rss"] / 1048576, result["page_count"]), file = sys.stderr)
+  return results
+
+
+def compare(results, baseline, tolerance = 0.25, min_time = 0.1):
+  # Returns the list of regressions, as strings. Times below min_time seconds are too noisy to be compared.
+  regressions = []
+  baseline_runs = { run["name"] : run for run in baseline["runs"] }
+  for run in results["runs"]:
+    base = baseline_runs.get(run["name"])
+    if (base is None) or ("timeout" in base): continue
+    if "timeout" in run:
+      regressions.append("%s: timeout after %ss" % (run["name"], run["timeout"]))
+      continue
+    for metric, unit in METRICS:
+      old = base.get(metric)
+      new = run .get(metric)
+      if (old is None) or (new is None): continue
+      if (metric == "reason_time") and (max(old, new) < min_time): continue
+      if new > old * (1.0 + tolerance):
+        regressions.append("%s: %s %s => %s %s (+%.0f%%)" % (run["name"], metric, old, new, unit, 100.0 * (new - old) / (old or 1)))
+  return regressions
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(prog = "python -m semantic2sql.benchmark", description = "Benchmark semantic2sql on random ontologies.")
+  parser.add_argument("--sizes",      type = int,   nargs = "*", default = DEFAULT_SIZES,  help = "values of nb_class")
+  parser.add_argument("--ratios",     type = float, nargs = "*", default = DEFAULT_RATIOS, help = "ratios nb_<construct> / nb_class")
+  parser.add_argument("--ratio-size", type = int,   default = 1000, help = "nb_class for the construct ratio sweeps")
+  parser.add_argument("--constructs", nargs = "*",  default = CONSTRUCTS, choices = CONSTRUCTS)
+  parser.add_argument("--seed",       type = int,   default = 0)
+  parser.add_argument("--rules",      default = "rules.txt", help = "rule set file, in the semantic2sql directory")
+  parser.add_argument("--timeout",    type = float, default = None, help = "timeout for each point, in seconds")
+  parser.add_argument("--output",     help = "JSON file for the results")
+  parser.add_argument("--baseline",   help = "JSON file of previous results; exit status is 1 on regression")
+  parser.add_argument("--tolerance",  type = float, default = 0.25, help = "allowed relative increase, compared to the baseline")
+  parser.add_argument("--min-time",   type = float, default = 0.1,  help = "reasoning times below are not compared")
+  args = parser.parse_args(argv)
+
+  results = run(points(args.sizes, args.ratios, args.ratio_size, args.constructs, args.seed), args.rules, args.timeout)
+  if args.output:
+    with open(args.output, "w") as f: json.dump(results, f, indent = 1)
+
+  if args.baseline:
+    with open(args.baseline) as f: baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.min_time)
+    for regression in regressions: print("REGRESSION %s" % regression, file = sys.stderr)
+    if regressions: return 1
+  return 0
+
+
+if __name__ == "__main__": sys.exit(main())
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+def reserve_blanks(graph, nb):
+  # Reserves nb blank node ids in the quadstore (store.current_blank, as Owlready does); returns the range
+  # (current, limit), the ids being -current-1 ... -limit
+  graph.execute("""UPDATE store SET current_blank=current_blank+?""", (nb,))
+  limit = graph.execute("""SELECT current_blank FROM store""").fetchone()[0]
+  return limit - nb, limit
+
+def release_blanks(graph, current, limit):
+  # Gives back the ids above current of a range reserved up to limit, if no other range has been reserved since
+  graph.execute("""UPDATE store SET current_blank=? WHERE current_blank=?""", (current, limit))
+
+def reserve_blank_ranges(graph, nb_ranges, size): # For the workers, see BlankAllocator(reserved = ...)
+  current, limit = reserve_blanks(graph, nb_ranges * size)
+  return [(current + i * size, current + (i + 1) * size) for i in range(nb_ranges)]
+
+
+class BlankAllocator(object):
+  # Allocates blank node ids (negative storids) by blocks of block_size, reserved in the quadstore; the
+  # high-water mark is thus persisted as soon as a block is taken, and neither Owlready nor a following run can
+  # reuse the ids. With reserved = (current, limit), e.g. from reserve_blank_ranges(), only that range is used,
+  # and the quadstore is not read nor written (workers on a copy of the quadstore).
+  def __init__(self, graph, block_size = 4096, reserved = None):
+    self.graph      = graph
+    self.block_size = block_size
+    self.reserved   = not reserved is None
+    self.exhausted  = False
+    if self.reserved: self.current, self.limit = reserved
+    else:             self.current = self.limit = graph.execute("""SELECT current_blank FROM store""").fetchone()[0]
+
+  def _next_block(self, nb):
+    if self.reserved:
+      self.exhausted = True
+      raise RuntimeError("No more blank node in the reserved range (%s, %s)!" % (self.current, self.limit))
+    self.current, self.limit = reserve_blanks(self.graph, max(nb, self.block_size)) # The rest of the previous block is lost
+
+  def skip_to(self, current): # No id below current will be allocated
+    if current <= self.current: return
+    if current <= self.limit: self.current = current; return
+    if self.reserved:
+      self.exhausted = True
+      raise RuntimeError("No more blank node in the reserved range (%s, %s)!" % (self.current, self.limit))
+    self.graph.execute("""UPDATE store SET current_blank=MAX(current_blank, ?)""", (current,))
+    self.current = self.limit = current
+
+  def new_blank_node(self):
+    if self.current >= self.limit: self._next_block(1)
+    self.current += 1
+    return -self.current
+
+  def new_blank_nodes(self, nb): # A range of nb ids, from a single block
+    if self.current + nb > self.limit: self._next_block(nb)
+    first = self.current + 1
+    self.current += nb
+    return range(-first, -self.current - 1, -1)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+
+class BulkLoad(object):
+  # Loads the tables derived from the quadstore at setup. Each table is filled once, from all its sources (SELECTs
+  # or Python rows), de-duplicated with GROUP BY on its key and sorted by key, while it has no index; the indexes
+  # are then created in one pass. times receives the time spent on each table (loading and indexing).
+  def __init__(self, cursor, times = None):
+    self.cursor  = cursor
+    self.times   = {} if times is None else times
+    self.tables  = {} # Table name => (key, indexes)
+    self.selects = {} # Table name => [(sql, params)]
+    self.rows    = {} # Table name => { key : row }
+    self.nbs     = {} # Table name => number of rows loaded
+
+  def add_table(self, name, key, indexes): # key is a list of columns; indexes are CREATE INDEX statements
+    self.tables[name] = (key, indexes)
+
+  def add_select(self, name, sql, params = ()):
+    self.selects.setdefault(name, []).append((sql, tuple(params)))
+
+  def add_rows(self, name, rows, key_len = 1): # The key is the first key_len values of the rows
+    d = self.rows.setdefault(name, {})
+    for row in rows: d.setdefault(tuple(row[:key_len]), row)
+
+  def finish(self):
+    for name, (key, indexes) in self.tables.items():
+      t       = time.time()
+      columns = [column for (cid, column, *others) in self.cursor.execute("""PRAGMA table_info(%s)""" % name)]
+      others  = [column for column in columns if not column in key]
+      if name in self.selects:
+        sqls   = [sql for (sql, params) in self.selects[name]]
+        params = [param for (sql, params) in self.selects[name] for param in params]
+        self.cursor.execute("""INSERT INTO %s(%s) WITH bulk(%s) AS (%s) SELECT %s FROM bulk GROUP BY %s ORDER BY %s""" % (
+          name, ",".join(key + others), ",".join(columns), "\nUNION ALL\n".join(sqls),
+          ",".join(key + ["MIN(%s)" % column for column in others]), ",".join(key), ",".join(key)), params)
+        self.nbs[name] = self.cursor.rowcount
+      elif name in self.rows:
+        rows = [row for k, row in sorted(self.rows[name].items())]
+        self.cursor.executemany("""INSERT INTO %s VALUES (%s)""" % (name, ",".join("?" for column in columns)), rows)
+        self.nbs[name] = len(rows)
+      else:
+        self.nbs[name] = 0
+      for index in indexes: self.cursor.execute(index)
+      self.times[name] = self.times.get(name, 0.0) + time.time() - t
+    self.tables.clear()
+    self.selects.clear()
+    self.rows.clear()
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+from collections import defaultdict
+
+
+def strongly_connected_components(nodes, succs):
+  # Iterative Tarjan; the components are returned in reverse topological order (successors first)
+  index      = {}
+  lowlink    = {}
+  on_stack   = set()
+  stack      = []
+  components = []
+  for root in nodes:
+    if root in index: continue
+    index[root] = lowlink[root] = len(index)
+    stack.append(root)
+    on_stack.add(root)
+    work = [(root, iter(succs.get(root, ())))]
+    while work:
+      node, it = work[-1]
+      for succ in it:
+        if not succ in index:
+          index[succ] = lowlink[succ] = len(index)
+          stack.append(succ)
+          on_stack.add(succ)
+          work.append((succ, iter(succs.get(succ, ()))))
+          break
+        elif succ in on_stack:
+          if index[succ] < lowlink[node]: lowlink[node] = index[succ]
+      else:
+        work.pop()
+        if work:
+          parent = work[-1][0]
+          if lowlink[node] < lowlink[parent]: lowlink[parent] = lowlink[node]
+        if lowlink[node] == index[node]:
+          component = []
+          while True:
+            x = stack.pop()
+            on_stack.discard(x)
+            component.append(x)
+            if x == node: break
+          components.append(component)
+  return components
+
+
+class TransitiveClosure(object):
+  # Transitive closure of a binary relation (e.g. is_a), maintained incrementally as edges are added.
+  # The first edges are condensed by strongly connected components and closed in topological order; the
+  # following ones are propagated to the predecessors. The reachable nodes are stored as sets: ontology
+  # hierarchies are deep but sparse, and sets were much faster than bitsets on them.
+  def __init__(self):
+    self.reachable  = {}                # node => nodes reachable from it (excluding itself, unless in a cycle)
+    self.preds      = defaultdict(set)  # node => direct predecessors
+    self.last_rowid = 0                 # Rows of the table already loaded, for BuiltinTransitiveClosure
+
+  def __len__(self): return sum(len(reachable) for reachable in self.reachable.values())
+
+  def __contains__(self, pair):
+    s, o = pair
+    reachable = self.reachable.get(s)
+    return (not reachable is None) and (o in reachable)
+
+  def add_edges(self, edges):
+    # Returns the pairs of the closure that are new and are not among the given edges
+    edges = set(edges)
+    if self.reachable: news = self._add_edges_incrementally(edges)
+    else:              news = self._add_edges_by_components(edges)
+    return [pair for pair in news if not pair in edges]
+
+  def _add_edges_by_components(self, edges):
+    succs = defaultdict(set)
+    for s, o in edges:
+      succs[s].add(o)
+      self.preds[o].add(s)
+    nodes = set(succs)
+    nodes.update(self.preds)
+
+    reachable = self.reachable
+    news      = []
+    for component in strongly_connected_components(nodes, succs): # Successors first, so as their reachable sets are complete
+      r = set()
+      for node in component:
+        for succ in succs.get(node, ()):
+          r.add(succ)
+          r.update(reachable.get(succ, ()))
+      if len(component) > 1: r.update(component) # Cycle
+      if not r: continue
+      for node in component:
+        reachable[node] = set(r)
+        news.extend((node, o) for o in r)
+    return news
+
+  def _add_edges_incrementally(self, edges):
+    reachable = self.reachable
+    preds     = self.preds
+    news      = []
+    for s, o in edges:
+      if (s, o) in self: continue
+      target = set(reachable.get(o, ()))
+      target.add(o)
+      preds[o].add(s)
+      # Every node reaching s (or s itself) now reaches o and the nodes reachable from o.
+      # A node that already reaches them all can be pruned, since its predecessors reach them too.
+      todo = [s]
+      while todo:
+        x = todo.pop()
+        r = reachable.get(x)
+        if r is None: r = reachable[x] = set()
+        new = target - r
+        if not new: continue
+        r.update(new)
+        news.extend((x, y) for y in new)
+        todo.extend(preds.get(x, ()))
+    return news
+
+
+_MAX_POST = float("inf")
+
+def _merge_intervals(intervals):
+  intervals.sort()
+  merged = [intervals[0]]
+  for low, high in intervals[1:]:
+    last_low, last_high = merged[-1]
+    if low <= last_high + 1:
+      if high > last_high: merged[-1] = (last_low, high)
+    else: merged.append((low, high))
+  return merged
+
+def _subtract_intervals(intervals, others): # The parts of intervals not covered by others, both being merged
+  subtracted = []
+  j = 0
+  for low, high in intervals:
+    while (j < len(others)) and (others[j][1] < low): j += 1
+    k = j
+    while low <= high:
+      if (k >= len(others)) or (others[k][0] > high):
+        subtracted.append((low, high))
+        break
+      other_low, other_high = others[k]
+      if other_low > low: subtracted.append((low, other_low - 1))
+      low = max(low, other_high + 1)
+      k += 1
+  return subtracted
+
+
+class IntervalLabels(object):
+  # Compressed reachability index of a relation given by its direct edges (the transitive reduction is not
+  # needed, but fewer edges give fewer intervals). The strongly connected components are numbered in
+  # post-order over a spanning forest of the inverted relation, and each component gets the merged intervals
+  # of the numbers of the components that reach it; so, s reaches o iff the number of s is in an interval of o.
+  # The relation is reflexive here (each node reaches itself), as is_a.
+  # The intervals of a node are exactly the numbers of the nodes reaching it, so as the labels can be updated
+  # when edges are added (see add_edges()); new nodes get the next numbers.
+  def __init__(self, edges):
+    succs = defaultdict(set)
+    preds = defaultdict(set)
+    for s, o in edges:
+      if s == o: continue
+      succs[s].add(o)
+      preds[o].add(s)
+    nodes = set(succs)
+    nodes.update(preds)
+    
+    components = strongly_connected_components(nodes, succs) # Ancestors first
+    node_2_c   = {}
+    for c, component in enumerate(components):
+      for node in component: node_2_c[node] = c
+    c_preds = [set() for component in components]
+    for o, ss in preds.items():
+      c_o = node_2_c[o]
+      for s in ss:
+        c_s = node_2_c[s]
+        if c_s != c_o: c_preds[c_o].add(c_s)
+        
+    # Post-order numbering over a spanning forest, from the ancestors down to their descendants
+    posts = [None] * len(components)
+    lows  = [None] * len(components)
+    post  = 0
+    for root in range(len(components)):
+      if not posts[root] is None: continue
+      posts[root] = -1 # Visited
+      work = [(root, iter(c_preds[root]))]
+      while work:
+        c, it = work[-1]
+        for child in it:
+          if posts[child] is None:
+            posts[child] = -1
+            work.append((child, iter(c_preds[child])))
+            break
+        else:
+          work.pop()
+          posts[c] = post
+          if lows[c] is None: lows[c] = post
+          post += 1
+          if work:
+            parent = work[-1][0]
+            if (lows[parent] is None) or (lows[c] < lows[parent]): lows[parent] = lows[c]
+            
+    # Intervals, from the descendants up to their ancestors
+    intervals = [None] * len(components)
+    for c in range(len(components) - 1, -1, -1):
+      l = [(lows[c], posts[c])]
+      for child in c_preds[c]: l.extend(intervals[child])
+      intervals[c] = _merge_intervals(l)
+      
+    self.node_2_post      = { node : posts[c] for node, c in node_2_c.items() }
+    self.node_2_intervals = { node : intervals[c] for node, c in node_2_c.items() }
+    self.post_2_nodes     = defaultdict(list)
+    for node, c in node_2_c.items(): self.post_2_nodes[posts[c]].append(node)
+    self.succs            = succs
+    self.next_post        = post
+    self.nb_edges         = sum(len(os) for os in succs.values()) # Edges labelled at once, and added since
+    self.nb_added_edges   = 0
+    self.last_rowid       = 0     # Rows of the table labelled, for BuiltinTransitiveClosure
+    self.targets          = set() # Nodes whose reaching nodes are inserted in the table, for BuiltinTransitiveClosure
+    self.target_rowids    = {}    # Rows of the target tables already loaded, for BuiltinTransitiveClosure
+    
+  def __len__(self): return sum(len(intervals) for intervals in self.node_2_intervals.values())
+  
+  def reaches(self, s, o):
+    if s == o: return True
+    post      = self.node_2_post.get(s)
+    intervals = self.node_2_intervals.get(o)
+    if (post is None) or (intervals is None): return False
+    i = bisect.bisect_right(intervals, (post, _MAX_POST)) - 1
+    return (i >= 0) and (intervals[i][1] >= post)
+  
+  def nodes(self, intervals): # The nodes numbered in intervals
+    post_2_nodes = self.post_2_nodes
+    for low, high in intervals:
+      for post in range(low, high + 1): yield from post_2_nodes.get(post, ())
+      
+  def add_edges(self, edges):
+    # Updates the labels; returns the (node, intervals) of the nodes reached by new nodes, intervals being the
+    # numbers of these new nodes. Pruned as in TransitiveClosure, since the successors of a node reaching all the
+    # new nodes reach them too.
+    node_2_intervals = self.node_2_intervals
+    grown            = []
+    for s, o in edges:
+      if s == o: continue
+      for node in (s, o):
+        if not node in self.node_2_post:
+          self.node_2_post[node] = self.next_post
+          self.post_2_nodes[self.next_post].append(node)
+          node_2_intervals[node] = [(self.next_post, self.next_post)]
+          self.next_post += 1
+      succs = self.succs[s]
+      if o in succs: continue
+      succs.add(o)
+      self.nb_added_edges += 1
+      added = node_2_intervals[s]
+      todo  = [o]
+      while todo:
+        x   = todo.pop()
+        new = _subtract_intervals(added, node_2_intervals[x])
+        if not new: continue
+        node_2_intervals[x] = _merge_intervals(node_2_intervals[x] + new)
+        grown.append((x, new))
+        todo.extend(self.succs.get(x, ()))
+    return grown
+  
+  def store(self, cursor, name, temporary = "TEMPORARY"):
+    # Stores the labels in the <name>_labels and <name>_intervals tables, and creates the <name>_closure view
+    for sql in ["""DROP VIEW IF EXISTS %s_closure""", """DROP TABLE IF EXISTS %s_labels""", """DROP TABLE IF EXISTS %s_intervals"""]:
+      cursor.execute(sql % name)
+    cursor.execute("""CREATE %s TABLE %s_labels(s INTEGER PRIMARY KEY, post INTEGER NOT NULL)""" % (temporary, name))
+    cursor.execute("""CREATE %s TABLE %s_intervals(o INTEGER NOT NULL, low INTEGER NOT NULL, high INTEGER NOT NULL)""" % (temporary, name))
+    cursor.executemany("""INSERT INTO %s_labels VALUES (?,?)""" % name, self.node_2_post.items())
+    cursor.executemany("""INSERT INTO %s_intervals VALUES (?,?,?)""" % name, ((o, low, high) for o, intervals in self.node_2_intervals.items() for low, high in intervals))
+    cursor.execute("""CREATE INDEX %s_labels_post ON %s_labels(post)""" % (name, name))
+    cursor.execute("""CREATE INDEX %s_intervals_o ON %s_intervals(o, low)""" % (name, name))
+    cursor.execute("""CREATE %s VIEW %s_closure AS SELECT l.s AS s, i.o AS o FROM %s_intervals i, %s_labels l WHERE l.post BETWEEN i.low AND i.high""" % (temporary, name, name, name))
+
+
+class RestrictionDepths(object):
+  # Depth of the restriction nodes, i.e. the number of restriction nodes reachable from a node through the values
+  # of the restrictions (including the node itself), maintained as restriction rows are added. A new restriction
+  # on a fresh node gets 1 + the depth of its value; adding a row to a node that the known depths depend on (a
+  # second value, or a cycle) invalidates them, and they are computed again when needed.
+  def __init__(self):
+    self.values      = {}    # Restriction node => value, or tuple of values if several
+    self.depths      = {}    # Node => depth
+    self.counted     = set() # Nodes the known depths depend on
+    self.max         = 0     # Max depth of the restriction nodes; None if unknown
+    self.last_rowids = {}    # Table name => rows already loaded, see ReasonedModel._update_restriction_depths()
+
+  def __len__(self): return len(self.values)
+
+  def clear(self):
+    self.values.clear()
+    self.depths.clear()
+    self.counted.clear()
+    self.max = 0
+    self.last_rowids.clear()
+
+  def add_rows(self, rows):
+    # rows are (s, value) pairs
+    values = self.values
+    news   = []
+    for s, value in rows:
+      if (s in values) or (s in self.counted):
+        self.depths.clear()
+        self.counted.clear()
+        self.max = None
+      previous = values.get(s, self)
+      if   previous is self:             values[s] = value
+      elif isinstance(previous, tuple):  values[s] = previous + (value,)
+      else:                              values[s] = (previous, value)
+      news.append(s)
+    if not self.max is None:
+      for s in news:
+        depth = self.depth(s)
+        if depth > self.max: self.max = depth
+
+  def max_depth(self):
+    if self.max is None: self.max = max((self.depth(s) for s in self.values), default = 0)
+    return self.max
+
+  def depth(self, x):
+    depths = self.depths
+    d = depths.get(x)
+    if not d is None: return d
+
+    # Follows the chain of restrictions with a single value, down to a node of known depth
+    values = self.values
+    path   = []
+    seen   = set()
+    while True:
+      if x in depths: d = depths[x]; break
+      value = values.get(x, self)
+      if value is self: # Not a restriction
+        d = depths[x] = 0
+        self.counted.add(x)
+        break
+      if isinstance(value, tuple) or (x in seen): d = self._count(x); break
+      path.append(x)
+      seen.add(x)
+      x = value
+
+    # 1 + the depth of the value, unless the node may be reachable from its value
+    for x in reversed(path):
+      if   x in depths:        d = depths[x]
+      elif x in self.counted:  d = self._count(x)
+      else:
+        d = depths[x] = d + 1
+        self.counted.add(x)
+    return d
+
+  def _count(self, x):
+    values  = self.values
+    visited = { x }
+    stack   = [x]
+    while stack:
+      value = values.get(stack.pop(), self)
+      if value is self: continue
+      for o in (value if isinstance(value, tuple) else (value,)):
+        if not o in visited:
+          visited.add(o)
+          stack.append(o)
+    self.counted.update(visited)
+    d = self.depths[x] = sum(1 for o in visited if o in values)
+    return d
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+from array import array
+from collections import deque
+from owlready2 import *
+from owlready2.class_construct import _restriction_type_2_label
+
+
+class Construct(object):
+  def __init__(self, xs):
+    self.xs = xs
+
+class AndConstruct(Construct):
+  def __str__(self):
+    if len(self.xs) >= 2:
+        return "(%s)" % (" and ".join(repr(x) for x in self.xs))
+    return "(%s and)" % ("".join(repr(x) for x in self.xs))
+
+class OrConstruct(Construct):
+  def __str__(self):
+      if hasattr(self, '_building_str'):
+          return "(...)"
+      self._building_str = True
+      try:
+          if len(self.xs) >= 2:
+              return "(%s)" % (" or ".join(str(x) for x in self.xs))
+          return "(%s or)" % ("".join(str(x) for x in self.xs))
+      finally:
+          del self._building_str
+
+class DisjointConstruct(Construct):
+  def __str__(self):
+    if len(self.xs) >= 2: return "(%s)" % (" disjoint ".join(str(x) for x in self.xs))
+    return "(%s disjoint)" % ("".join(str(x) for x in self.xs))
+
+class NotConstruct(Construct):
+  def __str__(self):
+    return "(not %s)" % (",".join(str(x) for x in self.xs))
+
+class RestrictionConstruct(Construct):
+  def __str__(self):
+      if hasattr(self, '_building_str'):
+          return "(...)"
+      self._building_str = True
+      try:
+          if self.xs[0] in (SOME, ONLY):
+              return "(%s %s %s)" % (self.xs[2], _restriction_type_2_label[self.xs[0]], self.xs[3])
+          else:
+              return "(%s %s %s %s)" % (self.xs[2], _restriction_type_2_label[self.xs[0]], self.xs[1], self.xs[3])
+      finally:
+          del self._building_str
+
+
+LIST_CONSTRUCTS        = [("flat_lists_30", OrConstruct), ("flat_lists_31", AndConstruct), ("flat_lists_37", DisjointConstruct), ("flat_lists_87", NotConstruct)]
+RESTRICTION_CONSTRUCTS = [("some", SOME, False), ("only", ONLY, False), ("max", MAX, True), ("min", MIN, True), ("exactly", EXACTLY, True)]
+
+
+class CatalogEntry(object): # View on a storid of a ConstructCatalog
+  __slots__ = ["catalog", "s"]
+  has_superclass = False
+  
+  def __init__(self, catalog, s):
+    self.catalog = catalog
+    self.s       = s
+    
+  @property
+  def name(self): return self.catalog.name(self.s)
+  @property
+  def constructs(self): return self.catalog.constructs(self.s)
+  @property
+  def is_new(self): return self.catalog.is_new(self.s)
+  
+  def __str__(self): return self.catalog.render(self.s)
+  __repr__ = __str__
+  
+  
+class ConstructCatalog(object):
+  # All the constructs of the model, as arrays of storids sorted by s (one array per column of each construct
+  # table), filled by one query per table. Constructs are created and rendered on demand, and the renderings
+  # are memoized. Mapping-like: catalog[s] is a CatalogEntry, for any storid used in a construct.
+  # The catalog can also be updated incrementally with invalidate(), as done by ConstructTracer.
+  def __init__(self, model):
+    self.model         = model
+    self.total_changes = model.db.total_changes # Outdated after any write, see ReasonedModel._get_constructs()
+    self.columns       = [] # (construct_class, p, columns); columns are (ss, os) for lists and (ss, cards, props, values) for restrictions
+    self.reloaded      = {} # s => (construct_class, p, xs) rows, for the storids invalidated or missing when the arrays were filled
+    self.rendered      = {}
+    self.rendering     = set()
+    self.asserted      = None
+    storids_sqls       = []
+    cursor             = model.cursor
+    for table, construct_class in LIST_CONSTRUCTS:
+      try: rows = cursor.execute("""SELECT s, o FROM %s ORDER BY s, o""" % table)
+      except sqlite3.OperationalError: continue # List table not created yet
+      columns = (array("q"), array("q"))
+      for row in rows:
+        for column, x in zip(columns, row): column.append(x)
+      self.columns.append((construct_class, None, columns))
+      storids_sqls.append("""SELECT s FROM %s UNION SELECT o FROM %s""" % (table, table))
+      
+    for table, p, has_card in RESTRICTION_CONSTRUCTS:
+      if has_card: rows = cursor.execute("""SELECT s, card, prop, value FROM %s ORDER BY s, rowid""" % table)
+      else:        rows = cursor.execute("""SELECT s, 0, prop, value FROM %s ORDER BY s, rowid""" % table)
+      columns = (array("q"), array("q"), array("q"), array("q"))
+      for row in rows:
+        for column, x in zip(columns, row): column.append(x)
+      self.columns.append((RestrictionConstruct, p, columns))
+      storids_sqls.append("""SELECT s FROM %s UNION SELECT prop FROM %s UNION SELECT value FROM %s""" % (table, table, table))
+      
+    self.storids_sql = " UNION ".join(storids_sqls)
+    self.storids     = array("q", (s for (s,) in cursor.execute("""SELECT * FROM (%s) ORDER BY 1""" % self.storids_sql)))
+    
+  def is_outdated(self): return self.model.db.total_changes != self.total_changes
+  
+  def __len__(self): return len(self.storids)
+  
+  def __iter__(self): return iter(self.storids)
+  
+  def keys(self): return iter(self.storids)
+  
+  def __contains__(self, s):
+    i = bisect.bisect_left(self.storids, s)
+    return (i < len(self.storids)) and (self.storids[i] == s)
+  
+  def __getitem__(self, s):
+    if not s in self: raise KeyError(s)
+    return CatalogEntry(self, s)
+  
+  def get(self, s, default = None):
+    if not s in self: return default
+    return CatalogEntry(self, s)
+  
+  def name(self, s):
+    if s > 0: return self.model.world._unabbreviate(s).rsplit("#", 1)[-1]
+    
+  def invalidate(self, s): # New rows for s, reloaded on demand
+    self.reloaded[s] = None
+    self.rendered.clear() # The renderings of the constructs using s are outdated too
+    
+  def _load(self, s):
+    rows = self.reloaded.get(s)
+    if rows is None:
+      rows   = self.reloaded[s] = []
+      cursor = self.model.cursor
+      for table, construct_class in LIST_CONSTRUCTS:
+        try: os = [o for (o,) in cursor.execute("""SELECT o FROM %s WHERE s=? ORDER BY o""" % table, (s,))]
+        except sqlite3.OperationalError: continue # List table not created yet
+        if os: rows.append((construct_class, None, os))
+      for table, p, has_card in RESTRICTION_CONSTRUCTS:
+        if has_card: sql = """SELECT card, prop, value FROM %s WHERE s=? ORDER BY rowid"""
+        else:        sql = """SELECT 0, prop, value FROM %s WHERE s=? ORDER BY rowid"""
+        for r in cursor.execute(sql % table, (s,)): rows.append((RestrictionConstruct, p, r))
+    return rows
+  
+  def constructs(self, s):
+    constructs = []
+    if (s in self.reloaded) or (not s in self):
+      for construct_class, p, xs in self._load(s):
+        if p is None: constructs.append(construct_class([CatalogEntry(self, o) for o in xs]))
+        else:         constructs.append(RestrictionConstruct([p, xs[0], CatalogEntry(self, xs[1]), CatalogEntry(self, xs[2])]))
+      return constructs
+    
+    for construct_class, p, columns in self.columns:
+      ss    = columns[0]
+      start = bisect.bisect_left (ss, s)
+      end   = bisect.bisect_right(ss, s, start)
+      if start == end: continue
+      if p is None:
+        constructs.append(construct_class([CatalogEntry(self, o) for o in columns[1][start : end]]))
+      else:
+        for i in range(start, end):
+          constructs.append(RestrictionConstruct([p, columns[1][i], CatalogEntry(self, columns[2][i]), CatalogEntry(self, columns[3][i])]))
+    return constructs
+  
+  def is_new(self, s): # Not asserted in the quadstore
+    if s in self.reloaded: return not self.model.cursor.execute("""SELECT 1 FROM objs WHERE s=? LIMIT 1""", (s,)).fetchone()
+    if self.asserted is None:
+      self.asserted = { s for (s,) in self.model.cursor.execute("""SELECT c.s FROM (%s) c WHERE EXISTS (SELECT 1 FROM objs WHERE objs.s=c.s)""" % self.storids_sql) }
+    return not s in self.asserted
+  
+  def render(self, s):
+    r = self.rendered.get(s)
+    if r is None:
+      if s in self.rendering: return "(...)" # Cyclic construct
+      self.rendering.add(s)
+      try:
+        name = self.name(s)
+        l    = [str(construct) for construct in self.constructs(s)]
+        if name: l.insert(0, name)
+        r = self.rendered[s] = ",".join(l)
+      finally:
+        self.rendering.discard(s)
+    return r
+  
+  
+class ConstructTracer(object): # Ring buffer of the (table, s) constructs created; descriptions are rendered when read, or sent to sink (e.g. print)
+  def __init__(self, model, size = 1000, sink = None):
+    self.model   = model
+    self.buffer  = deque(maxlen = size)
+    self.sink    = sink
+    self.catalog = None # Filled on the first description, then updated incrementally
+    self.nb      = 0
+
+  def record(self, table, s):
+    self.nb += 1
+    if self.catalog: self.catalog.invalidate(s)
+    self.buffer.append((table, s))
+    if self.sink: self.sink("%s : %s" % (s, self.describe(s)))
+
+  def describe(self, s):
+    if self.catalog is None: self.catalog = ConstructCatalog(self.model)
+    return self.catalog.render(s)
+
+  def __iter__(self):
+    for table, s in list(self.buffer): yield table, s, self.describe(s)
+
+  def clear_index(self): self.catalog = None # Needed after removals or renamings in the construct tables
+
+  def dump(self, file = None):
+    for table, s, description in self:
+      print("%s %s : %s" % (table, s, description), file = file)
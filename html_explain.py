@@ -81,11 +81,21 @@ class HTMLExplanation(object):
       rowid_2_s_o[rowid] = (s, o)
       s_o_2_rowid[s, o]  = rowid
       
+    # The rows of the list tables used as sources, and the elements of the disjoint lists, are resolved in batch
+    explanations    = self.model.provenance.explanations()
+    table_rowids    = defaultdict(set)
+    for table, s, o, rule, sources in explanations:
+      for source_table, rowid in sources: table_rowids[source_table].add(rowid)
+    table_rowid_2_s = { table : self.model.provenance.resolve(table, rowids) for table, rowids in table_rowids.items()
+                        if table in {"flat_lists_30", "flat_lists_31", "linked_lists_30", "linked_lists_31", "flat_lists_37"} }
+    disjoint_2_xs   = defaultdict(list)
+    for s, o in self.model.cursor.execute("""SELECT s,o FROM flat_lists_37""").fetchall(): disjoint_2_xs[s].append(o)
+    
     self.facts = []
     s_2_disjoint    = {}
     s_o_2_is_a_fact = {}
     self.s_2_is_a_fact = {}
-    for table, s, o, rule, sources in self.model.cursor.execute("""SELECT t,s,o,rule,sources FROM explanations""").fetchall():
+    for table, s, o, rule, sources in explanations:
       if s == owlready2.owl_nothing: continue
       if rule == "equivalence": rule = "assertion"
       
@@ -110,25 +120,23 @@ class HTMLExplanation(object):
       elif table == "flat_lists_37": # Disjoint
         fact = s_2_disjoint.get(s)
         if not fact:
-          xs = [int(x) for x in o.split(",")]
-          fact = s_2_disjoint[s] = DisjointFact(self, s, xs)
+          fact = s_2_disjoint[s] = DisjointFact(self, s, disjoint_2_xs[s])
           self.facts.append(fact)
           
       sources2 = []
 
       if sources:
-        for source in sources.split(","):
-          table, rowid = source.split(":")
+        for table, rowid in sources:
           if   table == "is_a":
-            s, o = rowid_2_s_o[int(rowid)]
+            s, o = rowid_2_s_o[rowid]
             source = s_o_2_is_a_fact.get((s, o))
             
           elif table in {"flat_lists_30", "flat_lists_31", "linked_lists_30", "linked_lists_31"}: # And/Or
-            s = self.model.cursor.execute("""SELECT s FROM %s WHERE rowid=? LIMIT 1""" % table, (rowid,)).fetchone()[0]
+            s = table_rowid_2_s[table][rowid]
             source = self.s_2_is_a_fact.get(s)
             
           elif table == "flat_lists_37": # Disjoint
-            s = self.model.cursor.execute("""SELECT s FROM flat_lists_37 WHERE rowid=? LIMIT 1""", (rowid,)).fetchone()[0]
+            s = table_rowid_2_s[table][rowid]
             source = s_2_disjoint.get(s)
             
           else: continue
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys, os, os.path, time, heapq, itertools, shutil, sqlite3, tempfile, multiprocessing
+from collections import defaultdict
+import owlready2, owlready2.base
+from owlready2 import *
+from owlready2.reasoning import _apply_reasoning_results, _INFERRENCES_ONTOLOGY
+from semantic2sql.reasoned_model import ReasonedModel
+from semantic2sql.sinks import WorldSink
+from semantic2sql.blank_allocator import reserve_blanks, release_blanks
+
+
+_PROPERTY_TYPES = (owl_object_property, owl_data_property, owl_annotation_property)
+_MAX_UNIVERSAL  = max(owlready2.base._universal_abbrev_2_iri) # owl:Thing, rdf:type,... are shared by all modules
+_BLANKS_PER_QUAD = 2    # Estimated blank node ids needed by a job, see ParallelReasonedModel.blank_range_size
+_MIN_BLANK_RANGE = 1024
+
+
+class _UnionFind(object):
+  def __init__(self):
+    self.parents = {}
+    self.flagged = set() # Roots whose set is flagged
+
+  def find(self, x):
+    parents = self.parents
+    root = parents.setdefault(x, x)
+    while parents[root] != root: root = parents[root]
+    while parents[x] != root: parents[x], x = root, parents[x] # Path compression
+    return root
+
+  def union(self, x, y):
+    x = self.find(x)
+    y = self.find(y)
+    if x == y: return x
+    self.parents[y] = x
+    if y in self.flagged:
+      self.flagged.discard(y)
+      self.flagged.add(x)
+    return x
+
+  def flag(self, x): self.flagged.add(self.find(x))
+
+  def is_flagged(self, x): return self.find(x) in self.flagged
+
+
+class _DependencyGraph(object):
+  # The dependency graph of the entities (named and blank): x depends on y if the classification of x needs the
+  # axioms of y, i.e. the quads (x, ?, y) (is_a, some, only, lists,...), plus the reverse edges of the equivalences
+  # and of the property assertions. Defined classes and the axioms on blank nodes (GCIs, disjointness,...) are
+  # triggered by any entity they refer to, since a class using one of these entities may be inferred under them.
+  # Shared entities (owl:Thing and other universal entities) are not nodes of the graph.
+  def __init__(self, world):
+    graph                  = world.graph
+    self.properties        = { s for (s,) in graph.execute("""SELECT s FROM objs WHERE p=? AND o IN (%s)""" % ",".join("?" for i in _PROPERTY_TYPES), (rdf_type,) + _PROPERTY_TYPES) }
+    self.object_properties = { s for (s,) in graph.execute("""SELECT s FROM objs WHERE p=? AND o=?""", (rdf_type, owl_object_property)) }
+    self.deps              = defaultdict(set)
+    self.triggered         = defaultdict(list)
+    self.nb_quads          = defaultdict(int)
+    self.parents           = {} # A told parent (superclass or class), for cutting the hierarchy into subtrees
+    is_shared              = lambda x: 0 < x <= _MAX_UNIVERSAL
+    symmetrics             = { owl_equivalentclass, owl_equivalentproperty, owl_equivalentindividual, owl_inverse_property }
+    referenced_blanks      = set()
+    defined                = []
+
+    for s, p, o in graph.execute("""SELECT s,p,o FROM objs"""):
+      self.nb_quads[s] += 1
+      if (p in self.properties) and (p != s): self.deps[s].add(p)
+      if is_shared(o) or (o == s): continue
+      self.deps[s].add(o)
+      if o < 0:
+        referenced_blanks.add(o)
+        if (p == owl_equivalentclass) and (s > 0): defined.append((s, o))
+      elif (p in symmetrics) or ((p in self.object_properties) and (s > 0)): self.deps[o].add(s)
+      if (s > 0) and (o > 0) and ((p == rdfs_subclassof) or (p == rdf_type)) and (not o in self.properties) and (not s in self.parents): self.parents[s] = o
+    for s, nb in graph.execute("""SELECT s, COUNT() FROM datas GROUP BY s"""):
+      self.nb_quads[s] += nb
+      self.deps[s] # Entities with data are nodes, even without dependencies
+
+    for s, blank in defined:
+      for x in self.refs(blank): self.triggered[x].append(s)
+    for blank in [x for x in self.deps if (x < 0) and (not x in referenced_blanks)]: # Axioms on blank nodes
+      for x in self.refs(blank): self.triggered[x].append(blank)
+
+  def refs(self, blank): # The named entities a blank node refers to, possibly via other blank nodes
+    refs    = set()
+    visited = { blank }
+    stack   = [blank]
+    while stack:
+      for x in self.deps.get(stack.pop(), ()):
+        if   x > 0: refs.add(x)
+        elif not x in visited:
+          visited.add(x)
+          stack.append(x)
+    return refs
+
+  def closure(self, entities): # The entities kept in the job classifying entities
+    kept  = set()
+    stack = list(entities)
+    while stack:
+      x = stack.pop()
+      if x in kept: continue
+      kept.add(x)
+      stack.extend(self.deps.get(x, ()))
+      stack.extend(self.triggered.get(x, ()))
+    return kept
+
+  def components(self):
+    # The connected components of the graph. The properties whose axioms do not refer to classes are not in any
+    # component, since they are replicated in the jobs that use them.
+    is_shared = lambda x: 0 < x <= _MAX_UNIVERSAL
+    uf        = _UnionFind()
+    for s in self.properties:
+      uf.find(s)
+      for o in self.deps.get(s, ()):
+        if (not o in self.properties) and (not is_shared(o)): uf.flag(s)
+    for s, os in self.deps.items():
+      if (s in self.properties) and not uf.is_flagged(s): continue
+      uf.find(s)
+      for o in os:
+        if (not o in self.properties) or uf.is_flagged(o): uf.union(s, o)
+
+    components = defaultdict(set)
+    for x in uf.parents:
+      if (x in self.properties) and not uf.is_flagged(x): continue
+      components[uf.find(x)].add(x)
+    return list(components.values())
+
+  def weights(self, entities): # The number of quads of the named entities, including those of the blank nodes they own
+    weights = {}
+    visited = set()
+    for x in entities:
+      if x < 0: continue
+      weight = self.nb_quads.get(x, 0)
+      stack  = [x]
+      while stack:
+        for blank in self.deps.get(stack.pop(), ()):
+          if (blank < 0) and not blank in visited:
+            visited.add(blank)
+            weight += self.nb_quads.get(blank, 0)
+            stack.append(blank)
+      weights[x] = weight
+    return weights
+
+  def cut(self, component, weights, target):
+    # Cuts the told hierarchy of a component into subtrees: the children of a class are grouped until the group
+    # weighs target; the ancestors shared by several groups are then replicated in their jobs (see closure()).
+    named    = { x for x in component if x > 0 }
+    children = defaultdict(list)
+    parents  = {}
+    for x in named:
+      parent = self.parents.get(x)
+      if not parent in named: parent = None
+      parents[x] = parent
+      children[parent].append(x)
+    order   = []
+    visited = set()
+    for root in [None] + list(named):
+      if root in visited: continue
+      if not root is None: # A cycle of told parents, e.g. from equivalences with named classes
+        children[parents[root]].remove(root)
+        children[None].append(root)
+        parents[root] = None
+      visited.add(root)
+      stack = [root]
+      while stack:
+        x = stack.pop()
+        order.append(x)
+        for child in children[x]:
+          if not child in visited:
+            visited.add(child)
+            stack.append(child)
+
+    subtree_weights = {}
+    piece_of        = {}
+    nb_pieces       = 0
+    for x in reversed(order):
+      group = []
+      group_weight = 0
+      for child in children[x]:
+        group.append(child)
+        group_weight += subtree_weights[child]
+        if group_weight >= target:
+          for child in group: piece_of[child] = nb_pieces
+          nb_pieces += 1
+          group = []
+          group_weight = 0
+      if (x is None) and group: # The rest of the roots
+        for child in group: piece_of[child] = nb_pieces
+        nb_pieces += 1
+      subtree_weights[x] = weights.get(x, 0) + group_weight
+    for x in order:
+      if (not x is None) and (not x in piece_of): piece_of[x] = piece_of[parents[x]]
+
+    pieces = [set() for i in range(nb_pieces)]
+    for x, i in piece_of.items(): pieces[i].add(x)
+    for x in component: # Blank nodes and flagged properties go with the first piece; they are replicated as needed
+      if not x in named: pieces[0].add(x)
+    return [piece for piece in pieces if piece]
+
+  def partition(self, nb_modules = 1):
+    components = self.components()
+    weights    = self.weights(set().union(*components))
+    target     = sum(weights.values()) / nb_modules
+    modules    = []
+    for component in components:
+      weight = sum(weights.get(x, 0) for x in component)
+      if (weight <= target) or (len(component) == 1): modules.append((component, weight))
+      else:
+        for piece in self.cut(component, weights, target): modules.append((piece, sum(weights.get(x, 0) for x in piece)))
+    return modules
+
+
+def partition(world, nb_modules = 1):
+  # Splits the entities into modules that can be classified independently: the connected components of the
+  # dependency graph (see _DependencyGraph), the components bigger than 1 / nb_modules of the ontology being cut
+  # into subtrees of the told hierarchy. A module is classified with the entities it depends on (its boundary),
+  # replicated from the other modules.
+  # Returns a list of (module, nb_quads), module being a set of storids.
+  return _DependencyGraph(world).partition(nb_modules)
+
+
+def _balance(modules, nb_jobs):
+  # Longest processing time first: the biggest module goes to the least loaded job
+  jobs = [(0, i, set()) for i in range(min(nb_jobs, len(modules)))]
+  for module, nb in sorted(modules, key = lambda module_nb: -module_nb[1]):
+    load, i, job = heapq.heappop(jobs)
+    job.update(module)
+    heapq.heappush(jobs, (load + nb, i, job))
+  return [job for load, i, job in sorted(jobs, key = lambda job: job[1]) if job]
+
+
+def _classify_job(snapshot, job_file, excluded, rule_set, options):
+  # Runs in a worker process, on its own copy of the quadstore, from which the entities not kept in the job are
+  # removed. Returns None if the reserved blank node range is exhausted.
+  shutil.copyfile(snapshot, job_file)
+  db = sqlite3.connect(job_file)
+  db.execute("""CREATE TEMPORARY TABLE excluded(s INTEGER PRIMARY KEY)""")
+  db.executemany("""INSERT INTO excluded VALUES (?)""", ((s,) for s in excluded))
+  db.execute("""DELETE FROM objs WHERE s IN (SELECT s FROM excluded)""")
+  db.execute("""DELETE FROM datas WHERE s IN (SELECT s FROM excluded)""")
+  db.commit()
+  db.close()
+
+  world = World(filename = job_file)
+  try:
+    rm = ReasonedModel(world, rule_set = rule_set, **options)
+    try:
+      rm.reason()
+    except RuntimeError:
+      if rm.blanks.exhausted: return None
+      raise
+    return dict(rm.new_parents), dict(rm.new_equivs), rm.entity_2_type, rm.blanks.current
+  finally:
+    world.close()
+    os.unlink(job_file)
+
+
+class ParallelReasonedModel(object):
+  # Classifies the modules of the ontology (see partition()) in several processes, each on its own copy of the
+  # quadstore with the module and its boundary, and merges the results. The boundary classes are classified both
+  # in the jobs that replicate them and in the job of their own module; when the results differ, the modules
+  # interact beyond their dependencies, and their jobs are merged and classified again.
+  def __init__(self, world, rule_set = None, processes = None, debug = False, blank_range_size = None, **options):
+    if options.get("persistent"): raise ValueError("Persistent sessions are not supported by ParallelReasonedModel!")
+    self.world               = world
+    self.rule_set            = rule_set or "rules.txt"
+    self.processes           = processes or os.cpu_count() or 1
+    self.debug               = debug
+    self.blank_range_size    = blank_range_size # Blank node ids reserved per job; estimated from the quads of the job if None
+    self.options             = dict(options, debug = debug)
+    self.new_parents         = None
+    self.new_equivs          = None
+    self.entity_2_type       = None
+    self.nb_rounds           = 0
+
+  def _run_jobs(self, snapshot, tmp_dir, kepts, sizes, all_entities):
+    blank_ranges = [reserve_blanks(self.world.graph, size) for size in sizes] # Jobs never share a blank node
+    args = [(snapshot, os.path.join(tmp_dir, "job_%s.sqlite3" % i), all_entities - kept, self.rule_set, dict(self.options, blank_range = blank_range)) for i, (kept, blank_range) in enumerate(zip(kepts, blank_ranges))]
+    if (self.processes == 1) or (len(kepts) == 1): outcomes = [_classify_job(*arg) for arg in args]
+    else:
+      with multiprocessing.Pool(min(self.processes, len(kepts))) as pool:
+        outcomes = pool.starmap(_classify_job, args)
+    used = max([current for current, limit in blank_ranges] + [outcome[3] for outcome in outcomes if outcome])
+    release_blanks(self.world.graph, used, blank_ranges[-1][1]) # Gives back the ids not used by the last jobs
+    return outcomes
+
+  def reason(self):
+    t = time.time()
+    graph        = _DependencyGraph(self.world)
+    modules      = graph.partition(self.processes)
+    all_entities = set() # The entities of no module (e.g. ontologies) are kept in every job
+    for module, nb in modules: all_entities.update(module)
+    jobs         = _balance(modules, self.processes)
+    if self.debug: print("%s modules in %s jobs (%.1fs)" % (len(modules), len(jobs), time.time() - t), file = sys.stderr)
+
+    self.new_parents   = defaultdict(list)
+    self.new_equivs    = defaultdict(list)
+    self.entity_2_type = {}
+    self.nb_rounds     = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      snapshot = os.path.join(tmp_dir, "snapshot.sqlite3")
+      self.world.graph.commit() # Else the backup waits for the pending transaction
+      dest = sqlite3.connect(snapshot)
+      self.world.graph.db.backup(dest)
+      dest.close()
+
+      results = [] # (job, kept, (new_parents, new_equivs, entity_2_type, blank))
+      todo    = [(job, 1) for job in jobs] # (job, factor of the blank range size)
+      while todo:
+        self.nb_rounds += 1
+        kepts = [graph.closure(job) for job, factor in todo]
+        sizes = [(self.blank_range_size or max(_MIN_BLANK_RANGE, _BLANKS_PER_QUAD * sum(graph.nb_quads.get(x, 0) for x in kept))) * factor for kept, (job, factor) in zip(kepts, todo)]
+        retry = []
+        for (job, factor), kept, outcome in zip(todo, kepts, self._run_jobs(snapshot, tmp_dir, kepts, sizes, all_entities)):
+          if outcome is None: retry.append((job, factor * 2)) # Blank node range exhausted
+          else:               results.append((job, kept, outcome))
+        if self.debug and retry: print("%s jobs retried with more blank nodes" % len(retry), file = sys.stderr)
+
+        # Reconciliation: the boundary classes are compared with their classification in the job of their module
+        s_2_i = {}
+        for i, (job, kept, outcome) in enumerate(results):
+          for s in job: s_2_i[s] = i
+        uf = _UnionFind()
+        for i, (job, kept, (new_parents, new_equivs, entity_2_type, blank)) in enumerate(results):
+          for s in kept - job:
+            j = s_2_i.get(s)
+            if j is None: continue # Not in any module, e.g. blank nodes and properties without axioms
+            other = results[j][2]
+            if (set(new_parents.get(s, ())) != set(other[0].get(s, ()))) or (set(new_equivs.get(s, ())) != set(other[1].get(s, ()))): uf.union(i, j)
+        merged = defaultdict(set)
+        for i in uf.parents: merged[uf.find(i)].update(results[i][0])
+        results = [result for i, result in enumerate(results) if not i in uf.parents]
+        todo    = retry + [(job, 1) for job in merged.values()]
+        if self.debug and merged: print("Reconciliation: %s jobs merged into %s" % (len(uf.parents), len(merged)), file = sys.stderr)
+
+    # The results of a class come from the job of its module; those of the entities without module (e.g. properties
+    # without axioms, replicated in several jobs) are merged
+    owned = set()
+    for job, kept, outcome in results: owned.update(job)
+    for job, kept, (new_parents, new_equivs, entity_2_type, blank) in results:
+      for new, merged in [(new_parents, self.new_parents), (new_equivs, self.new_equivs)]:
+        for s, others in new.items():
+          if (s in owned) and not s in job: continue
+          l = merged[s]
+          l.extend(o for o in others if not o in l)
+      for s, s_type in entity_2_type.items():
+        if (not s in owned) or (s in job): self.entity_2_type[s] = s_type
+
+  def run(self, x = None, debug = 1, sink = None):
+    locked = self.world.graph.has_write_lock()
+    if locked: self.world.graph.release_write_lock() # Not needed during reasoning
+    try:
+      self.reason()
+    finally:
+      if locked: self.world.graph.acquire_write_lock() # re-lock when applying results
+
+    if sink is None: sink = WorldSink(x, debug)
+    sink.open(self)
+    sink.write(self.new_parents, self.new_equivs, self.entity_2_type)
+    sink.close()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math, copy, sqlite3
+from collections import defaultdict
+from semantic2sql.rule import _col_ref
+
+
+class JoinPlanner(object):
+  # Cost-based join ordering for the SQL of the rules. The order is chosen greedily, each table being joined
+  # with the smallest estimated fanout, from the live row counts (the model's last_inferences) and the
+  # number of rows per key of the indexes (sqlite_stat1, maintained by TableStatistics).
+  # The SQL is generated again with CROSS JOINs when the cardinalities of the rule's tables move to another
+  # bucket (a power of base), and cached per rule and bucket.
+  def __init__(self, model, base = 4, default_fanout = 10):
+    self.model          = model
+    self.base           = base
+    self.default_fanout = default_fanout
+    self.nb_plans       = 0
+    self.static_rows    = {} # Row counts of the tables that are not inferred (e.g. objs)
+    self.table_2_rules  = None
+    self.invalidate()
+
+  def invalidate(self, tables = None): # Called when the statistics change; the plans of the rules using tables are dropped
+    self.stats   = None
+    self.indexes = {}
+    if not tables: return
+    if self.table_2_rules is None:
+      self.table_2_rules = defaultdict(set)
+      for stage in self.model.rule_set.stages:
+        for rule in stage.preprocesses + stage.completions:
+          if getattr(rule, "join_plans", None) is None: continue
+          for sql_if in rule.sql.sql_ifs:
+            for sql_from in sql_if.sql_froms: self.table_2_rules[sql_from.table].add(rule)
+    for table in tables:
+      for rule in self.table_2_rules.get(table, ()): rule.join_plans.clear()
+
+  def _load_stats(self):
+    self.stats = {}
+    for schema in ["main", "temp"] + ([self.model.work_store.schema] if self.model.work_store else []):
+      try: rows = self.model.db.execute("""SELECT tbl, idx, stat FROM %s.sqlite_stat1 WHERE idx IS NOT NULL""" % schema).fetchall()
+      except sqlite3.OperationalError: continue # No ANALYZE yet
+      for table_name, index, stat in rows:
+        column = self._index_column(index, "%s." % schema)
+        stat   = stat.split()
+        if column and (len(stat) >= 2): self.stats[table_name, column] = float(stat[1])
+
+  def _index_column(self, index, schema = ""):
+    r = self.model.db.execute("""PRAGMA %sindex_info(%s)""" % (schema, index)).fetchone()
+    return r and r[2]
+
+  def is_indexed(self, table, column):
+    columns = self.indexes.get(table.name)
+    if columns is None:
+      schema  = self._work_store_schema(table)
+      columns = { self._index_column(index, schema) for (seq, index, *others) in self.model.db.execute("""PRAGMA %sindex_list(%s)""" % (schema, table.name)) }
+      if columns: self.indexes[table.name] = columns # Else, the table may not be created or indexed yet
+    return column in columns
+
+  def rows(self, table):
+    nb = self.model.last_inferences.get(table)
+    if not nb is None: return nb
+    nb = self.static_rows.get(table.name)
+    if nb is None:
+      try:    nb = self.model.db.execute("""SELECT COUNT() FROM %s%s""" % (self._work_store_schema(table), table.name)).fetchone()[0]
+      except sqlite3.OperationalError: nb = 0
+      self.static_rows[table.name] = nb
+    return nb
+
+  def _work_store_schema(self, table): # Prefix for the tables created in the work store, which may also exist in main
+    if self.model.work_store and (table.name in self.model.work_store.tables): return "%s." % self.model.work_store.schema
+    return ""
+
+  def fanout(self, table, column): # Estimated number of rows matching a value of column
+    rows = self.rows(table)
+    if not self.is_indexed(table, column): return rows # Scan
+    if self.stats is None: self._load_stats()
+    return min(rows, self.stats.get((table.name, column), self.default_fanout))
+
+  def join_order(self, sql_if, first = None):
+    links = defaultdict(list) # i => [(other i, column of i)]
+    bound = defaultdict(list) # i => [column equal to a constant]
+    for sql_where in sql_if.sql_wheres:
+      if sql_where.operator != "=": continue
+      x1 = _col_ref(sql_where.x1)
+      x2 = _col_ref(sql_where.x2)
+      if x1 and x2:
+        links[x1.i].append((x2.i, x1.column))
+        links[x2.i].append((x1.i, x2.column))
+      elif x1: bound[x1.i].append(x1.column)
+      elif x2: bound[x2.i].append(x2.column)
+
+    sql_froms = [first] if first else []
+    remnants  = [sql_from for sql_from in sql_if.sql_froms if not sql_from is first]
+    while remnants:
+      joined_is = { sql_from.i for sql_from in sql_froms }
+      def cost(sql_from):
+        connected = False
+        nb        = self.rows(sql_from.table)
+        for column in bound[sql_from.i]:
+          connected = True
+          nb = min(nb, self.fanout(sql_from.table, column))
+        for i, column in links[sql_from.i]:
+          if i in joined_is:
+            connected = True
+            nb = min(nb, self.fanout(sql_from.table, column))
+        return (bool(sql_froms) and not connected, nb, sql_from.i) # Avoid cartesian products
+      sql_from = min(remnants, key = cost)
+      sql_froms.append(sql_from)
+      remnants.remove(sql_from)
+    return sql_froms
+
+  def bucket(self, rule):
+    return tuple(int(math.log(self.rows(sql_from.table) + 1, self.base)) for sql_if in rule.sql.sql_ifs for sql_from in sql_if.sql_froms)
+
+  def plan(self, rule): # Returns the SQL of the rule, ordered for the current cardinalities
+    key  = self.bucket(rule)
+    plan = rule.join_plans.get(key)
+    if plan is None:
+      self.nb_plans += 1
+      sql = copy.copy(rule.sql) # The static SQL objects of the rule are shared, the plan is generated on copies
+      sql.sql_ifs = []
+      for sql_if in rule.sql.sql_ifs:
+        planned_sql_if = copy.copy(sql_if)
+        planned_sql_if.join_order = self.join_order(sql_if)
+        planned_sql_if.planner    = self
+        sql.sql_ifs.append(planned_sql_if)
+      sql0      = str(sql)
+      sql1      = sql.with_last_inference_conditions(self.model.rule_set, rule)
+      sql_delta = sql.with_delta_tables(self.model.rule_set, rule)
+      plan      = rule.join_plans[key] = (sql0, sql1, sql.last_inference_tables, sql_delta, sql.delta_param_tables)
+    return plan
+
+
+class TableStatistics(object):
+  # Maintains sqlite_stat1 for the inferrable tables as they grow. The rows per key of the indexes come from an
+  # ANALYZE bounded by analysis_limit (the rows per key are estimated from a sample of the index, not a full scan),
+  # done again only when the table has doubled; in between, the row counts are updated directly in sqlite_stat1,
+  # the rows per key being kept, which needs no scan.
+  def __init__(self, model, analysis_limit = 1000, resample_growth = 2):
+    self.model           = model
+    self.analysis_limit  = analysis_limit
+    self.resample_growth = resample_growth
+    self.nb_analyzes     = 0
+    self.nb_updates      = 0
+    self.clear()
+
+  def clear(self): # Needed after removals
+    self.tables  = {} # Table => (nb rows, nb rows at the last ANALYZE, [(index name, rows per key)])
+    self.schemas = {} # Table => "main", "temp" or the schema of the work store
+
+  def _schema(self, table):
+    schema = self.schemas.get(table)
+    if schema is None:
+      if   self.model.work_store:                                                                                                schema = self.model.work_store.schema
+      elif self.model.db.execute("""SELECT 1 FROM temp.sqlite_master WHERE type='table' AND name=?""", (table.name,)).fetchone(): schema = "temp"
+      else:                                                                                                                      schema = "main"
+      self.schemas[table] = schema
+    return schema
+
+  def _analyze(self, schema, table):
+    limit = self.model.db.execute("""PRAGMA analysis_limit""").fetchone()[0]
+    if not limit: self.model.db.execute("""PRAGMA analysis_limit = %s""" % self.analysis_limit)
+    try:     self.model.db.execute("""ANALYZE %s.%s""" % (schema, table.name))
+    finally:
+      if not limit: self.model.db.execute("""PRAGMA analysis_limit = 0""")
+    self.nb_analyzes += 1
+    return [(index, stat.split()[1:]) for (index, stat) in self.model.db.execute("""SELECT idx, stat FROM %s.sqlite_stat1 WHERE tbl=? AND idx IS NOT NULL""" % schema, (table.name,))]
+
+  def update(self, table, nb):
+    # Updates the statistics of table, which has about nb rows; returns True if changed.
+    # The highest rowid is used as number of rows, since the constructs added by the normalization are not counted.
+    if self.model.work_store and not table.name in self.model.work_store.tables: return False # Not created yet, or a view
+    try: nb = max(nb, self.model.db.execute("""SELECT MAX(rowid) FROM %s""" % (self.model.work_store.qualify(table.name) if self.model.work_store else table.name)).fetchone()[0] or 0)
+    except sqlite3.OperationalError: return False # Not created yet
+    previous_nb, analyzed_nb, per_keys = self.tables.get(table, (0, 0, None))
+    if nb == previous_nb: return False
+    schema = self._schema(table)
+    
+    if (per_keys is None) or (nb < previous_nb) or (nb >= analyzed_nb * self.resample_growth):
+      self.tables[table] = (nb, nb, self._analyze(schema, table))
+      return True
+    
+    self.tables[table] = (nb, analyzed_nb, per_keys)
+    if not per_keys: return False
+    self.model.db.executemany("""UPDATE %s.sqlite_stat1 SET stat=? WHERE tbl=? AND idx=?""" % schema, [(" ".join([str(nb)] + per_key), table.name, index) for (index, per_key) in per_keys])
+    self.model.db.execute("""ANALYZE %s.sqlite_master""" % schema) # Reloads the statistics
+    self.nb_updates += 1
+    return True
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json, time
+from collections import defaultdict
+
+
+_PLANNED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+class ProfiledCursor(object):
+  # Cursor proxy measuring the time spent in SQLite (execute and fetch), and capturing the query plans
+  def __init__(self, profiler, cursor):
+    self.profiler = profiler
+    self.cursor   = cursor
+
+  def _timed(self, f, *args):
+    t0 = time.perf_counter()
+    try:     return f(*args)
+    finally: self.profiler.sql_time += time.perf_counter() - t0
+
+  def execute(self, sql, params = ()):
+    self.profiler.capture_plan(sql, params)
+    self._timed(self.cursor.execute, sql, params)
+    return self
+
+  def executemany(self, sql, params):
+    self._timed(self.cursor.executemany, sql, params)
+    return self
+
+  def executescript(self, sql):
+    self._timed(self.cursor.executescript, sql)
+    return self
+
+  def fetchone(self):            return self._timed(self.cursor.fetchone)
+  def fetchmany(self, *args):    return self._timed(self.cursor.fetchmany, *args)
+  def fetchall(self):            return self._timed(self.cursor.fetchall)
+  def __iter__(self):            return self
+  def __next__(self):            return self._timed(self.cursor.__next__)
+  def close(self):               self.cursor.close()
+
+  @property
+  def rowcount(self):    return self.cursor.rowcount
+  @property
+  def lastrowid(self):   return self.cursor.lastrowid
+  @property
+  def description(self): return self.cursor.description
+
+
+class Profiler(object):
+  # Records each rule execution (wall, SQL and Python time, SQLite VM steps, delta rows fed in, hits), and the
+  # EXPLAIN QUERY PLAN of each SQL statement the first time a rule runs it.
+  # VM steps are counted with the SQLite progress handler, every progress_steps instructions.
+  def __init__(self, model = None, progress_steps = 1000):
+    self.progress_steps = progress_steps
+    self.executions     = []
+    self.stages         = []
+    self.plans          = defaultdict(dict) # rule name => { sql : plan }
+    self.sql_time       = 0.0
+    self.vm_steps       = 0
+    self.current_rule   = None
+    self.t0             = time.perf_counter()
+    self.model          = None
+    if model: self.attach(model)
+
+  def attach(self, model):
+    self.model = model
+    model.db.set_progress_handler(self._progress, self.progress_steps)
+
+  def detach(self):
+    if self.model: self.model.db.set_progress_handler(None, 0)
+
+  def _progress(self):
+    self.vm_steps += self.progress_steps
+    return 0
+
+  def wrap_cursor(self, cursor): return ProfiledCursor(self, cursor)
+
+  def capture_plan(self, sql, params):
+    if self.current_rule is None: return
+    plans = self.plans[self.current_rule.name]
+    if sql in plans: return
+    plans[sql] = None
+    if not sql.lstrip().upper().startswith(_PLANNED_STATEMENTS): return # CREATE, DROP, PRAGMA,...
+    if self.model.work_store: sql = self.model.work_store.rewrite(sql)
+    try:                   plans[sql] = [(id, parent, detail) for (id, parent, notused, detail) in self.model.db.execute("""EXPLAIN QUERY PLAN %s""" % sql, params)]
+    except Exception as e: plans[sql] = [(0, 0, "error: %s" % e)]
+
+  def start_stage(self, stage): self.stages.append({ "name" : stage.name, "start" : time.perf_counter() - self.t0 })
+
+  def end_stage(self, stage): self.stages[-1]["wall"] = time.perf_counter() - self.t0 - self.stages[-1]["start"]
+
+  def start_rule(self, rule):
+    model = self.model
+    self.current_rule = rule
+    delta = {}
+    for table in set(getattr(rule, "delta_tables", ())):
+      delta[table.name] = (model.last_inferences.get(table) or 0) - (rule.last_inferences.get(table) or 0)
+    self._rule_start = (time.perf_counter(), self.sql_time, self.vm_steps, delta)
+
+  def end_rule(self, rule, nb_hits):
+    t, sql_time, vm_steps, delta = self._rule_start
+    wall     = time.perf_counter() - t
+    sql_time = self.sql_time - sql_time
+    self.executions.append({
+      "rule"     : rule.name,
+      "stage"    : self.model.current_stage.name,
+      "start"    : t - self.t0,
+      "wall"     : wall,
+      "sql"      : sql_time,
+      "python"   : max(0.0, wall - sql_time),
+      "vm_steps" : self.vm_steps - vm_steps,
+      "delta"    : delta,
+      "hits"     : nb_hits,
+    })
+    self.current_rule = None
+
+  def summary(self): # Aggregated by rule, the most expensive first
+    rules = {}
+    for execution in self.executions:
+      summary = rules.get(execution["rule"])
+      if summary is None: summary = rules[execution["rule"]] = { "rule" : execution["rule"], "executions" : 0, "wall" : 0.0, "sql" : 0.0, "python" : 0.0, "vm_steps" : 0, "delta" : 0, "hits" : 0 }
+      summary["executions"] += 1
+      for key in ["wall", "sql", "python", "vm_steps", "hits"]: summary[key] += execution[key]
+      summary["delta"] += sum(execution["delta"].values())
+    return sorted(rules.values(), key = lambda summary: -summary["wall"])
+
+  def to_json(self):
+    return {
+      "stages"     : self.stages,
+      "executions" : self.executions,
+      "rules"      : self.summary(),
+      "plans"      : { rule : [{ "sql" : sql, "plan" : plan } for sql, plan in plans.items() if plan] for rule, plans in self.plans.items() },
+    }
+
+  def to_chrome_trace(self): # Trace event format, for chrome://tracing or Perfetto
+    events = []
+    for stage in self.stages:
+      events.append({ "name" : stage["name"], "cat" : "stage", "ph" : "X", "pid" : 1, "tid" : 1,
+                      "ts" : stage["start"] * 1e6, "dur" : stage.get("wall", 0.0) * 1e6 })
+    for execution in self.executions:
+      events.append({ "name" : execution["rule"], "cat" : "rule", "ph" : "X", "pid" : 1, "tid" : 2,
+                      "ts" : execution["start"] * 1e6, "dur" : execution["wall"] * 1e6,
+                      "args" : { key : execution[key] for key in ["sql", "python", "vm_steps", "delta", "hits"] } })
+    return { "traceEvents" : events, "displayTimeUnit" : "ms" }
+
+  def dump_json(self, filename):
+    with open(filename, "w") as f: json.dump(self.to_json(), f, indent = 1)
+
+  def dump_chrome_trace(self, filename):
+    with open(filename, "w") as f: json.dump(self.to_chrome_trace(), f)
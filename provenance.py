@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import defaultdict
+
+
+class ProvenanceStore(object):
+  # Storage of the explanations (explain = True). Each explanation is a row of explanations(t, s, o, rule), whose
+  # rowid is the explanation id, and each of its sources a row of explanation_sources(expl_id, table_id,
+  # source_rowid). Rule and table names are integer ids (see explanation_names).
+  # The SQL rules write both tables with a single INSERT ... SELECT into the explanation_rows view, whose
+  # INSTEAD OF trigger splits each row (t, s, o, rule, t1, rowid1, t2, rowid2,...) into an explanation and its
+  # sources.
+  def __init__(self, model):
+    self.model     = model
+    self.name_2_id = {}
+    self.id_2_name = {}
+    self.width     = 0 # Number of (table id, rowid) pairs in explanation_rows
+
+  def create(self):
+    cursor = self.model.cursor
+    cursor.execute("""CREATE %s TABLE explanation_names(id INTEGER PRIMARY KEY, name TEXT NOT NULL)""" % self.model.temporary)
+    cursor.execute("""CREATE %s TABLE explanations(t INTEGER NOT NULL, s INTEGER NOT NULL, o INTEGER, rule INTEGER NOT NULL)""" % self.model.temporary)
+    cursor.execute("""CREATE %s TABLE explanation_sources(expl_id INTEGER NOT NULL, table_id INTEGER NOT NULL, source_rowid INTEGER NOT NULL)""" % self.model.temporary)
+    self.model.sql_destroy += """\nDROP VIEW IF EXISTS temp.explanation_rows;\nDROP TABLE explanation_names;\nDROP TABLE explanations;\nDROP TABLE explanation_sources;\n"""
+    self.open()
+
+  def open(self): # Also when a persistent session is restored
+    self.id_2_name = dict(self.model.cursor.execute("""SELECT id, name FROM explanation_names"""))
+    self.name_2_id = { name : id for (id, name) in self.id_2_name.items() }
+    self.width     = 0
+    widths = [len(sql_if.sql_froms) for stage in self.model.rule_set.stages for rule in stage.preprocesses + stage.completions
+              for sql_if in getattr(getattr(rule, "sql", None), "sql_ifs", ())]
+    self.ensure_width(max(widths + [1]))
+
+  def id(self, name):
+    id = self.name_2_id.get(name)
+    if id is None:
+      id = self.name_2_id[name] = len(self.name_2_id) + 1
+      self.id_2_name[id] = name
+      self.model.cursor.execute("""INSERT INTO explanation_names VALUES (?,?)""", (id, name))
+    return id
+
+  def ensure_width(self, width):
+    if width <= self.width: return
+    cursor  = self.model.cursor
+    columns = ",".join("t%s,rowid%s" % (i, i) for i in range(width))
+    pairs   = " UNION ALL ".join("SELECT NEW.t%s AS t, NEW.rowid%s AS source_rowid" % (i, i) for i in range(width))
+    cursor.execute("""DROP VIEW IF EXISTS temp.explanation_rows""") # Also drops the trigger
+    cursor.execute("""CREATE TEMPORARY VIEW explanation_rows(t,s,o,rule,%s) AS SELECT %s""" % (columns, ",".join("NULL" for i in range(4 + 2 * width))))
+    cursor.execute("""
+CREATE TEMPORARY TRIGGER explanation_rows_insert INSTEAD OF INSERT ON explanation_rows BEGIN
+  INSERT INTO explanations VALUES (NEW.t, NEW.s, NEW.o, NEW.rule);
+  INSERT INTO explanation_sources SELECT (SELECT MAX(rowid) FROM explanations), t, source_rowid FROM (%s) WHERE t IS NOT NULL;
+END""" % pairs)
+    self.width = width
+
+  def insert_sql(self, width): # INSERT INTO explanation_rows, with width sources; to be followed by a SELECT
+    self.ensure_width(width)
+    return """INSERT INTO explanation_rows(t,s,o,rule%s)""" % "".join(",t%s,rowid%s" % (i, i) for i in range(width))
+
+  def select_sources(self, sources, width): # sources are (table name, rowid SQL) pairs; padded to width with NULLs
+    return ",".join(["%s,%s" % (self.id(table_name), rowid) for (table_name, rowid) in sources] + ["NULL,NULL"] * (width - len(sources)))
+
+  def add(self, t, s, o, rule, sources = ()): # sources are (table id, rowid) pairs
+    cursor = self.model.cursor
+    cursor.execute("""INSERT INTO explanations VALUES (?,?,?,?)""", (self.id(t), s, o, self.id(rule)))
+    sources = [(table_id, rowid) for (table_id, rowid) in sources if not table_id is None]
+    if sources:
+      expl_id = cursor.lastrowid
+      cursor.executemany("""INSERT INTO explanation_sources VALUES (?,?,?)""", [(expl_id, table_id, rowid) for (table_id, rowid) in sources])
+
+  def add_many(self, t, rule, s_os): # Explanations without source
+    t    = self.id(t)
+    rule = self.id(rule)
+    self.model.cursor.executemany("""INSERT INTO explanations VALUES (?,?,?,?)""", [(t, s, o, rule) for (s, o) in s_os])
+
+  def add_select(self, t, rule, sql, params = ()): # Explanations without source, for the (s, o) rows of the SELECT
+    self.model.cursor.execute("""INSERT INTO explanations SELECT ?,*,? FROM (%s)""" % sql, (self.id(t),) + tuple(params) + (self.id(rule),))
+
+  def rules(self, s, o): # Names of the rules that inferred (s, o), one per explanation
+    return [self.id_2_name[rule] for (rule,) in self.model.cursor.execute("""SELECT rule FROM explanations WHERE s=? AND o=?""", (s, o))]
+
+  def explanations(self):
+    # Returns a list of (t, s, o, rule, sources) with names, sources being a list of (table name, rowid)
+    cursor    = self.model.cursor
+    id_2_name = self.id_2_name
+    expl_id_2_sources = defaultdict(list)
+    for expl_id, table_id, rowid in cursor.execute("""SELECT expl_id, table_id, source_rowid FROM explanation_sources ORDER BY rowid"""):
+      expl_id_2_sources[expl_id].append((id_2_name[table_id], rowid))
+    return [(id_2_name[t], s, o, id_2_name[rule], expl_id_2_sources.get(expl_id, []))
+            for (expl_id, t, s, o, rule) in cursor.execute("""SELECT rowid, t, s, o, rule FROM explanations ORDER BY rowid""").fetchall()]
+
+  def resolve(self, table_name, rowids, columns = "s"): # Batched lookup of rows by rowid; returns { rowid : value(s) }
+    rowids = sorted(set(rowids))
+    r = {}
+    for i in range(0, len(rowids), 500):
+      for row in self.model.cursor.execute("""SELECT rowid,%s FROM %s WHERE rowid IN (%s)""" % (columns, table_name, ",".join(str(rowid) for rowid in rowids[i : i + 500]))):
+        r[row[0]] = row[1] if len(row) == 2 else row[1:]
+    return r
@@ -17,7 +17,7 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, os, random, types
+import sys, os, time, random, types
 
 from owlready2 import *
 
@@ -201,8 +201,13 @@ def create_random(iri = "http://test.org/random.owl", nb_class = 100, nb_is_a =
         c = Or(list(l))
         C.is_a.append(c)
         classes.append(c)
+        
+      elif to_create == "not":
+        c = Not(r.choice(atomic_classes))
+        C.is_a.append(c)
+        classes.append(c)
 
-  if '-o' in sys.argv:
+  if (__name__ == "__main__") and ('-o' in sys.argv): # Only when run as a script
     print()
     for p in props:
       if p.is_a == [ObjectProperty]: print("      random.%s" % p.name)
@@ -246,36 +251,37 @@ def run_semantic2sql(onto):
   return t
 
 
-seed = 11
+if __name__ == "__main__":
+  seed = 11
 
-if "-s" in sys.argv:
-  seed = int(sys.argv[sys.argv.index("-s") + 1])
+  if "-s" in sys.argv:
+    seed = int(sys.argv[sys.argv.index("-s") + 1])
   
-#onto = create_random(nb_class = 10, nb_and = 3, nb_or = 1, seed = 67)
-#onto = create_random(nb_class = 6, nb_prop = 1, nb_prop_is_a = 0, nb_and = 2, nb_or = 1, seed = seed)
-#onto = create_random(nb_class = 5, nb_prop = 1, nb_prop_is_a = 0, nb_and = 2, nb_or = 1, seed = seed)
-onto = create_random(nb_class = 5, nb_prop = 1, nb_prop_is_a = 0, nb_and = 1, nb_or = 1, seed = seed)
-onto.save("/tmp/t.owl")
-print(".")
+  #onto = create_random(nb_class = 10, nb_and = 3, nb_or = 1, seed = 67)
+  #onto = create_random(nb_class = 6, nb_prop = 1, nb_prop_is_a = 0, nb_and = 2, nb_or = 1, seed = seed)
+  #onto = create_random(nb_class = 5, nb_prop = 1, nb_prop_is_a = 0, nb_and = 2, nb_or = 1, seed = seed)
+  onto = create_random(nb_class = 5, nb_prop = 1, nb_prop_is_a = 0, nb_and = 1, nb_or = 1, seed = seed)
+  onto.save("/tmp/t.owl")
+  print(".")
 
-if   "-h" in sys.argv:
-  sync_reasoner()
+  if   "-h" in sys.argv:
+    sync_reasoner()
 
-elif "-l" in sys.argv:
-  seed = 0
-  while 1:
-    world = World()
-    cmd = "python ./semantic2sql/random_ontology.py -s %s" % seed
-    print(cmd)
+  elif "-l" in sys.argv:
+    seed = 0
+    while 1:
+      world = World()
+      cmd = "python ./semantic2sql/random_ontology.py -s %s" % seed
+      print(cmd)
     
-    t = time.time()
-    os.system(cmd)
-    t = time.time() - t
-    if t > 0.5:
-      print("SEED", seed)
-      break
-    seed += 1
-    time.sleep(0.1)
+      t = time.time()
+      os.system(cmd)
+      t = time.time() - t
+      if t > 0.5:
+        print("SEED", seed)
+        break
+      seed += 1
+      time.sleep(0.1)
     
-else:
-  run_semantic2sql(onto)
+  else:
+    run_semantic2sql(onto)
@@ -17,35 +17,85 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, time, random, itertools
-from collections import defaultdict
+import sys, time, random, itertools, hashlib
+from collections import defaultdict, Counter
 import owlready2
 from owlready2.reasoning import _apply_reasoning_results, _INFERRENCES_ONTOLOGY
 from semantic2sql.rule import *
+from semantic2sql.construct_trace import *
+from semantic2sql.scheduler import *
+from semantic2sql.profiler import *
+from semantic2sql.planner import *
+from semantic2sql.sinks import *
+from semantic2sql.blank_allocator import *
+from semantic2sql.bulk_load import *
+from semantic2sql.work_store import *
+from semantic2sql.provenance import *
 
 
 _NORMALIZED_PROPS = {rdfs_subclassof, SOME, VALUE, ONLY, EXACTLY, MIN, MAX, owl_onproperty, owl_onclass, owl_ondatarange, owl_withrestrictions}
+_RESTRICTION_PS   = { ONLY : -1, SOME : -1, VALUE : -1, HAS_SELF : -1, MAX : -2, MIN : -2, EXACTLY : -2, owl_onproperty : 2, owl_onclass : 3, owl_ondatarange : 3 } # p => index in the restriction row
+_RESTRICTION_TABLE_NAMES = ["some", "data_value", "only", "max", "min", "exactly"]
+_REMOVE_SINGLE_LIST_RELS = { owl_intersectionof, owl_unionof }
+_DRED_KEPT        = { "is_a" : "s!=o AND o!=%s" % owl_thing, "prop_is_a" : "s!=o" } # Rows always true, never over-deleted; for the other tables, those of the constructs (s<0)
 
 
 class ReasonedModel(object):
-  def __init__(self, world, rule_set = None, temporary = True, debug = False, explain = False):
+  def __init__(self, world, rule_set = None, temporary = True, debug = False, explain = False, semi_naive = True, trace = False, is_a_index = True, scheduler = "priority", persistent = False, profile = False, plan_joins = True, is_a_storage = "full", blank_range = None, work_store = None):
+    if persistent and work_store: raise ValueError("Persistent sessions cannot use a work store!")
     self.world                  = world
     self.db                     = world.graph.db
-    self.temporary              = "TEMPORARY" if temporary else ""
-    self._candidate_completions = set()
+    self.work_store             = WorkStore(work_store) if isinstance(work_store, str) else work_store # Filename or WorkStore
+    self.temporary              = "TEMPORARY" if (temporary and not persistent and not self.work_store) else ""
+    self.persistent             = persistent
+    self.scheduler_class        = SCHEDULERS[scheduler] if isinstance(scheduler, str) else scheduler
+    self._candidate_completions = self.scheduler_class(self)
     self.sql_destroy            = ""
     self.debug                  = debug
     self.explain                = explain
+    self.provenance             = ProvenanceStore(self) if explain else None
     self._extra_dumps           = {}
     self.extract_result_time    = 0
+    self.nb_new_is_a            = 0
+    self.nb_new_equiv           = 0
+    self.stage_times            = {}
+    self.setup_times            = {} # Table name => time spent loading and indexing it (see BulkLoad)
     self.new_parents            = None
     self.new_equivs             = None
     self.entity_2_type          = None
     self.optimize_limits        = defaultdict(lambda : 1)
+    self.statistics             = TableStatistics(self)
+    self.semi_naive             = semi_naive
+    self._delta_ranges          = {}
+    self._batch                 = None
+    self.is_a_index             = {} if is_a_index else None # s => { o }, mirror of the is_a table
+    self._is_a_index_rowid      = 0
+    self.closures               = {} # Table => TransitiveClosure, see BuiltinTransitiveClosure
+    self.restriction_depths     = RestrictionDepths()
+    if not is_a_storage in ("full", "reduced"): raise ValueError("Unknown is_a storage '%s'!" % is_a_storage)
+    self.is_a_storage           = is_a_storage # "reduced": the is_a closure is kept as interval labels, see IntervalLabels and IS_A_CLOSURE_RULE
+    self.is_a_labels            = None
+    self.construct_renames      = {} # Blank node => storid of the construct it was merged into, see normalize_constructs()
+    self._grown_constructs      = set() # Names of the construct tables grown by a persistent session, see _normalize_added_constructs()
+    self._construct_catalog     = None
+    self.blanks                 = BlankAllocator(world.graph, reserved = blank_range) # blank_range: (current, limit), see reserve_blank_ranges()
     
-    if rule_set is None:            self.rule_set = get_rule_set("rules.txt").tailor_for(self)
-    elif isinstance(rule_set, str): self.rule_set = get_rule_set(rule_set).tailor_for(self)
+    if   isinstance(trace, ConstructTracer): self.trace = trace
+    elif callable(trace):                    self.trace = ConstructTracer(self, sink = trace)
+    elif trace:                              self.trace = ConstructTracer(self)
+    else:                                    self.trace = None
+    
+    if   isinstance(profile, Profiler):      self.profiler = profile
+    elif profile:                            self.profiler = Profiler()
+    else:                                    self.profiler = None
+    
+    self.planner = JoinPlanner(self) if (plan_joins and not explain) else None # The explanations SQL keeps the static join order, see SQLIf.ordered_sql_from()
+    
+    if rule_set is None:            rule_set = "rules.txt"
+    if isinstance(rule_set, str):   self.rule_set = get_rule_set(rule_set, is_a_closure = (is_a_storage == "reduced")).tailor_for(self) # The rules file gets the is_a TransitiveClosure
     else:                           self.rule_set = rule_set.tailor_for(self)
+    if (is_a_storage == "reduced") and not any(isinstance(rule, BuiltinTransitiveClosure) and (rule.table.name == "is_a") for stage in self.rule_set.stages for rule in stage.preprocesses + stage.completions):
+      raise ValueError("The 'reduced' is_a storage needs an is_a TransitiveClosure rule, which labels the closure! Load the rule set with semantic2sql.rule.IS_A_CLOSURE_RULE appended to the rules, or pass a rules filename.")
 
     self._list_cache = {}
     for l in self.rule_set.lists.values(): self._list_cache[l] = {}
@@ -53,13 +103,39 @@ class ReasonedModel(object):
   def _increment_extra(self, name, v = 1):
     self._extra_dumps[name] = self._extra_dumps.get(name, 0) + v
     
-  def new_blank_node(self):
-    self.current_blank += 1
-    return -self.current_blank
+  def new_blank_node(self): return self.blanks.new_blank_node()
   
-  def prepare(self):
-    self.current_blank = self.world.graph.execute("SELECT current_blank FROM store").fetchone()[0]
+  def new_blank_nodes(self, nb): return self.blanks.new_blank_nodes(nb)
+  
+  @property
+  def current_blank(self): return self.blanks.current
+  
+  def _has_is_a(self, s, o):
+    if self.is_a_labels and (s != o) and self.is_a_labels.reaches(s, o): return True # Self is_a are always stored
+    if not self.is_a_index is None: return o in self._get_is_a_index(s)
+    if self._batch and ((s, o) in self._batch.is_a_pairs): return True
+    return not self.cursor.execute("""SELECT 1 FROM is_a WHERE s=? AND o=? LIMIT 1""", (s, o)).fetchone() is None
+  
+  def _get_is_a_index(self, s): # The index is loaded lazily, by s
+    os = self.is_a_index.get(s)
+    if os is None:
+      os = self.is_a_index[s] = { o for (o,) in self.cursor.execute("""SELECT o FROM is_a WHERE s=?""", (s,)) }
+    return os
+  
+  def _add_is_a(self, s, o):
+    if not self.is_a_index is None: self._get_is_a_index(s).add(o)
     
+  def _sync_is_a_index(self): # Catch up with the rows inserted in is_a by SQL, since the last sync
+    if self.is_a_index is None: return
+    if not self.is_a_index: # Nothing loaded yet
+      self._is_a_index_rowid = self.cursor.execute("""SELECT MAX(rowid) FROM is_a""").fetchone()[0] or 0
+      return
+    for rowid, s, o in self.cursor.execute("""SELECT rowid,s,o FROM is_a WHERE rowid>?""", (self._is_a_index_rowid,)):
+      os = self.is_a_index.get(s)
+      if not os is None: os.add(o)
+      if rowid > self._is_a_index_rowid: self._is_a_index_rowid = rowid
+      
+  def prepare(self):
     if self.temporary: self.cursor.execute("""PRAGMA temp_store = MEMORY""")
     
     self.cursor.executescript("""
@@ -103,50 +179,457 @@ DROP TABLE only;
 DROP TABLE max;
 DROP TABLE min;
 DROP TABLE exactly;
+DROP VIEW restriction;
+DROP TABLE infer_descendants;
+DROP TABLE infer_ancestors;
+DROP TABLE concrete;
 DROP VIEW all_objs;
 """
 
-    # Imports
-    self.cursor.execute("""INSERT INTO types SELECT s,o FROM objs WHERE p=? AND o IN (?,?,?,?,?,?)""", (rdf_type, owl_named_individual, owl_class, owl_object_property, owl_data_property, owl_functional_property, owl_transitive_property))
-    
-    self.cursor.execute("""INSERT INTO is_a SELECT q1.s,q1.o,1 FROM objs q1, objs q2 WHERE q1.p=? AND q2.s=q1.s AND q2.p=? AND q2.o=? AND q1.o!=?""", (rdf_type, rdf_type, owl_named_individual, owl_named_individual))
-    self.cursor.execute("""INSERT INTO is_a SELECT s,o,1 FROM objs WHERE p=?""", (rdfs_subclassof,))
+    # Imports, in bulk: the indexes are created after loading
+    bulk = BulkLoad(self.cursor, self.setup_times)
+    bulk.add_table("types",     ["s", "o"], ["""CREATE UNIQUE INDEX types_so ON types(s,o)""", """CREATE INDEX types_o ON types(o)"""])
+    bulk.add_table("is_a",      ["s", "o"], ["""CREATE UNIQUE INDEX is_a_so ON is_a(s,o)""", """CREATE INDEX is_a_o ON is_a(o)""", """CREATE INDEX is_a_l ON is_a(l)"""])
+    bulk.add_table("prop_is_a", ["s", "o"], ["""CREATE UNIQUE INDEX prop_is_a_so ON prop_is_a(s,o)""", """CREATE INDEX prop_is_a_o ON prop_is_a(o)"""])
+    self._import_assertions(bulk = bulk)
+    bulk.finish()
     
-    self.cursor.execute("""INSERT INTO prop_is_a SELECT s,o FROM objs WHERE p=?""", (rdfs_subpropertyof,))
+    if self.explain:
+      self.provenance.create()
+      self.provenance.add_select("is_a", "assertion", """SELECT s, o FROM is_a""")
+      
+  def _import_assertions(self, only_s = None, bulk = None): # With bulk, the SELECTs are given to the BulkLoad
+    if only_s: where = " AND q1.s IN (SELECT s FROM %s)" % only_s # Only for the entities in the given table
+    else:      where = ""
+    selects = [
+      ("types",     """SELECT q1.s,q1.o FROM objs q1 WHERE q1.p=? AND q1.o IN (?,?,?,?,?,?)%s""" % where, (rdf_type, owl_named_individual, owl_class, owl_object_property, owl_data_property, owl_functional_property, owl_transitive_property)),
+      ("is_a",      """SELECT q1.s,q1.o,1 FROM objs q1, objs q2 WHERE q1.p=? AND q2.s=q1.s AND q2.p=? AND q2.o=? AND q1.o!=?%s""" % where, (rdf_type, rdf_type, owl_named_individual, owl_named_individual)),
+      ("is_a",      """SELECT q1.s,q1.o,1 FROM objs q1 WHERE q1.p=?%s""" % where, (rdfs_subclassof,)),
+      ("prop_is_a", """SELECT q1.s,q1.o FROM objs q1 WHERE q1.p=?%s""" % where, (rdfs_subpropertyof,)),
+    ]
+    for table, sql, params in selects:
+      if bulk: bulk.add_select(table, sql, params)
+      else:    self.cursor.execute("""INSERT OR IGNORE INTO %s %s""" % (table, sql), params)
     
-    self.cursor.execute("""CREATE UNIQUE INDEX types_so ON types(s,o)""")
-    self.cursor.execute("""CREATE INDEX types_o ON types(o)""")
+  def _optimize(self): # Before the last stage, updates the statistics of all the tables that grew since their last update
+    updated = [table for table, nb in self.last_inferences.items() if self.statistics.update(table, nb)]
+    if self.planner: self.planner.invalidate(updated)
     
-    self.cursor.execute("""CREATE UNIQUE INDEX is_a_so ON is_a(s,o)""")
-    self.cursor.execute("""CREATE INDEX is_a_o ON is_a(o)""")
-    self.cursor.execute("""CREATE INDEX is_a_l ON is_a(l)""")
+  def _check_optimize_table(self, table, nb):
+    if nb >= self.optimize_limits[table]:
+      self.optimize_limits[table] = nb + nb // 4 + 1 # Statistics updated every 25% of growth, see TableStatistics
+      self.statistics.update(table, nb)
+      if self.planner: self.planner.invalidate([table])
+      
     
-    self.cursor.execute("""CREATE UNIQUE INDEX prop_is_a_so ON prop_is_a(s,o)""")
-    self.cursor.execute("""CREATE INDEX prop_is_a_o ON prop_is_a(o)""")
+  def update_delta_table(self, table, rule):
+    # delta_<table> contains the rows of table with rowid in ]low, high], low being the oldest last inference of the rules
+    # using it; each rule only reads its own rows from the delta. Returns True if the delta is not empty for the rule
+    last        = rule.last_inferences[table] or 0
+    name        = "delta_%s" % table.name
+    delta_range = self._delta_ranges.get(table)
+    if delta_range is None: delta_range = self._create_delta_table(table, last)
+    delta_range[2].add(rule)
     
-    if self.explain:
-      self.cursor.execute("""CREATE %s TABLE explanations(t TEXT NOT NULL, s INTEGER NOT NULL, o INTEGER NOT NULL, rule TEXT NOT NULL, sources TEXT NOT NULL)""" % self.temporary)
-      self.cursor.execute("""INSERT INTO explanations SELECT 'is_a', s, o, 'assertion', '' FROM is_a""")
-      self.sql_destroy += """\nDROP TABLE explanations;\n"""
+    if last < delta_range[0]: # Extends the delta downward, without removing the rows needed by the other rules
+      self.cursor.execute("""INSERT INTO %s SELECT rowid,%s FROM %s WHERE rowid>? AND rowid<=?""" % (name, ",".join(table.columns), table.name), (last, delta_range[0]))
+      delta_range[0] = last
       
-  def _optimize(self):
+    else:
+      low = min(user.last_inferences.get(table) or 0 for user in delta_range[2])
+      if low > delta_range[0]: # All the rules have read the oldest rows
+        self.cursor.execute("""DELETE FROM %s WHERE rowid<=?""" % name, (low,))
+        delta_range[0] = low
+        if delta_range[1] < low: delta_range[1] = low
+        
+    high = self.cursor.execute("""SELECT MAX(rowid) FROM %s""" % table.name).fetchone()[0] or 0
+    if high > delta_range[1]:
+      self.cursor.execute("""INSERT INTO %s SELECT rowid,%s FROM %s WHERE rowid>?""" % (name, ",".join(table.columns), table.name), (delta_range[1],))
+      delta_range[1] = high
+      
+    return delta_range[1] > last
   
-    pass
+  def _create_delta_table(self, table, last = 0):
+    self.cursor.execute("""CREATE TEMPORARY TABLE delta_%s(rowid INTEGER PRIMARY KEY, %s)""" % (table.name, ", ".join("%s INTEGER" % column for column in table.columns)))
+    delta_range = self._delta_ranges[table] = [last, last, set()]
+    return delta_range
   
-  def _check_optimize_table(self, table, nb):
-    if nb >= self.optimize_limits[table]:
-      self.optimize_limits[table] = 2 * nb
-      self.cursor.execute("""ANALYZE %s""" % table.name)
+  def _reset_delta_tables(self): # Needed after removals in the inferrable tables
+    if self.trace: self.trace.clear_index()
+    if not self.is_a_index is None:
+      self.is_a_index.clear()
+      self._is_a_index_rowid = 0
+    self.closures.clear()
+    self.restriction_depths.clear()
+    self.statistics.clear()
+    self.is_a_labels = None
+    for table, delta_range in self._delta_ranges.items():
+      self.cursor.execute("""DELETE FROM delta_%s""" % table.name)
+      delta_range[0] = delta_range[1] = 0
+      delta_range[2].clear()
       
-    
   def destroy(self):
     self.cursor.executescript(self.sql_destroy)
     self.sql_destroy = ""
+    self._drop_delta_tables()
+    if self.work_store:
+      self.world.graph.commit() # Else the work store cannot be detached
+      self.work_store.detach()
+    
+  def _drop_delta_tables(self):
+    for table in self._delta_ranges: self.cursor.execute("""DROP TABLE delta_%s""" % table.name)
+    self._delta_ranges = {}
+    
+  def _tables_changed_since(self, since):
+    return { table for table, nb in self.last_inferences.items() if nb > (since.get(table) or 0) }
+  
+  def _from_grown_constructs(self, rule): # The construct tables have no delta => such rules are executed fully once
+    return isinstance(rule, IfRule) and not rule.from_tables.isdisjoint(self._grown_constructs)
+  
+  def _rule_set_signature(self):
+    h = hashlib.sha1()
+    for stage in self.rule_set.stages:
+      for rule in stage.preprocesses + stage.completions:
+        h.update(("%s %s %s\n" % (rule.name, rule.__class__.__name__, getattr(rule, "sql0", ""))).encode("utf8"))
+    return h.hexdigest()
+  
+  def _load_session(self):
+    if not self.cursor.execute("""SELECT 1 FROM sqlite_master WHERE type='table' AND name='s2s_session'""").fetchone(): return None
+    return dict(self.cursor.execute("""SELECT key, value FROM s2s_session"""))
+  
+  def _run_session_incrementally(self):
+    # Persistent session: the tables inferred by the previous run are kept, and the changes of the quads since the
+    # snapshot of the previous run are reasoned incrementally:
+    #  - the removed is-a / type / subproperty assertions between named entities, by DRed (see _dred_over_delete()),
+    #  - the added is-a / type / subproperty assertions,
+    #  - the new anonymous constructs, normalized alone (see _normalize_added_constructs()).
+    # Other changes (modified constructs, new axioms on properties,...) need a full run; returns False in that case.
+    cursor  = self.cursor
+    session = self._load_session()
+    if session is None: return False
+    self.sql_destroy = session["sql_destroy"]
+    
+    relevant_props = set(_NORMALIZED_PROPS) | { rdf_first, rdf_rest, owl_equivalentclass, owl_equivalentindividual, rdf_type, rdfs_subpropertyof }
+    for rule in self.rule_set.name_2_rule.values():
+      for depends in rule.dependss: relevant_props.update(depends)
+      relevant_props.update(getattr(rule, "rels", ()))
+    ps = ",".join(str(p) for p in relevant_props)
+    
+    ok = (session["signature"] == self._rule_set_signature()) and cursor.execute("""SELECT 1 FROM sqlite_master WHERE type='table' AND name='s2s_renames'""").fetchone()
+    dreds = None
+    if ok:
+      cursor.execute("""DROP TABLE IF EXISTS s2s_added""") # Left by an aborted run
+      cursor.execute("""CREATE TEMPORARY TABLE s2s_added AS SELECT s,p,o FROM quads EXCEPT SELECT s,p,o FROM s2s_session_quads""")
+      removeds = cursor.execute("""SELECT s,p,o FROM s2s_session_quads WHERE p IN (%s) EXCEPT SELECT s,p,o FROM quads WHERE p IN (%s)""" % (ps, ps)).fetchall()
+      self._init_last_inferences()
+      ok = self._check_session_changes(ps, removeds)
+      if ok and removeds:
+        dreds = self._dred_over_delete(removeds)
+        ok = not dreds is None
+    if not ok:
+      cursor.execute("""DROP TABLE IF EXISTS s2s_added""")
+      self.destroy()
+      return False
+    
+    self.blanks.skip_to(int(session["current_blank"])) # The blank nodes of the session are kept
+    self.max_restriction_depth = int(session["max_restriction_depth"])
+    
+    if dreds:
+      for table, rows in dreds.items():
+        rowids = sorted(rows)
+        for i in range(0, len(rowids), 500):
+          cursor.execute("""DELETE FROM %s WHERE rowid IN (%s)""" % (table.name, ",".join(str(rowid) for rowid in rowids[i : i + 500])))
+      self._reset_delta_tables()
+      self._init_last_inferences()
+    since = dict(self.last_inferences)
+    
+    if not self._normalize_added_constructs(dreds):
+      cursor.execute("""DROP TABLE s2s_added""")
+      self.destroy()
+      return False
+    
+    cursor.execute("""CREATE TEMPORARY TABLE s2s_added_s AS SELECT DISTINCT s FROM s2s_added""")
+    if dreds: cursor.executemany("""INSERT INTO s2s_added_s VALUES (?)""", { (row[0],) for rows in dreds.values() for row in rows.values() })
+    self._import_assertions("s2s_added_s")
+    cursor.execute("""DROP TABLE s2s_added_s""")
+    if dreds: self._dred_rederive(dreds)
+    self._apply_construct_renames(since)
+    if self.explain:
+      self.provenance.open()
+      self.provenance.add_select("is_a", "assertion", """SELECT s, o FROM is_a WHERE rowid>?""", (since[self.rule_set.tables["is_a"]],))
+    self._init_last_inferences()
+    
+    self.max_restriction_depth_last_update = since[self.rule_set.tables["is_a"]]
+    
+    if self._tables_changed_since(since) or self._grown_constructs:
+      for stage in self.rule_set.stages:
+        self.execute_stage(stage, since)
+    return True
+  
+  def _check_session_changes(self, ps, removeds): # True if the changes can be reasoned incrementally, see _run_session_incrementally()
+    cursor = self.cursor
+    if removeds:
+      if self.explain or (self.is_a_storage == "reduced"): return False # The explanations and the labels are not retracted
+      for stage in self.rule_set.stages:
+        for rule in stage.preprocesses + stage.completions:
+          if isinstance(rule, BuiltinRemoveSingleParentClass): return False
+          if isinstance(rule, IfRule) and [sql_if for sql_if in rule.sql.sql_ifs if sql_if.sql_not_is_as]: return False # Removals may enable the rule
+      for s, p, o in removeds:
+        if (s < 0) or (o < 0) or (not p in (rdf_type, rdfs_subclassof, rdfs_subpropertyof)): return False
+        if (p == rdf_type) and not cursor.execute("""SELECT 1 FROM objs WHERE s=? AND p=? AND o=? LIMIT 1""", (o, rdf_type, owl_class)).fetchone(): return False
+        
+    blanks = { s for (s,) in cursor.execute("""SELECT DISTINCT s FROM s2s_added WHERE s<0""") }
+    for (o,) in cursor.execute("""SELECT DISTINCT o FROM s2s_added WHERE o<0 AND p IN (%s)""" % ps).fetchall():
+      if not o in blanks: return False # Refers to a blank node of the snapshot
+    if blanks:
+      cursor.execute("""CREATE TEMPORARY TABLE s2s_added_blanks(s INTEGER PRIMARY KEY)""")
+      cursor.executemany("""INSERT INTO s2s_added_blanks VALUES (?)""", [(s,) for s in blanks])
+      modified = cursor.execute("""SELECT 1 FROM s2s_session_quads WHERE (s<0 AND s IN (SELECT s FROM s2s_added_blanks)) OR (o<0 AND o IN (SELECT s FROM s2s_added_blanks)) LIMIT 1""").fetchone()
+      cursor.execute("""DROP TABLE s2s_added_blanks""")
+      if modified: return False # Construct of the snapshot modified
+      
+    construct_props = set(_NORMALIZED_PROPS) | { rdf_first, rdf_rest, rdf_type }
+    for l in self.rule_set.lists.values():
+      if l.flat: construct_props.update(l.flat.rels)
+    for s, p, o in cursor.execute("""SELECT s,p,o FROM s2s_added WHERE p IN (%s)""" % ps).fetchall():
+      if   s < 0:                                                 ok = p in construct_props
+      elif p in (rdf_type, rdfs_subclassof, rdfs_subpropertyof): ok = True
+      else:                                                       ok = (p in (owl_equivalentclass, owl_equivalentindividual)) and (o < 0)
+      if not ok: return False
+      
+    if blanks: # The rules creating new lists would create them again, when executed fully (see execute_stage())
+      added_ps = { p for (p,) in cursor.execute("""SELECT DISTINCT p FROM s2s_added WHERE s<0""") }
+      grown    = set(_RESTRICTION_TABLE_NAMES) if added_ps.intersection(_RESTRICTION_PS) else set()
+      for l in self.rule_set.lists.values():
+        if l.flat and added_ps.intersection(l.flat.rels): grown.update(self._list_table_names(l))
+      for stage in self.rule_set.stages:
+        for rule in stage.preprocesses + stage.completions:
+          if isinstance(rule, IfMultipleInferRule) and rule.new_vars and not rule.from_tables.isdisjoint(grown): return False
+    return True
+  
+  def _list_table_names(self, l):
+    names = [builtin.table.name for builtin in (l.flat, l.key, l.linked) if builtin]
+    if l.rel in _REMOVE_SINGLE_LIST_RELS: names.append("flat_lists_292") # View on the union and intersection lists
+    return names
+  
+  def _restore_list_builtins(self):
+    for stage in self.rule_set.stages:
+      for rule in stage.preprocesses:
+        if isinstance(rule, (BuiltinCreateFlatList, BuiltinCreateKeyList, BuiltinCreateLinkedList)): rule.restore(self, self.cursor)
+        
+  def _dred_over_delete(self, removeds):
+    # DRed (delete and re-derive), 1st step: the rows of the fact tables that may depend on the removed assertions
+    # are over-deleted, i.e. the rows of the assertions and, until fixpoint, the rows inserted by the rules matching
+    # at least one over-deleted row. The rules are evaluated with the delta branches of their SQL, the delta tables
+    # containing the last over-deleted rows, with rowids shifted above those of the table. The constructs and the
+    # rows always true (see _DRED_KEPT) are kept. Returns { table : { rowid : row } }, or None if a full run is needed.
+    cursor   = self.cursor
+    tables   = self.rule_set.tables
+    facts    = { table for table, inferrable in self.rule_set.table_2_inferrable.items() if inferrable and not (table.list or table.is_a_thing) }
+    rules    = []
+    closures = []
+    for stage in self.rule_set.stages:
+      for rule in stage.preprocesses + stage.completions:
+        if   isinstance(rule, BuiltinTransitiveClosure): closures.append(rule)
+        elif isinstance(rule, (IfSingleInferRule, IfMultipleInferRule)) and rule.sql_dred: rules.append(rule)
+    delta_tables = { table for rule in rules for table in rule.delta_tables }
+    
+    matches = {}
+    def match(table, values): # The rows matching values (None for any value), except those kept; None if no value is given
+      rows = matches.get((table, values))
+      if rows is None:
+        columns = [(column, value) for column, value in zip(table.columns, values) if (column != "l") and (not value is None)]
+        if not columns: return None
+        rows = matches[table, values] = { row[0] : row[1:] for row in cursor.execute("""SELECT rowid,%s FROM %s WHERE %s AND %s""" % (",".join(table.columns), table.name, " AND ".join("%s=?" % column for column, value in columns), _DRED_KEPT.get(table.name, "s>0")), [value for column, value in columns]) }
+      return rows
+    
+    nexts = defaultdict(dict)
+    for s, p, o in removeds:
+      if p == rdfs_subpropertyof: nexts[tables["prop_is_a"]].update(match(tables["prop_is_a"], (s, o)))
+      else:                       nexts[tables["is_a"]]     .update(match(tables["is_a"], (s, o, None)))
+      
+    dreds = defaultdict(dict)
+    while True:
+      frontier = {}
+      for table, rows in nexts.items():
+        rows = { rowid : row for rowid, row in rows.items() if not rowid in dreds[table] }
+        if rows:
+          frontier[table] = rows
+          dreds[table].update(rows)
+      if not frontier: break
+      
+      for table in delta_tables:
+        if not table in self._delta_ranges: self._create_delta_table(table)
+        cursor.execute("""DELETE FROM delta_%s""" % table.name)
+        if table in frontier:
+          last = self.last_inferences[table]
+          cursor.executemany("""INSERT INTO delta_%s VALUES (%s)""" % (table.name, ",".join("?" for i in range(len(table.columns) + 1))),
+                             [(rowid + last,) + row for rowid, row in frontier[table].items()])
+          
+      nexts = defaultdict(dict)
+      for rule in rules:
+        if frontier.keys().isdisjoint(rule.delta_tables): continue
+        params = tuple(self.last_inferences[table] for table in rule.delta_param_tables)
+        for var_values in cursor.execute(rule.sql_dred, params).fetchall():
+          for table, values in rule.dred_heads(var_values):
+            if not table in facts: continue
+            rows = match(table, values)
+            if rows is None: return None
+            nexts[table].update(rows)
+            
+      for rule in closures: # (x, y) may depend on (a, b) if x is_a* a and b is_a* y, the table being closed
+        table = rule.table
+        for row in frontier.get(table, {}).values():
+          nexts[table].update((row2[0], row2[1:]) for row2 in cursor.execute("""SELECT rowid,%s FROM %s WHERE (s=? OR s IN (SELECT s FROM %s WHERE o=?)) AND (o=? OR o IN (SELECT o FROM %s WHERE s=?)) AND %s""" % (",".join(table.columns), table.name, table.name, table.name, _DRED_KEPT.get(table.name, "s>0")), (row[0], row[0], row[1], row[1])))
+          
+    return { table : rows for table, rows in dreds.items() if rows }
+  
+  def _dred_rederive(self, dreds):
+    # DRed, 2nd step: the over-deleted rows still derivable in one step from the remaining rows are inserted again,
+    # and the stages then propagate them as new rows. The rules are restricted to the subjects of the over-deleted rows.
+    cursor   = self.cursor
+    s_2_rows = defaultdict(list)
+    for table, rows in dreds.items():
+      for row in rows.values(): s_2_rows[table, row[0]].append(row)
+    def is_over_deleted(table, values): # values: None for any value
+      if values[0] is None: rows = dreds[table].values()
+      else:                 rows = s_2_rows.get((table, values[0]), ())
+      return any(all((value is None) or (column == "l") or (value == x) for column, value, x in zip(table.columns, values, row)) for row in rows)
+    
+    for stage in self.rule_set.stages:
+      for rule in stage.preprocesses + stage.completions:
+        if   isinstance(rule, IfSingleInferRule):
+          if not rule.table in dreds: continue
+          columns = rule.table.columns
+          ss      = sorted({ row[0] for row in dreds[rule.table].values() })
+          for i in range(0, len(ss), 500):
+            cursor.execute("""WITH heads(%s) AS (%s) INSERT OR IGNORE INTO %s SELECT * FROM heads WHERE %s IN (%s)""" % (",".join(columns), rule.sql0[rule.sql0.find("SELECT"):], rule.table.name, columns[0], ",".join(str(s) for s in ss[i : i + 500])))
+            
+        elif isinstance(rule, IfMultipleInferRule):
+          if not [sql_insert for sql_insert in rule.sql_inserts if (not sql_insert.list) and (sql_insert.table in dreds)]: continue
+          if rule.sql0: r = cursor.execute(rule.sql0).fetchall()
+          else:         r = [()]
+          rows = [var_values for var_values in dict.fromkeys(r)
+                  if [1 for table, values in rule.dred_heads(var_values) if (table in dreds) and is_over_deleted(table, values)]]
+          if rows: rule.execute_rows(self, cursor, rows)
+          
+  def _normalize_added_constructs(self, dreds):
+    # The new anonymous constructs of the added quads are normalized alone: they are merged with the existing
+    # constructs having the same structure (as the hash-consing of normalize_constructs()), and a construct equivalent
+    # to a named class takes the storid of the class (as merge_equivalent_concepts()). Returns False if a full run is needed.
+    cursor = self.cursor
+    s_2_pos = defaultdict(list)
+    for s, p, o in cursor.execute("""SELECT s,p,o FROM s2s_added WHERE s<0 AND p IN (%s)""" % ",".join(str(p) for p in _RESTRICTION_PS)): s_2_pos[s].append((p, o))
+    s_2_list = {}
+    for l in self.rule_set.lists.values():
+      if not l.flat: continue
+      for rel in l.flat.rels:
+        for s, o in cursor.execute("""SELECT s,o FROM s2s_added WHERE s<0 AND p=?""", (rel,)).fetchall():
+          if l.flat.single_element: s_2_list[s] = (l, [o])
+          else:                     s_2_list[s] = (l, [i for (i, d) in self.world._parse_list_as_rdf(o)])
+    if dreds or s_2_list: self._restore_list_builtins() # Needed by List.add(), and by the rules re-derived
+    if not (s_2_pos or s_2_list): return True
+    
+    construct_tables = _RESTRICTION_TABLE_NAMES + [l.flat.table.name for l in self.rule_set.lists.values() if l.flat]
+    targets = {}
+    for s, o in cursor.execute("""SELECT s,o FROM s2s_added WHERE p IN (?,?) AND s>0 AND o<0""", (owl_equivalentclass, owl_equivalentindividual)).fetchall():
+      if (o in targets) or (s in targets.values()) or not ((o in s_2_pos) or (o in s_2_list)): return False
+      for table in construct_tables: # The class is already a construct
+        if cursor.execute("""SELECT 1 FROM %s WHERE s=? LIMIT 1""" % table, (s,)).fetchone(): return False
+      targets[o] = s
+      
+    renames = {}
+    def normalize(x): # The storid of the construct x, or None if a full run is needed
+      if not ((x in s_2_pos) or (x in s_2_list)): return x
+      if x in renames: return renames[x]
+      renames[x] = x # Cycles are kept as is, as in normalize_constructs()
+      target = targets.get(x, x)
+      
+      if x in s_2_pos:
+        po = [(p, normalize(o)) for p, o in s_2_pos[x]]
+        if [p for p, o in po if o is None]: return None
+        restriction = self._restriction_row(target, po)
+        if not restriction: return x
+        table, row = restriction
+        if (table == "data_value") or (len(row) == 3): columns = ["prop", "value"]
+        else:                                           columns = ["card", "prop", "value"]
+        r = cursor.execute("""SELECT s FROM %s WHERE %s LIMIT 1""" % (table, " AND ".join("%s=?" % column for column in columns)), row[1 : len(columns) + 1]).fetchone()
+        if r:
+          x0 = r[0]
+        else:
+          cursor.execute("""INSERT INTO %s VALUES (%s)""" % (table, ",".join("?" for i in row)), row)
+          self._grown_constructs.add(table)
+          x0 = target
+          
+      else:
+        l, elements = s_2_list[x]
+        elements = { normalize(e) for e in elements }
+        if None in elements: return None
+        elements = sorted(elements)
+        if   (len(elements) == 1) and (l.rel in _REMOVE_SINGLE_LIST_RELS): x0 = elements[0]
+        elif (len(elements) <= 1) and not l.flat.single_element:          x0 = x # Not a construct, as in normalize_constructs()
+        else:
+          if l.key: x0 = l.key.get(cursor, elements)
+          else:
+            x0 = None
+            for (s,) in cursor.execute("""SELECT s FROM %s WHERE o=?""" % l.flat.table.name, (elements[0],)).fetchall():
+              if [o for (o,) in cursor.execute("""SELECT o FROM %s WHERE s=? ORDER BY o""" % l.flat.table.name, (s,))] == elements:
+                x0 = s
+                break
+          if not x0:
+            x0 = l.add(self, cursor, defaultdict(int), frozenset(elements), target)
+            self._grown_constructs.update(self._list_table_names(l))
+            
+      if (x in targets) and (x0 != target): return None # Equivalent to an existing construct
+      renames[x] = x0
+      return x0
+    
+    for x in list(s_2_pos) + list(s_2_list):
+      if normalize(x) is None: return False
+    cursor.executemany("""INSERT OR REPLACE INTO s2s_renames VALUES (?,?)""", [(x, x0) for x, x0 in renames.items() if x != x0])
+    return True
+  
+  def _apply_construct_renames(self, since): # The assertions imported since refer to the blank nodes of the quads
+    is_a_since = since[self.rule_set.tables["is_a"]]
+    self.cursor.execute("""
+INSERT OR IGNORE INTO is_a
+SELECT s,o,l FROM (SELECT COALESCE(r1.s0, is_a.s) AS s, COALESCE(r2.s0, is_a.o) AS o, is_a.l AS l FROM is_a LEFT JOIN s2s_renames r1 ON r1.s=is_a.s LEFT JOIN s2s_renames r2 ON r2.s=is_a.o
+                   WHERE is_a.rowid>? AND ((r1.s IS NOT NULL) OR (r2.s IS NOT NULL)))
+WHERE s!=o""", (is_a_since,))
+    self.cursor.execute("""DELETE FROM is_a WHERE rowid>? AND (s IN (SELECT s FROM s2s_renames) OR o IN (SELECT s FROM s2s_renames))""", (is_a_since,))
+    self.cursor.execute("""DELETE FROM types WHERE rowid>? AND s IN (SELECT s FROM s2s_renames)""", (since[self.rule_set.tables["types"]],))
     
+  def _save_session(self, incremental):
+    cursor = self.cursor
+    if incremental:
+      cursor.execute("""DROP TABLE s2s_added""")
+      cursor.execute("""DELETE FROM s2s_session_quads""")
+      cursor.execute("""INSERT INTO s2s_session_quads SELECT s,p,o FROM quads""") # After the sink, whose results are quads too
+    else:
+      cursor.execute("""CREATE TABLE s2s_session(key TEXT PRIMARY KEY, value TEXT)""")
+      cursor.execute("""CREATE TABLE s2s_session_quads AS SELECT s,p,o FROM quads""")
+      cursor.execute("""CREATE TABLE s2s_renames(s INTEGER PRIMARY KEY, s0 INTEGER NOT NULL)""")
+      cursor.executemany("""INSERT INTO s2s_renames VALUES (?,?)""", self.construct_renames.items())
+      self.sql_destroy += """DROP TABLE s2s_session;\nDROP TABLE s2s_session_quads;\nDROP TABLE s2s_renames;\n"""
+      
+    cursor.executemany("""INSERT OR REPLACE INTO s2s_session VALUES (?,?)""", [
+      ("signature",             self._rule_set_signature()),
+      ("current_blank",         str(self.current_blank)),
+      ("max_restriction_depth", str(self.max_restriction_depth)),
+      ("sql_destroy",           self.sql_destroy),
+    ])
+    
+  def _update_restriction_depths(self):
+    depths = self.restriction_depths
+    for table, value in [("some", "value"), ("only", "value"), ("data_value", "NULL")]:
+      rows = self.cursor.execute("""SELECT rowid,s,%s FROM %s WHERE rowid>? ORDER BY rowid""" % (value, table), (depths.last_rowids.get(table, 0),)).fetchall()
+      if rows:
+        depths.last_rowids[table] = rows[-1][0]
+        depths.add_rows((s, o) for rowid, s, o in rows)
+        
   def _restriction_depth(self, s = None, with_is_a = True):
-    if s is None:
-      if with_is_a:
-        r = self.cursor.execute("""
+    if (s is None) and with_is_a:
+      return self.cursor.execute("""
 WITH depth(n) AS (
 SELECT (
 WITH RECURSIVE interm(s) AS (
@@ -158,34 +641,12 @@ SELECT COUNT(*) FROM interm
 )
 FROM restriction)
 SELECT MAX(n) FROM depth;
-""").fetchone()
-      else:
-        r = self.cursor.execute("""
-WITH depth(n) AS (
-SELECT (
-WITH RECURSIVE interm(s) AS (
-SELECT restriction.s
-  UNION
-SELECT r.value FROM interm, restriction r WHERE r.s=interm.s AND r.value IN (SELECT s FROM restriction)
-)
-SELECT COUNT(*) FROM interm
-)
-FROM restriction)
-SELECT MAX(n) FROM depth;
-""").fetchone()
-      
-    else:
-
-      r = self.cursor.execute("""
-WITH RECURSIVE interm(s) AS (
-SELECT ?
-  UNION
-SELECT r.value FROM interm, restriction r WHERE interm.s=r.s
-)
-SELECT COUNT() FROM interm WHERE s IN (SELECT s FROM restriction);
-""", (s,)).fetchone()
-      
-    return r[0]
+""").fetchone()[0]
+    
+    # Without is_a, the depths are maintained incrementally, see RestrictionDepths
+    self._update_restriction_depths()
+    if s is None: return self.restriction_depths.max_depth()
+    return self.restriction_depths.depth(s)
   
   def check_restriction_depth(self, depth):
     if depth <= self.max_restriction_depth: return True
@@ -207,7 +668,7 @@ SELECT s,o FROM objs WHERE p IN (%s) AND s>0 AND o<0
   UNION ALL
 SELECT o,s FROM objs WHERE p IN (%s) AND o>0 AND s<0 
 """ % (ps, ps)).fetchall()
-    if not equivs: return
+    if not equivs: return []
     
     self.cursor.execute("""CREATE INDEX tmpquads_s ON tmpquads(s) WHERE s<0""")
     self.cursor.execute("""CREATE INDEX tmpquads_o ON tmpquads(o) WHERE o<0""")
@@ -230,10 +691,12 @@ SELECT o,s FROM objs WHERE p IN (%s) AND o>0 AND s<0
     
     for table_name in ("is_a", "types"): # Reset due to removals
       self.last_inferences[self.rule_set.tables[table_name]] = self.cursor.execute("""SELECT MAX(rowid) FROM %s""" % table_name).fetchone()[0]
+    self._reset_delta_tables()
       
     #print("\n", time.time() - t, "s", file = sys.stderr)
     
     if self.debug: self.check_last_inferences()
+    return repl
     
   def normalize_constructs(self):
     debug = 0
@@ -241,17 +704,13 @@ SELECT o,s FROM objs WHERE p IN (%s) AND o>0 AND s<0
     nbs   = {}
     flat_lists = [l for l in self.rule_set.lists.values() if l.flat]
     
-    def int_p(po): return int(po[0]), po[1]
-    
     cursor = self.cursor
     world  = self.world
-    merges = {}
     
     cursor.execute("""CREATE TEMPORARY TABLE tmpquads (s INTEGER, p INTEGER, o INTEGER)""")
     cursor.execute("""INSERT INTO tmpquads SELECT s,p,o FROM quads WHERE s < 0 AND p IN (%s)""" % ",".join(str(p) for p in _NORMALIZED_PROPS))
     l = []
-    
-    REMOVE_SINGLE_LIST_RELS = { owl_intersectionof, owl_unionof }
+    single_renames = {}
     
     for flat_list in flat_lists:
       for rel in flat_list.flat.rels:
@@ -261,185 +720,109 @@ SELECT o,s FROM objs WHERE p IN (%s) AND o>0 AND s<0
         else:
           for s,p,o in r:
             rdf_list = list(set(world._parse_list_as_rdf(o)))
-            if   (len(rdf_list) == 1) and (flat_list.rel in REMOVE_SINGLE_LIST_RELS):
+            if   (len(rdf_list) == 1) and (flat_list.rel in _REMOVE_SINGLE_LIST_RELS):
               cursor.execute("""INSERT INTO is_a SELECT q1.s,?,1 FROM is_a q1 WHERE q1.o=?""", (rdf_list[0][0], s))
               cursor.execute("""DELETE FROM is_a WHERE o=?""", (s,))
+              single_renames[s] = rdf_list[0][0]
             elif len(rdf_list) >  1:
               l.extend((s, flat_list.rel, i) for (i,d) in rdf_list)
               
     cursor.executemany("""INSERT INTO tmpquads VALUES (?,?,?)""", l)
     
-    self.merge_equivalent_concepts()
+    equiv_renames = { o : s for (s, o) in self.merge_equivalent_concepts() }
     
     if debug:
       print("\nNORMALIZE STEP 0 :")
       for s,p,o in cursor.execute("""SELECT s,p,o FROM tmpquads""").fetchall(): print("   ", s, p, o)
       print()
     
-    cursor.execute("""CREATE TEMPORARY TABLE tmpnorm (def TEXT, s TEXT, s0 INTEGER, nb INTEGER)""")
+    # Hash-consing: constructs are visited bottom-up, and constructs with the same (p, o) children are merged
+    s_2_pos = defaultdict(list)
+    for s, p, o in cursor.execute("""SELECT s,p,o FROM tmpquads"""): s_2_pos[s].append((p, o))
     
-    class Insertions(object):
-      def __init__(self, iteration):
-        self.iteration  = iteration
-        self.insertions = []
-        self.merges     = []
-        
-      def extract(self):
-        cursor.execute("""DELETE FROM tmpnorm""")
-        
-        cursor.execute("""INSERT INTO tmpnorm
-WITH sorted_tmpquads(s,p,o) AS (
-SELECT * FROM tmpquads ORDER BY p,o
-),
-     interm(s,def) AS (
-SELECT s, group_concat(p || ' ' || o) FROM sorted_tmpquads GROUP BY s
-)
-SELECT def, group_concat(s), MAX(s), COUNT() FROM interm GROUP BY def
-""")
-
-      def dump1(self):
-        print("\nNORMALIZE STEP %s :" % self.iteration)
-        for po, s, nb in cursor.execute("""SELECT def, s, nb FROM tmpnorm""").fetchall(): print("   ", po, " | ", s, " | ", nb)
-        print()
-        
-      def dump2(self):
-        for s,p,o in cursor.execute("""SELECT s,p,o FROM tmpquads""").fetchall(): print("   ", s, p, o)
-        print()
-        
-      def insert(self):
-        cursor.execute("""DROP INDEX IF EXISTS tmpquads_s""")
-        cursor.execute("""DROP INDEX IF EXISTS tmpquads_o""")
-        cursor.execute("""DELETE FROM tmpquads""")
-        cursor.executemany("INSERT OR IGNORE INTO tmpquads VALUES (?,?,?)", self.insertions)
-        
-        cursor.execute("""CREATE INDEX tmpquads_s ON tmpquads(s)""")
-        cursor.execute("""CREATE INDEX tmpquads_o ON tmpquads(o)""")
-        
-        nb = cursor.rowcount
-        if debug: print("NORMALIZE MERGES", self.merges)
-        for s0, s in self.merges:
-          renames = []
-          removes = []
-          for s2 in s.split(","):
-            s2 = int(s2)
-            if s2 == s0: continue
-            removes.append((s2,))
-            renames.append((s0, s2))
-          cursor.executemany("""DELETE FROM tmpquads WHERE s=?""", removes)
-          cursor.executemany("""UPDATE OR REPLACE tmpquads SET o=? WHERE o=?""", renames)
-          cursor.executemany("""UPDATE OR REPLACE is_a SET o=? WHERE o=?""", renames) # Optimizable
-          cursor.executemany("""UPDATE OR REPLACE is_a SET s=? WHERE s=?""", renames)
-          cursor.executemany("""DELETE FROM types WHERE s=?""", removes)
-        return nb
-      
-    iteration = 1
-    while True:
-      insertions = Insertions(iteration)
-      insertions.extract()
-      if debug: insertions.dump1()
-      
-      if not cursor.execute("""SELECT 1 FROM tmpnorm WHERE nb > 1 LIMIT 1""").fetchone(): break
-      
-      for po, s0 in cursor.execute("""SELECT def, s0 FROM tmpnorm WHERE nb = 1"""):
-        for po1 in po.split(","):
-          insertions.insertions.append((s0, *int_p(po1.split(" "))))
-          
-      for po, s, s0 in cursor.execute("""SELECT def, s, s0 FROM tmpnorm WHERE nb > 1""").fetchall():
-        for po1 in po.split(","):
-          insertions.insertions.append((s0, *int_p(po1.split(" "))))
-        insertions.merges.append((s0, s))
-        
-      insertions.insert()
-      
-      if debug: insertions.dump2()
-      iteration += 1
-      
-      
-    p_2_restriction_i = {
-      ONLY : -1,
-      SOME : -1,
-      VALUE : -1,
-      HAS_SELF : -1,
-      MAX : -2,
-      MIN : -2,
-      EXACTLY : -2,
-      owl_onproperty : 2,
-      owl_onclass : 3,
-      owl_ondatarange : 3,
-    }
-    
-    somes       = []
-    data_values = []
-    onlys       = []
-    maxs        = []
-    mins        = []
-    exactly    = []
-    for po, s0 in self.cursor.execute("""SELECT def, s0 FROM tmpnorm"""):
-      po = [int_p(i.split(" ")) for i in po.split(",")]
-      if po[0][0] in p_2_restriction_i:
-        restriction = [s0, 0, 0, 0]
-        type = None
-        for p, o in po:
-          i = p_2_restriction_i[p]
-          if   i == -1: restriction[3] = o; type = p
-          elif i == -2: restriction[1] = int(o); type = p
-          else:         restriction[i] = int(o)
-        if   type == SOME:    del restriction[1]; somes.append(restriction)
-        elif type == ONLY:    del restriction[1]; onlys.append(restriction)
-        elif type == MAX:     maxs   .append(restriction)
-        elif type == MIN:     mins   .append(restriction)
-        elif type == EXACTLY: exactly.append(restriction)
-        elif type == VALUE:
-          del restriction[1]
-          if self.world._get_by_storid(restriction[1])._owl_type == owl_data_property:
-            data_values.append(restriction + ["XXX"])
-          else:
-            somes.append(restriction)
+    key_2_class = {}
+    s_2_class   = {}
+    for root in s_2_pos:
+      if root in s_2_class: continue
+      visitings = set()
+      stack     = [(root, False)]
+      while stack:
+        s, children_done = stack.pop()
+        if children_done:
+          visitings.discard(s)
+          key = frozenset(Counter((p, ("class", s_2_class[o])) if o in s_2_class else (p, o) for p, o in s_2_pos[s]).items()) # o still being visited (cycle) are kept as is
+          s_2_class[s] = key_2_class.setdefault(key, len(key_2_class))
+        elif not ((s in s_2_class) or (s in visitings)):
+          visitings.add(s)
+          stack.append((s, True))
+          for p, o in s_2_pos[s]:
+            if (o in s_2_pos) and not ((o in s_2_class) or (o in visitings)): stack.append((o, False))
             
-    for table, values in [("some", somes), ("data_value", data_values), ("only", onlys), ("max", maxs), ("min", mins), ("exactly", exactly)]:
-      if values:
-        cursor.executemany("INSERT OR IGNORE INTO %s VALUES (%s)" % (table, ",".join("?" for i in values[0])), values)
-        nb += cursor.rowcount
-        #nbs[self.rule_set.tables[table]] = cursor.rowcount
+    class_2_s0 = {}
+    for s, c in s_2_class.items():
+      if (not c in class_2_s0) or (s > class_2_s0[c]): class_2_s0[c] = s
+    renames = { s : class_2_s0[c] for s, c in s_2_class.items() if s != class_2_s0[c] }
     
-    self.cursor.executescript("""
-CREATE UNIQUE INDEX some_s       ON some(s);
-CREATE UNIQUE INDEX data_value_s ON data_value(s);
-CREATE UNIQUE INDEX only_s       ON only(s);
-CREATE UNIQUE INDEX max_s        ON max(s);
-CREATE UNIQUE INDEX min_s        ON min(s);
-CREATE UNIQUE INDEX exactly_s    ON exactly(s);
-
-CREATE INDEX some_v       ON some      (value, prop);
-CREATE INDEX data_value_v ON data_value(value, prop);
-CREATE INDEX only_v       ON only      (value, prop);
-CREATE INDEX max_v        ON max       (value, prop);
-CREATE INDEX min_v        ON min       (value, prop);
-CREATE INDEX exactly_v    ON exactly   (value, prop);
-""")
-
+    if debug: print("NORMALIZE MERGES", renames)
+    
+    if renames:
+      cursor.execute("""CREATE TEMPORARY TABLE tmpmerge (s INTEGER PRIMARY KEY, s0 INTEGER)""")
+      cursor.executemany("""INSERT INTO tmpmerge VALUES (?,?)""", renames.items())
+      
+      cursor.execute("""DELETE FROM tmpquads WHERE s IN (SELECT s FROM tmpmerge)""")
+      cursor.execute("""UPDATE tmpquads SET o=(SELECT s0 FROM tmpmerge WHERE tmpmerge.s=tmpquads.o) WHERE o IN (SELECT s FROM tmpmerge)""")
+      cursor.execute("""UPDATE OR REPLACE is_a SET o=(SELECT s0 FROM tmpmerge WHERE tmpmerge.s=is_a.o) WHERE o IN (SELECT s FROM tmpmerge)""")
+      cursor.execute("""UPDATE OR REPLACE is_a SET s=(SELECT s0 FROM tmpmerge WHERE tmpmerge.s=is_a.s) WHERE s IN (SELECT s FROM tmpmerge)""")
+      cursor.execute("""DELETE FROM types WHERE s IN (SELECT s FROM tmpmerge)""")
+      cursor.execute("""DROP TABLE tmpmerge""")
+      
+    if debug:
+      print("\nNORMALIZE RESULT :")
+      for s,p,o in cursor.execute("""SELECT s,p,o FROM tmpquads""").fetchall(): print("   ", s, p, o)
+      print()
+      
+    # The storids replaced, kept by the persistent sessions for the assertions imported later, see _apply_construct_renames()
+    self.construct_renames = {}
+    for x in set(single_renames) | set(equiv_renames) | set(renames):
+      x0 = single_renames.get(x, x)
+      x0 = equiv_renames.get(x0, x0)
+      x0 = renames.get(x0, x0)
+      if x0 != x: self.construct_renames[x] = x0
+      
+    restrictions = defaultdict(list)
+    for s0, po in s_2_pos.items():
+      if s0 in renames: continue
+      restriction = self._restriction_row(s0, [(p, renames.get(o, o)) for p, o in po])
+      if restriction: restrictions[restriction[0]].append(restriction[1])
+      
+    bulk = BulkLoad(cursor, self.setup_times)
+    for table in _RESTRICTION_TABLE_NAMES:
+      bulk.add_table(table, ["s"], ["""CREATE UNIQUE INDEX %s_s ON %s(s)""" % (table, table), """CREATE INDEX %s_v ON %s(value, prop)""" % (table, table)])
+      bulk.add_rows(table, restrictions[table])
+      
     flat_list_rels = set()
     for flat_list in flat_lists:
       table_name = flat_list.flat.table.name
       cursor.execute("""CREATE %s TABLE %s(s INTEGER NOT NULL, o INTEGER NOT NULL)""" % (self.temporary, table_name))
-      cursor.execute("""CREATE UNIQUE INDEX %s_so ON %s(s,o)""" % (table_name, table_name))
       
       self.sql_destroy += """DROP TABLE flat_lists_%s;\n""" % flat_list.rel
       
-      cursor.execute("""INSERT OR IGNORE INTO %s SELECT s,o FROM tmpquads WHERE p=?""" % table_name, (flat_list.rel,))
-      nb += cursor.rowcount
-      nbs[flat_list.flat.table] = cursor.rowcount
+      bulk.add_table(table_name, ["s", "o"], ["""CREATE UNIQUE INDEX %s_so ON %s(s,o)""" % (table_name, table_name), """CREATE INDEX %s_os ON %s(o,s)""" % (table_name, table_name)])
+      bulk.add_select(table_name, """SELECT s,o FROM tmpquads WHERE p=?""", (flat_list.rel,))
       
-      cursor.execute("""CREATE INDEX %s_os ON %s(o,s)""" % (table_name, table_name))
-
       flat_list_rels.add(flat_list.rel)
       
+    bulk.finish()
+    nb += sum(bulk.nbs.values())
+    for flat_list in flat_lists: nbs[flat_list.flat.table] = bulk.nbs[flat_list.flat.table.name]
+    
     if self.explain:
-      self.cursor.execute("""INSERT INTO explanations SELECT 'flat_lists_37', s, group_concat(o), 'assertion', '' FROM flat_lists_37 GROUP BY s""")
+      self.provenance.add_select("flat_lists_37", "assertion", """SELECT s, NULL FROM flat_lists_37 GROUP BY s""")
       
-    cursor.execute("""DROP TABLE tmpnorm""")
     cursor.execute("""DROP TABLE tmpquads""")
     
+    if (owl_unionof in flat_list_rels) or (owl_intersectionof in flat_list_rels): self.sql_destroy += """DROP VIEW flat_lists_292;\n"""
+    else:                                                                          self.sql_destroy += """DROP TABLE flat_lists_292;\n"""
     if owl_unionof in flat_list_rels:
       if owl_intersectionof in flat_list_rels:
         cursor.execute("""CREATE %s VIEW flat_lists_292 AS SELECT * FROM flat_lists_30 UNION ALL SELECT * FROM flat_lists_31""" % self.temporary)
@@ -451,107 +834,35 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
       cursor.execute("""CREATE %s TABLE flat_lists_292(s INTEGER, o INTEGER)""" % self.temporary)
       
     # Reset due to insertion / removal
-    self.last_inferences[self.rule_set.tables["is_a"]] = self.cursor.execute("""SELECT MAX(rowid) FROM is_a""").fetchone()[0]
+    self.last_inferences[self.rule_set.tables["is_a"]] = self.cursor.execute("""SELECT MAX(rowid) FROM is_a""").fetchone()[0] or 0
+    self._reset_delta_tables()
     
     return nb, nbs
+  
+  def _restriction_row(self, s0, po): # (table name, row) of the restriction s0 with the given (p, o), or None
+    if not min(p for p, o in po) in _RESTRICTION_PS: return None
+    restriction = [s0, 0, 0, 0]
+    type = None
+    for p, o in po:
+      i = _RESTRICTION_PS[p]
+      if   i == -1: restriction[3] = o; type = p
+      elif i == -2: restriction[1] = int(o); type = p
+      else:         restriction[i] = int(o)
+    if   type == SOME:    del restriction[1]; return "some", restriction
+    elif type == ONLY:    del restriction[1]; return "only", restriction
+    elif type == MAX:     return "max", restriction
+    elif type == MIN:     return "min", restriction
+    elif type == EXACTLY: return "exactly", restriction
+    elif type == VALUE:
+      del restriction[1]
+      if self.world._get_by_storid(restriction[1])._owl_type == owl_data_property: return "data_value", restriction + ["XXX"]
+      return "some", restriction
 
   
   
-  def _get_constructs(self, include_linked = 1):
-    from owlready2.class_construct import _restriction_type_2_label
-
-    cursor = self.cursor
-    class Entity(object):
-      def __init__(self, s, name = None):
-        self.s  = s
-        self.has_superclass = False
-        self.is_new = False
-        self.constructs = []
-        self.name = name
-        
-      def __str__(self):
-        if self.name and not self.constructs: return self.name
-        l = []
-        if self.name: l.append(self.name)
-        for construct in self.constructs: l.append(str(construct))
-        return "%s" % ",".join(l)
-      
-      def check(self):
-        r = cursor.execute("""SELECT 1 FROM objs WHERE s=? LIMIT 1""", (self.s,)).fetchone()
-        if not r: self.is_new = True
-        
-    class Construct(object):
-      def __init__(self, xs):
-        self.xs = xs
-    class AndConstruct(Construct):
-      def __str__(self):
-        #if len(self.xs) >= 2: return "(%s)" % (" and ".join(str(x) for x in self.xs))
-        #return "(%s and)" % ("".join(str(x) for x in self.xs))
-        if len(self.xs) >= 2:
-            return "(%s)" % (" and ".join(repr(x) for x in self.xs))
-        return "(%s and)" % ("".join(repr(x) for x in self.xs))
-    class OrConstruct(Construct):
-      def __str__(self):
-        #if len(self.xs) >= 2: return "(%s)" % (" or ".join(str(x) for x in self.xs))
-        #return "(%s or)" % ("".join(str(x) for x in self.xs))
-          if hasattr(self, '_building_str'):
-              return "(...)"
-          self._building_str = True
-          try:
-              if len(self.xs) >= 2:
-                  return "(%s)" % (" or ".join(str(x) for x in self.xs))
-              return "(%s or)" % ("".join(str(x) for x in self.xs))
-          finally:
-              del self._building_str
-    class DisjointConstruct(Construct):
-      def __str__(self):
-        if len(self.xs) >= 2: return "(%s)" % (" disjoint ".join(str(x) for x in self.xs))
-        return "(%s disjoint)" % ("".join(str(x) for x in self.xs))
-    class NotConstruct(Construct):
-      def __str__(self):
-        return "(not %s)" % (",".join(str(x) for x in self.xs))
-    class RestrictionConstruct(Construct):
-      def __str__(self):
-        #if self.xs[0] in (SOME, ONLY):
-        #  return "(%s %s %s)" % (self.xs[2], _restriction_type_2_label[self.xs[0]], self.xs[3])
-        #else:
-        #  return "(%s %s %s %s)" % (self.xs[2], _restriction_type_2_label[self.xs[0]], self.xs[1], self.xs[3])
-          if hasattr(self, '_building_str'):
-              return "(...)"
-          self._building_str = True
-          try:
-              if self.xs[0] in (SOME, ONLY):
-                  return "(%s %s %s)" % (self.xs[2], _restriction_type_2_label[self.xs[0]], self.xs[3])
-              else:
-                  return "(%s %s %s %s)" % (self.xs[2], _restriction_type_2_label[self.xs[0]], self.xs[1], self.xs[3])
-          finally:
-              del self._building_str
-
-    s_2_entity = {}
-    def get_entity(s):
-      entity = s_2_entity.get(s)
-      if not entity:
-        if s > 0: name = self.world._unabbreviate(s).rsplit("#", 1)[-1]
-        else:     name = None
-        entity = s_2_entity[s] = Entity(s, name)
-      return entity
-    
-    for table, construct_class in [("flat_lists_30", OrConstruct), ("flat_lists_31", AndConstruct), ("flat_lists_37", DisjointConstruct), ("flat_lists_87", NotConstruct)]:
-      for s, os in self.cursor.execute("""SELECT s, group_concat(o) FROM %s GROUP BY s""" % table):
-        entity = get_entity(s)
-        entity.constructs.append(construct_class([get_entity(int(o)) for o in os.split(",")]))
-    
-    for table, p, has_card in [("some", SOME, False), ("only", ONLY, False), ("max", MAX, True), ("min", MIN, True), ("exactly", EXACTLY, True)]:
-      for r in self.cursor.execute("""SELECT * FROM %s""" % table):
-        if has_card: s, card, prop, value = r
-        else:        s,       prop, value = r; card = 0
-        entity = get_entity(s)
-        entity.constructs.append(RestrictionConstruct([p, card, get_entity(prop), get_entity(value)]))
-        
-    for entity in s_2_entity.values():
-      entity.check()
-      
-    return s_2_entity
+  def _get_constructs(self, include_linked = 1): # Cached until the next write, see ConstructCatalog
+    if (self._construct_catalog is None) or self._construct_catalog.is_outdated(): self._construct_catalog = ConstructCatalog(self)
+    return self._construct_catalog
   
   def dump_constructs(self):
     s_2_construct = self._get_constructs()
@@ -600,7 +911,7 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
           rules = []
           rule_2_nb = defaultdict(int)
 
-          for rule, in self.cursor.execute("""SELECT rule FROM explanations WHERE s=? AND o=?""", (orig_row[0], orig_row[1])):
+          for rule in self.provenance.rules(orig_row[0], orig_row[1]):
             if not rule in rule_2_nb: rules.append(rule)
             rule_2_nb[rule] += 1
           l = []
@@ -612,79 +923,122 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
         print("   ", *row)
     print()
   ############  
-  def execute_stage(self, stage):
+  def execute_stage(self, stage, since = None):
+    # If since is given (last_inferences of a previous run), only the rules depending on the rows inferred after are executed
     if self.debug:
       print()
       print("Enter stage '%s':" % stage.name)
     self.current_stage = stage
-    
+    t = time.time()
+    if self.profiler: self.profiler.start_stage(stage)
+
     self._optimize()
+    self._reset_delta_tables()
     
-    self._candidate_completions = set(stage.initial_completions) # Need to define it before running preprocesses, because preprocesses may add candidates!
-    
-    for rule in stage.preprocesses:
+    for rule in stage.completions: # Before creating the scheduler, which sorts on nb_execution
       rule.nb_execution  = 0
       rule.total_time    = 0.0
       rule.total_matches = 0
       rule.total_hits    = 0
-      self.execute_rule(rule)
       
-    if self.debug:
-      print()
+    if since is None: self._candidate_completions = self.scheduler_class(self, stage.initial_completions) # Need to define it before running preprocesses, because preprocesses may add candidates!
+    else:             self._candidate_completions = self.scheduler_class(self)
     
-    for rule in stage.completions:
+    for rule in stage.preprocesses:
       rule.nb_execution  = 0
       rule.total_time    = 0.0
       rule.total_matches = 0
       rule.total_hits    = 0
-      
+      if   since is None:            self.execute_rule(rule)
+      elif isinstance(rule, Builtin): rule.restore(self, self.cursor)
+      elif self._from_grown_constructs(rule): self.execute_rule(rule)
+      elif set(rule.delta_tables) & self._tables_changed_since(since):
+        rule.last_inferences.update(since)
+        self.execute_rule(rule)
+        
+    if not since is None:
+      changeds = self._tables_changed_since(since)
+      for create, rules in stage.depend_2_completions.items():
+        if set(self.rule_set.create_2_tables.get(create) or [self.rule_set.tables["inferred_objs"]]) & changeds:
+          for rule in rules:
+            rule.last_inferences.update(since)
+            self._candidate_completions.add(rule)
+      for rule in stage.completions:
+        if self._from_grown_constructs(rule):
+          rule.last_inferences.clear()
+          self._candidate_completions.add(rule)
+            
+    if self.debug:
+      print()
+    
     while self._candidate_completions:
-      l = list(self._candidate_completions)
-      l.sort(key = lambda rule: (rule.priority, rule.nb_execution, rule.complexity, rule.name))
-      rule = l[0]
-      self._candidate_completions.remove(rule)
+      rule = self._candidate_completions.pop()
       self.execute_rule(rule)
-      
+
+    self.stage_times[stage.name] = time.time() - t
+    if self.profiler: self.profiler.end_stage(stage)
     if self.debug:
       print()
   ############
 
-  def run(self, x = None, debug = 1):
-    locked = self.world.graph.has_write_lock()
-    if locked: self.world.graph.release_write_lock() # Not needed during reasoning
+  def _init_last_inferences(self):
+    self.last_inferences = {}
+    for table in self.rule_set.tables.values():
+      if not self.rule_set.table_2_inferrable.get(table, None): continue
+      try: nb = self.cursor.execute("""SELECT MAX(rowid) FROM %s""" % table.name).fetchone()[0] or 0
+      except sqlite3.OperationalError: nb = 0
+      self.last_inferences[table] = nb
+      self.optimize_limits[table] = nb + 1
+    if self.debug: self.check_last_inferences()
+    
+  def reason(self, extract = True): # Compute new_parents, new_equivs and entity_2_type, without applying them; returns True if incremental
+    self.cursor = self.db.cursor()
+    if self.work_store:
+      if not self.work_store.db:
+        self.world.graph.commit() # The pragmas of the work store cannot be changed within a transaction
+        self.work_store.attach(self.db)
+      self.cursor = self.work_store.wrap_cursor(self.cursor)
+    if self.profiler:
+      self.profiler.attach(self)
+      self.cursor = self.profiler.wrap_cursor(self.cursor)
     try:
-      self.cursor = self.db.cursor()
-      self.prepare()
-  
-      
-      self.last_inferences = {}
-      for table in self.rule_set.tables.values():
-        if not self.rule_set.table_2_inferrable.get(table, None): continue
-        try: nb = self.cursor.execute("""SELECT MAX(rowid) FROM %s""" % table.name).fetchone()[0] or 0
-        except sqlite3.OperationalError: nb = 0
-        self.last_inferences[table] = nb
-        self.optimize_limits[table] = nb + 1
-      if self.debug: self.check_last_inferences()
-      
-      self.max_restriction_depth = 1
-      self.max_restriction_depth_last_update = 0
-      
-      for stage in self.rule_set.stages:
-        if stage is self.rule_set.stages[-1]: self._optimize()
-        self.execute_stage(stage)
+      incremental = self.persistent and self._run_session_incrementally()
+      if not incremental:
+        self.prepare()
         
-      t = time.time()
-      self.new_parents, self.new_equivs, self.entity_2_type = self.extract_inferences()
-      self.extract_result_time = time.time() - t
+        self._init_last_inferences()
+        
+        self.max_restriction_depth = 1
+        self.max_restriction_depth_last_update = 0
+        
+        for stage in self.rule_set.stages:
+          if stage is self.rule_set.stages[-1]: self._optimize()
+          self.execute_stage(stage)
+    finally:
+      if self.profiler: self.profiler.detach()
       
+    self.extract_result_time = 0
+    if extract: self.new_parents, self.new_equivs, self.entity_2_type = self.extract_inferences()
+    return incremental
+  
+  def run(self, x = None, debug = 1, chunk_size = 10000, sink = None): # sink defaults to applying the results to the world (and x, the ontology)
+    locked = self.world.graph.has_write_lock()
+    if locked: self.world.graph.release_write_lock() # Not needed during reasoning
+    try:
+      incremental = self.reason(extract = False)
     finally:
       if locked: self.world.graph.acquire_write_lock() # re-lock when applying results
       
-    if   isinstance(x, Ontology):  ontology = x
-    if CURRENT_NAMESPACES.get():   ontology = CURRENT_NAMESPACES.get()[-1].ontology
-    else:                          ontology = self.world.get_ontology(_INFERRENCES_ONTOLOGY)
+    if sink is None: sink = WorldSink(x, debug)
+    sink.open(self)
+    for new_parents, new_equivs, entity_2_type in self.iter_inferences(chunk_size): # The results are not kept in memory
+      sink.write(new_parents, new_equivs, entity_2_type)
+    sink.close()
+    if isinstance(sink, WorldSink) and sink.keep_results: self.new_parents, self.new_equivs, self.entity_2_type = sink.new_parents, sink.new_equivs, sink.entity_2_type
     
-    _apply_reasoning_results(self.world, ontology, debug, self.new_parents, self.new_equivs, self.entity_2_type)
+    if self.persistent:
+      self._drop_delta_tables() # Delta tables are specific to this model, whereas the inferred tables are kept
+      self._save_session(incremental) # After applying the results, which modify the quads
     
  
     
@@ -731,10 +1085,13 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
       print("Execute rule %s..." % rule, end = "", flush = True)
       
     current_matches = rule.total_matches
+    if self.profiler: self.profiler.start_rule(rule)
     
     rule.nb_execution += 1
     t0 = time.time()
     
+    self._sync_is_a_index()
+    
     if rule.recursive:
       nb_new_triples = old_n = 0
       first = True
@@ -770,6 +1127,7 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
     t = time.time() - t0
     rule.total_time += t
     rule.total_hits += nb_new_triples
+    if self.profiler: self.profiler.end_rule(rule, nb_new_triples)
     
     if self.debug:
       if nb_new_triples: 
@@ -779,12 +1137,13 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
       self.check_last_inferences()
       
   def compute_completion_candidates(self, rule, nb_new_triples, added_nb_inferences):
+    others = []
     for create in rule.creates:
       for other in self.current_stage.depend_2_completions[create]:
         if not other in self._candidate_completions:
-          self._candidate_completions.add(other)
           other.last_inferences.update(self.last_inferences)
-            
+        others.append(other)
+        
     if added_nb_inferences:
       for table, nb in added_nb_inferences.items():
         if table in self.last_inferences:
@@ -796,7 +1155,10 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
       if rule.table in self.last_inferences:
         self.last_inferences[rule.table] += nb_new_triples
         self._check_optimize_table(rule.table, self.last_inferences[rule.table])
-          
+        
+    # After the counts are updated, so as the keys take the new rows into account (already waiting rules may be promoted)
+    for other in others: self._candidate_completions.add(other)
+    
     
   def _trigger_create(self, create):
     for rule in self.current_stage.depend_2_completions[create]:
@@ -818,10 +1180,11 @@ CREATE INDEX exactly_v    ON exactly   (value, prop);
 
     
 
-  def extract_inferences(self):
+  def _prepare_extraction(self):
     # Infer equivalence from double inheritance
+    self.cursor.execute("""DROP TABLE IF EXISTS equiv""") # Left by a previous run of a persistent session
     self.cursor.execute("""CREATE TABLE equiv (s INTEGER NOT NULL, o INTEGER NOT NULL)""")
-    self.sql_destroy += """DROP TABLE equiv;"""
+    if not "DROP TABLE equiv;" in self.sql_destroy: self.sql_destroy += """DROP TABLE equiv;\n"""
 
     self.cursor.execute("""
 INSERT OR IGNORE INTO equiv
@@ -829,40 +1192,92 @@ SELECT DISTINCT q1.s, q2.s
 FROM is_a q1, is_a q2
 WHERE q1.s=q2.o AND q2.s=q1.o AND q1.s!=q2.s AND q1.s>0 AND q2.s>0
 """)
-
+    if self.is_a_labels: # Cycles of direct is_a; the entities of a cycle are reached by the same entities
+      intervals_2_ss = defaultdict(list)
+      for s, intervals in self.is_a_labels.node_2_intervals.items():
+        if s > 0: intervals_2_ss[tuple(intervals)].append(s)
+      self.cursor.executemany("""INSERT OR IGNORE INTO equiv VALUES (?,?)""", ((s1, s2) for ss in intervals_2_ss.values() if len(ss) > 1 for s1 in ss for s2 in ss if s1 != s2))
+      self.is_a_labels.store(self.cursor, "is_a", self.temporary)
+      if not "DROP VIEW is_a_closure;" in self.sql_destroy: self.sql_destroy += """DROP VIEW is_a_closure;\nDROP TABLE is_a_labels;\nDROP TABLE is_a_intervals;\n"""
+      
+    # New parents: the inferred is_a, except the trivial ones (asserted, asserted then is_a, or equivalent),
+    # with the type of the entity. Computed in SQL, and then read by chunks of entities.
+    self.cursor.execute("""DROP TABLE IF EXISTS extracted""")
+    self.cursor.execute("""CREATE %s TABLE extracted (s INTEGER NOT NULL, o INTEGER NOT NULL, type INTEGER)""" % self.temporary)
+    if not "DROP TABLE extracted;" in self.sql_destroy: self.sql_destroy += """DROP TABLE extracted;\n"""
+    if self.is_a_labels: closure = "is_a_closure" # The implied is_a are not all in is_a
+    else:                closure = "is_a"
+    self.cursor.execute("""
+INSERT INTO extracted
+SELECT q.s, q.o, (SELECT t.o FROM types t WHERE t.s=q.s LIMIT 1)
+FROM %s q
+WHERE q.s > 0 AND q.o > 0 AND q.s != q.o AND q.s != ?
+AND NOT EXISTS (SELECT 1 FROM is_a q1, %s q2 WHERE q1.s=q.s AND q1.l=1 AND q1.o!=q.s AND q1.o > 0 AND q2.s=q1.o AND q2.o!=q1.o AND q2.o=q.o)
+AND NOT EXISTS (SELECT 1 FROM objs WHERE objs.s=q.s AND objs.p IN (?,?) AND objs.o=q.o)
+AND NOT EXISTS (SELECT 1 FROM equiv WHERE equiv.s=q.s AND equiv.o=q.o)
+""" % (closure, closure), (owl_nothing, rdfs_subclassof, rdf_type))
+    self.cursor.execute("""CREATE INDEX extracted_s ON extracted(s)""")
+    
+  def iter_inferences(self, chunk_size = 10000):
+    # Yields (new_parents, new_equivs, entity_2_type) by chunks of at most chunk_size entities, the equivalences
+    # first, so as _apply_reasoning_results can be called on each chunk
+    t = time.time()
+    self._prepare_extraction()
+    self.nb_new_is_a = self.nb_new_equiv = 0
+    o_2_type = { owl_class : "class", owl_object_property : "property", owl_data_property : "property", owl_named_individual : "individual" }
+    type_of  = lambda t: o_2_type[t or owl_class]
     
-    new_parents   = defaultdict(list)
     new_equivs    = defaultdict(list)
     entity_2_type = {}
-    for s, o in self.cursor.execute("""
-WITH trivial(s,o) AS (
-SELECT q1.s,q2.o
-FROM is_a q1, is_a q2
-WHERE q1.l=1 AND q2.s=q1.o AND q1.s > 0 AND q2.s > 0 AND q2.o > 0 AND q1.s != q1.o AND q2.s != q2.o
-UNION ALL
-SELECT s,o FROM objs WHERE p IN (?,?)
-UNION ALL
-SELECT * FROM equiv
-)
-SELECT s,o
-FROM is_a
-WHERE s > 0 AND o > 0 AND s != o AND s != ?
-EXCEPT
-SELECT * FROM trivial
-""", (rdfs_subclassof, rdf_type, owl_nothing)):
-      new_parents[s].append(o)
-      
-    for s, o in self.cursor.execute("""SELECT s,o FROM equiv WHERE s < o"""):
+    for s, o, s_type, o_type in self.cursor.execute("""
+SELECT s, o, (SELECT t.o FROM types t WHERE t.s=equiv.s LIMIT 1), (SELECT t.o FROM types t WHERE t.s=equiv.o LIMIT 1)
+FROM equiv WHERE s < o""").fetchall():
       new_equivs[s].append(o)
       new_equivs[o].append(s)
+      entity_2_type[s] = type_of(s_type)
+      entity_2_type[o] = type_of(o_type)
+      if len(entity_2_type) >= chunk_size:
+        self.nb_new_equiv += len(new_equivs)
+        self.extract_result_time += time.time() - t
+        yield {}, new_equivs, entity_2_type
+        t = time.time()
+        new_equivs    = defaultdict(list)
+        entity_2_type = {}
+    self.nb_new_equiv += len(new_equivs)
+    
+    last_s = None
+    while True:
+      rows = self.cursor.execute("""
+SELECT s, o, type FROM extracted
+WHERE s > ? AND s <= (SELECT MAX(s) FROM (SELECT DISTINCT s FROM extracted WHERE s > ? ORDER BY s LIMIT ?))
+ORDER BY s""", (last_s or 0, last_s or 0, chunk_size)).fetchall()
+      if not rows: break
+      new_parents = defaultdict(list)
+      for s, o, s_type in rows:
+        new_parents[s].append(o)
+        entity_2_type[s] = type_of(s_type)
+      last_s = rows[-1][0]
+      self.nb_new_is_a += len(new_parents)
+      self.extract_result_time += time.time() - t
+      yield new_parents, new_equivs, entity_2_type
+      t = time.time()
+      new_equivs    = defaultdict(list)
+      entity_2_type = {}
       
+    if new_equivs: # No new parent
+      self.extract_result_time += time.time() - t
+      yield {}, new_equivs, entity_2_type
+    else:
+      self.extract_result_time += time.time() - t
       
-    o_2_type = { owl_class : "class", owl_object_property : "property", owl_data_property : "property", owl_named_individual : "individual" }
-    entities = set(new_parents)
-    entities.update(new_equivs)
-    for s in entities:
-      entity_2_type[s] = o_2_type[(self.cursor.execute("""SELECT o FROM types WHERE s=? LIMIT 1""", (s,)).fetchone() or (owl_class,))[0]]
-      
+  def extract_inferences(self):
+    new_parents   = defaultdict(list)
+    new_equivs    = defaultdict(list)
+    entity_2_type = {}
+    for chunk_new_parents, chunk_new_equivs, chunk_entity_2_type in self.iter_inferences():
+      new_parents  .update(chunk_new_parents)
+      for s, os in chunk_new_equivs.items(): new_equivs[s].extend(os)
+      entity_2_type.update(chunk_entity_2_type)
     return new_parents, new_equivs, entity_2_type
   
   
@@ -885,13 +1300,43 @@ SELECT * FROM trivial
                 (start, rule.name, rule.total_time, search_time, nb_execution, matches, rule.total_hits), file = sys.stderr)
         print()
         
+    if self.setup_times:
+      print("Setup:", file = sys.stderr)
+      for table, t in sorted(self.setup_times.items(), key = lambda table_t: -table_t[1]):
+        print("  %s: %0.4fs" % (table, t), file = sys.stderr)
+      print()
+      
     print("Extraction des resultats: %0.4fs" % self.extract_result_time, file = sys.stderr)
-    print("  New is-a ", len(dict(self.new_parents or {})), file = sys.stderr)
-    print("  New equiv", len(dict(self.new_equivs or {})), file = sys.stderr)
+    print("  New is-a ", self.nb_new_is_a,  file = sys.stderr)
+    print("  New equiv", self.nb_new_equiv, file = sys.stderr)
       
     print("Extra:")
     print("  max_restriction_depth = %s" % self.max_restriction_depth)
     if self._extra_dumps:
       for k,v in self._extra_dumps.items():
         print("  %s = %s" % (k, v))
+        
+  def rule_usage(self): # Same data as print_rule_usage(), as a JSON-compatible dict
+    stages = {}
+    for stage in self.rule_set.stages:
+      rules = {}
+      for rule_type, stage_rules in [("preprocess", stage.preprocesses), ("completion", stage.completions)]:
+        for rule in stage_rules:
+          rules[rule.name] = {
+            "type"       : rule_type,
+            "time"       : getattr(rule, "total_time",    0.0),
+            "executions" : getattr(rule, "nb_execution",  0),
+            "matches"    : getattr(rule, "total_matches", 0),
+            "hits"       : getattr(rule, "total_hits",    0),
+          }
+      stages[stage.name] = { "time" : self.stage_times.get(stage.name, 0.0), "rules" : rules }
+    return {
+      "stages"                : stages,
+      "setup_times"           : dict(self.setup_times),
+      "extract_result_time"   : self.extract_result_time,
+      "new_is_a"              : self.nb_new_is_a,
+      "new_equiv"             : self.nb_new_equiv,
+      "max_restriction_depth" : getattr(self, "max_restriction_depth", 0),
+      "extra"                 : dict(self._extra_dumps),
+    }
          
@@ -22,9 +22,14 @@
 #  python ./semantic2sql/regtest2.py Exp.test_xxx1 --keep --debug
 
 from owlready2 import *
-import sys, os, unittest, tempfile, atexit, types
+import sys, os, io, unittest, tempfile, atexit, types, sqlite3, pickle
 
 from semantic2sql.reasoned_model import *
+import semantic2sql.rule
+from semantic2sql.parallel import *
+import semantic2sql.benchmark
+import semantic2sql.closure
+import semantic2sql.blank_allocator
 
 if "--keep" in sys.argv:
   sys.argv.remove("--keep")
@@ -119,6 +124,32 @@ class BaseTest(unittest.TestCase):
       onto_inference.graph.dump()
     return rm
   
+  def assert_same_inferences(self, create, get_results = None, **variants):
+    # Reasons on a new world for each variant, and checks that they all give the same results.
+    # A variant is either a dict of ReasonedModel arguments, the world being filled by create(world),
+    # or a function(world) that fills the world and returns the reasoned model.
+    # get_results(rm) defaults to the is_a pairs. Returns { variant name : reasoned model }
+    if get_results is None: get_results = lambda rm: set(rm.cursor.execute("SELECT s,o FROM is_a").fetchall())
+    models  = {}
+    results = {}
+    for name, variant in variants.items():
+      world = World()
+      if callable(variant): rm = variant(world)
+      else:
+        create(world)
+        rm = ReasonedModel(world, **{ "rule_set" : RULES_FILE, **variant })
+        rm.reason()
+      models [name] = rm
+      results[name] = get_results(rm)
+      
+    first, *others = variants
+    for name in others: assert results[name] == results[first], "'%s' and '%s' differ" % (first, name)
+    return models
+  
+  def get_inferences(self, rm): # new_parents and new_equivs, as IRI pairs
+    unabbreviate = rm.world._unabbreviate
+    return [{ (unabbreviate(s), unabbreviate(o)) for s, os in d.items() for o in os } for d in [rm.new_parents, rm.new_equivs]]
+  
   def assert_is_a(self, s, o):
     r = self.rm.cursor.execute("SELECT 1 FROM is_a WHERE s=? AND o=?""", (s, o)).fetchone()
     assert not r is None
@@ -1990,7 +2021,28 @@ class Test(BaseTest):
     assert rm._restriction_depth(C.is_a[-1].storid) == 2
     assert rm._restriction_depth(D.is_a[-1].storid) == 1
     assert rm._restriction_depth(E.is_a[-1].storid) == 3
-    
+
+  def test_depth_2(self):
+    depths = semantic2sql.closure.RestrictionDepths()
+    depths.add_rows([(-1, 10), (-2, -1), (-3, -2)])
+    assert depths.depth(-3) == 3
+    assert depths.depth(10) == 0
+    assert depths.max_depth() == 3
+
+    depths.add_rows([(-4, -3)])
+    assert depths.depth(-4) == 4
+    assert depths.max == 4
+
+    depths.add_rows([(-1, -5), (-5, -6)]) # Second value for -1, and restriction on a new node
+    assert depths.depth(-4) == 5
+    assert depths.max_depth() == 5
+
+    depths.add_rows([(-6, -2)]) # Cycle
+    assert depths.depth(-4) == 6
+    assert depths.depth(-6) == 4
+    assert depths.depth(-2) == 4
+    assert depths.max_depth() == 6
+
 
 
 
@@ -2185,9 +2237,853 @@ class Test(BaseTest):
       A_3()
       
     rm = self.sync_reasoner()
+    
+  def test_semi_naive_1(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class A(Thing): pass
+        class A1(A): pass
+        class A2(A1): pass
+        class B(Thing): pass
+        class C(Thing): is_a = [p.some(A2)]
+        class D(Thing): is_a = [p.some(A1 | B)]
+        class R(Thing): equivalent_to = [p.some(A)]
+
+    self.assert_same_inferences(create, naive = { "semi_naive" : False }, semi_naive = { "semi_naive" : True })
+
+  def test_semi_naive_2(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class A(Thing): pass
+        class A1(A): pass
+        class A2(A1): pass
+        class A3(A2): pass
+        class B(Thing): pass
+        class C(Thing): is_a = [p.some(A3)]
+        class D(Thing): is_a = [p.some(A2 | B)]
+        class R(Thing): equivalent_to = [p.some(A)]
+        class S(Thing): equivalent_to = [p.some(A1) & p.some(A)]
+
+    models = self.assert_same_inferences(create,
+      naive       = { "semi_naive" : False },
+      round_robin = { "semi_naive" : True, "scheduler" : "round_robin" },
+      delta       = { "semi_naive" : True, "scheduler" : "delta" },
+    )
+    for rm in models.values():
+      for table, (low, high, rules) in rm._delta_ranges.items(): # The delta only keeps the rows not yet read by all the rules
+        if not rules: continue
+        assert low <= min(rule.last_inferences[table] for rule in rules)
+        assert rm.cursor.execute("SELECT COUNT() FROM delta_%s" % table.name).fetchone()[0] == high - low
+
+  def test_trace_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): pass
+      class X(Thing): is_a = [A | B]
+      class D(Thing): is_a = [p.some(X)]
+      
+    descriptions = []
+    rm = ReasonedModel(self.onto.world, rule_set = RULES_FILE, trace = descriptions.append)
+    rm.run()
+    
+    descriptions2 = [description for table, s, description in rm.trace]
+    assert ("((p some A) or (p some B))" in descriptions2) or ("((p some B) or (p some A))" in descriptions2)
+    assert len(descriptions) == len(rm.trace.buffer)
+    assert descriptions == ["%s : %s" % (s, description) for table, s, description in rm.trace] # The catalog is updated incrementally
+    assert isinstance(rm.trace.catalog, ConstructCatalog)
+    
+  def test_is_a_index_1(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class A(Thing): pass
+        class A1(A): pass
+        class B(Thing): pass
+        class X(Thing): is_a = [A1 | B | A]
+        class D(Thing): is_a = [p.some(X)]
+        class E(Thing): equivalent_to = [A & A1]
+        
+    rm = self.assert_same_inferences(create, no_index = { "is_a_index" : False }, index = { "is_a_index" : True })["index"]
+    
+    is_a = set(rm.cursor.execute("SELECT s,o FROM is_a").fetchall())
+    rm._sync_is_a_index()
+    for s, o in is_a: assert rm._has_is_a(s, o)
+    assert { (s, o) for s, os in rm.is_a_index.items() for o in os } == is_a
+    
+  def test_normalize_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class q(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): pass
+      class C(Thing): pass
+      class D(Thing): is_a = [p.some(q.some(A | B) & C)]
+      class E(Thing): is_a = [p.some(C & q.some(B | A))]
+      
+    rm = ReasonedModel(self.onto.world, rule_set = RULES_FILE)
+    rm.run()
+    
+    assert len(rm.cursor.execute("SELECT * FROM some WHERE prop=?", (p.storid,)).fetchall()) == 1
+    assert len(rm.cursor.execute("SELECT * FROM some WHERE prop=? AND value<0", (q.storid,)).fetchall()) == 1
+    assert len(rm.cursor.execute("SELECT DISTINCT s FROM flat_lists_31").fetchall()) == 1
+    
+  def test_scheduler_1(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class A(Thing): pass
+        class A1(A): pass
+        class A2(A1): pass
+        class B(Thing): pass
+        class C(Thing): is_a = [p.some(A2)]
+        class D(Thing): is_a = [p.some(A1 | B)]
+        class R(Thing): equivalent_to = [p.some(A)]
+        
+    self.assert_same_inferences(create, priority = { "scheduler" : "priority" }, round_robin = { "scheduler" : "round_robin" }, delta = { "scheduler" : "delta" })
+
+  def test_scheduler_2(self):
+    class FakeTable(object): pass
+    class FakeRule(object):
+      def __init__(self, name, table):
+        self.name            = name
+        self.priority        = 1
+        self.nb_execution    = 0
+        self.complexity      = 1
+        self.delta_tables    = [table]
+        self.last_inferences = { table : 0 }
+    class FakeModel(object): pass
+
+    t1 = FakeTable()
+    t2 = FakeTable()
+    model = FakeModel()
+    model.last_inferences = { t1 : 5, t2 : 3 }
+    r1 = FakeRule("r1", t1)
+    r2 = FakeRule("r2", t2)
+
+    scheduler = DeltaScheduler(model, [r1, r2])
+    model.last_inferences[t2] = 10 # The delta of r2 grew while it was waiting
+    scheduler.add(r2)
+    assert len(scheduler) == 2
+    assert scheduler.pop() is r2
+    assert scheduler.pop() is r1
+    assert len(scheduler) == 0
+
+    scheduler = Scheduler(model, [r1, r2]) # Default key is the priority
+    r2.priority = 0
+    scheduler.add(r2)
+    assert scheduler.pop() is r2
+
+  def test_rule_set_cache_1(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class A(Thing): pass
+        class A1(A): pass
+        class C(Thing): is_a = [p.some(A1)]
+        class R(Thing): equivalent_to = [p.some(A)]
+        
+    with open(os.path.join(os.path.dirname(semantic2sql.rule.__file__), RULES_FILE)) as f: rules_txt = f.read()
+    rule_set = semantic2sql.rule.RuleSet() # Cached as loaded, before any run
+    rule_set.load(rules_txt)
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache_file = os.path.join(cache_dir, "rules.pickle")
+      semantic2sql.rule._save_cached_rule_set(cache_file, { "http://www.w3.org/2002/07/owl#intersectionOf" : owl_intersectionof }, rule_set)
+      cached_rule_set = semantic2sql.rule._load_cached_rule_set(cache_file)
+      assert isinstance(cached_rule_set, semantic2sql.rule.RuleSet)
+      
+      with open(cache_file, "rb") as f: module_digests, abbreviated_iris = pickle.load(f)
+      assert set(module_digests) == { "semantic2sql.rule", "semantic2sql.rule_parser", "semantic2sql.pattern" } # Compiler, and modules of the pickled instances
+      
+      pickler = semantic2sql.rule._ModuleRecordingPickler(io.BytesIO())
+      pickler.dump([rule_set, semantic2sql.closure.TransitiveClosure()])
+      assert pickler.modules == { "semantic2sql.rule", "semantic2sql.pattern", "semantic2sql.closure" }
+      
+      module_digest = semantic2sql.rule._module_digest
+      semantic2sql.rule._module_digest = lambda module_name: "modified" if module_name == "semantic2sql.pattern" else module_digest(module_name)
+      try:     assert semantic2sql.rule._load_cached_rule_set(cache_file) is None # pattern.py was modified
+      finally: semantic2sql.rule._module_digest = module_digest
+      
+      semantic2sql.rule._save_cached_rule_set(cache_file, { "http://www.w3.org/2002/07/owl#intersectionOf" : owl_unionof }, rule_set)
+      assert semantic2sql.rule._load_cached_rule_set(cache_file) is None
+      
+    cache_dir = os.environ.pop("SEMANTIC2SQL_CACHE_DIR", None)
+    try:     assert semantic2sql.rule.get_rule_set_cache_dir() is None # Opt-in
+    finally:
+      if not cache_dir is None: os.environ["SEMANTIC2SQL_CACHE_DIR"] = cache_dir
+      
+    self.assert_same_inferences(create, rules_file = { "rule_set" : RULES_FILE }, cached = { "rule_set" : cached_rule_set })
+    
+  def test_persistent_1(self):
+    def create(world, added):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class A(Thing): pass
+        class A1(A): pass
+        class B(Thing): pass
+        class C(Thing): is_a = [p.some(A1)]
+        class S(Thing): equivalent_to = [p.some(B)]
+        if added: add(onto)
+      return onto
+    def add(onto):
+      with onto:
+        onto.A1.is_a.append(onto.B)
+        class Y(onto.A1): pass
+    def get_is_a(rm):
+      unabbreviate = rm.world._unabbreviate
+      return { (unabbreviate(s), unabbreviate(o)) for (s, o) in rm.cursor.execute("SELECT s,o FROM is_a WHERE s>0 AND o>0") }
+    
+    def incremental(change): # Updates the session of world after change(), rather than reasoning on a new world
+      def reason(new_world):
+        change()
+        rm = ReasonedModel(world, rule_set = RULES_FILE, persistent = True)
+        rm.cursor = rm.db.cursor()
+        assert rm._run_session_incrementally()
+        return rm
+      return reason
+    def create_removed(world):
+      onto = create(world, True)
+      onto.A1.is_a.remove(onto.A)
+      
+    world = World()
+    onto = create(world, False)
+    ReasonedModel(world, rule_set = RULES_FILE, persistent = True).run()
+    rm = self.assert_same_inferences(lambda world2: create(world2, True), get_is_a, incremental = incremental(lambda: add(onto)), scratch = {})["incremental"]
+    rm._drop_delta_tables()
+    rm._save_session(True) # As done by run()
+    
+    rm = self.assert_same_inferences(create_removed, get_is_a, incremental = incremental(lambda: onto.A1.is_a.remove(onto.A)), scratch = {})["incremental"]
+    rm._drop_delta_tables()
+    
+    with onto:
+      class Y2(onto.Y): pass
+    ReasonedModel(world, rule_set = RULES_FILE, persistent = True).run() # Incremental; the quads written by the sink are in the snapshot
+    rm = ReasonedModel(world, rule_set = RULES_FILE, persistent = True)
+    rm.cursor = rm.db.cursor()
+    assert rm._run_session_incrementally()
+    assert rm.cursor.execute("SELECT COUNT() FROM s2s_added").fetchone()[0] == 0
+    rm._drop_delta_tables()
+    
+  def test_persistent_2(self):
+    def create(world, changes):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class Z(Thing): pass
+        class A(Z): pass
+        class A1(A): pass
+        class A2(A1): pass
+        class A3(A1, A): pass # A3 is_a A is also asserted
+        class B(Thing): pass
+        class C(Thing): is_a = [p.some(A2)]
+        class S(Thing): equivalent_to = [p.some(Z)]
+        class D(Thing): pass
+        class E(Thing): pass
+        a = A2("a")
+      for change in changes: change(onto)
+      return onto
+    def remove_a1_a(onto): onto.A1.is_a.remove(onto.A)
+    def add_some(onto):
+      with onto: onto.D.is_a.append(onto.p.some(onto.A1))
+    def add_equiv(onto):
+      with onto: onto.E.equivalent_to.append(onto.p.some(onto.B))
+    def get_is_a(rm):
+      unabbreviate = rm.world._unabbreviate
+      return { (unabbreviate(s), unabbreviate(o)) for (s, o) in rm.cursor.execute("SELECT s,o FROM is_a WHERE s>0 AND o>0") }
+    
+    rule_set = semantic2sql.rule.RuleSet()
+    with open(os.path.join(os.path.dirname(semantic2sql.rule.__file__), RULES_FILE)) as f:
+      rule_set.load(f.read() + """\nCOMPLETION HIGH_PRIORITY RECURSIVE "is_a_transitivity"\nIF    { ?A is_a ?B\n        ?B is_a ?C }\nINFER { ?A is_a(2) ?C }\n""")
+      
+    def incremental(changes):
+      def reason(world):
+        onto = create(world, [])
+        ReasonedModel(world, rule_set = rule_set, persistent = True).run(sink = CallbackSink())
+        for change in changes: change(onto)
+        rm = ReasonedModel(world, rule_set = rule_set, persistent = True)
+        rm.cursor = rm.db.cursor()
+        assert rm._run_session_incrementally()
+        return rm
+      return reason
+    
+    for changes in [[remove_a1_a], [add_some], [add_equiv], [remove_a1_a, add_some, add_equiv]]:
+      rm = self.assert_same_inferences(lambda world: create(world, changes), get_is_a, incremental = incremental(changes), scratch = { "rule_set" : rule_set })["incremental"]
+      is_a = get_is_a(rm)
+      
+      if remove_a1_a in changes: # Over-deleted, then re-derived only where another derivation remains
+        assert not ("http://test.org/onto.owl#A2", "http://test.org/onto.owl#Z") in is_a
+        assert not ("http://test.org/onto.owl#a",  "http://test.org/onto.owl#A") in is_a
+        assert not ("http://test.org/onto.owl#C",  "http://test.org/onto.owl#S") in is_a
+        assert     ("http://test.org/onto.owl#A3", "http://test.org/onto.owl#Z") in is_a
+      else:
+        assert     ("http://test.org/onto.owl#C",  "http://test.org/onto.owl#S") in is_a
+      if add_some in changes:
+        assert     ("http://test.org/onto.owl#D",  "http://test.org/onto.owl#S") in is_a or (remove_a1_a in changes)
+        
+  def test_parallel_1(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        for i in range(3):
+          A  = types.new_class("A%s"  % i, (Thing,))
+          A1 = types.new_class("A1_%s" % i, (A,))
+          A2 = types.new_class("A2_%s" % i, (A1,))
+          R  = types.new_class("R%s"  % i, (Thing,)); R.equivalent_to = [A1]
+          B  = types.new_class("B%s"  % i, (Thing,)); B.is_a.append(p.some(A))
+          S  = types.new_class("S%s"  % i, (Thing,)); S.equivalent_to = [p.some(A)]
+      return onto
+    def parallel(world):
+      onto = create(world)
+      rm = ParallelReasonedModel(world, rule_set = RULES_FILE, processes = 2)
+      with onto: rm.run()
+      assert issubclass(onto.B0, onto.S0)
+      return rm
+      
+    world = World()
+    create(world)
+    assert len(partition(world)) == 3
+    rm = self.assert_same_inferences(create, self.get_inferences, sequential = {}, parallel = parallel)["parallel"]
+    assert rm.nb_rounds == 1
+    
+  def test_parallel_2(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class q(ObjectProperty): pass
+        class D(Thing): pass
+        q.domain = [D]
+        classes = [types.new_class("C0", (Thing,))]
+        for i in range(1, 40): classes.append(types.new_class("C%s" % i, (classes[(i - 1) // 3],))) # A single component
+        class S(Thing): equivalent_to = [p.some(classes[1])]
+        classes[30].is_a.append(p.some(classes[20])) # Across subtrees
+        classes[35].is_a.append(q.some(classes[5]))
+        AllDisjoint([classes[1], classes[2]])
+        class N(Thing): is_a = [Not(classes[3])]
+      return onto
+    def parallel(blank_range_size):
+      def reason(world):
+        create(world)
+        current_blank = world.graph.execute("""SELECT current_blank FROM store""").fetchone()[0]
+        rm = ParallelReasonedModel(world, rule_set = rules_file.name, processes = 4, blank_range_size = blank_range_size)
+        rm.reason()
+        if blank_range_size is None:
+          assert rm.nb_rounds == 1
+          assert world.graph.execute("""SELECT current_blank FROM store""").fetchone()[0] - current_blank < 4 * 1024 # The unused ids are given back
+        else:
+          assert rm.nb_rounds > 1 # Retried with more blank nodes
+        return rm
+      return reason
+    
+    rules_file = tempfile.NamedTemporaryFile("w", suffix = ".txt", delete = False)
+    with open(os.path.join(os.path.dirname(semantic2sql.rule.__file__), RULES_FILE)) as f:
+      rules_file.write(f.read() + """\nCOMPLETION HIGH_PRIORITY RECURSIVE "is_a_transitivity"\nIF    { ?A is_a ?B\n        ?B is_a ?C }\nINFER { ?A is_a(2) ?C }\n""")
+    rules_file.close()
+    try:
+      world = World()
+      create(world)
+      assert len(partition(world)) == 1
+      assert len(partition(world, 4)) > 1
+      models = self.assert_same_inferences(create, self.get_inferences, sequential = { "rule_set" : rules_file.name }, estimated_blanks = parallel(None), few_blanks = parallel(1))
+      results = self.get_inferences(models["sequential"])
+      assert ("http://test.org/onto.owl#C30", "http://test.org/onto.owl#S") in results[0]
+      assert ("http://test.org/onto.owl#C35", "http://test.org/onto.owl#D") in results[0]
+    finally:
+      os.unlink(rules_file.name)
+      
+  def test_benchmark_1(self):
+    results = semantic2sql.benchmark.run(semantic2sql.benchmark.points(sizes = [20], ratios = [0.5], ratio_size = 20, constructs = ["not"]), RULES_FILE, verbose = False)
+    assert [run["name"] for run in results["runs"]] == ["nb_class=20", "nb_class=20,nb_not=10"]
+    for run in results["runs"]:
+      assert run["peak_rss"] > 0 and run["page_count"] > 0
+      assert set(run["usage"]["stages"]) == { stage.name for stage in get_rule_set(RULES_FILE).stages }
+      
+    assert semantic2sql.benchmark.compare(results, results) == []
+    for run in results["runs"]:
+      run["reason_time"] = 1.0
+    baseline = { "runs" : [dict(run, reason_time = 0.5) for run in results["runs"]] }
+    regressions = semantic2sql.benchmark.compare(results, baseline)
+    assert len(regressions) == 2 and all("reason_time" in regression for regression in regressions)
+    
+  def test_profile_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): is_a = [p.some(A)]
+      class R(Thing): equivalent_to = [p.some(A)]
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE, profile = Profiler(progress_steps = 10))
+    rm.reason()
+    assert rm.new_parents[B.storid] == [R.storid]
+    
+    profiler = rm.profiler
+    assert [stage["name"] for stage in profiler.stages] == [stage.name for stage in rm.rule_set.stages]
+    assert sum(execution["hits"] for execution in profiler.executions) == sum(rule["hits"] for rule in profiler.summary())
+    for execution in profiler.executions:
+      assert execution["sql"] <= execution["wall"]
+    assert sum(execution["vm_steps"] for execution in profiler.executions) > 0
+    
+    plans = profiler.to_json()["plans"]
+    assert any(plan["sql"] == rule.sql0 for rule in rm.rule_set.name_2_rule.values() if isinstance(rule, IfRule) for plan in plans.get(rule.name, []))
+    assert all(event["ph"] == "X" for event in profiler.to_chrome_trace()["traceEvents"])
+    
+  def test_transitive_closure_1(self):
+    with self.onto:
+      props = [types.new_class("p%s" % i, (ObjectProperty,)) for i in range(30)]
+      for i in range(1, 30): props[i].is_a.append(props[i - 1]) # Deep chain
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    prop_is_a = set(rm.cursor.execute("SELECT s,o FROM prop_is_a"))
+    for i in range(30):
+      for j in range(30):
+        assert ((props[i].storid, props[j].storid) in prop_is_a) == (i >= j)
+        
+    closure = semantic2sql.closure.TransitiveClosure()
+    news = closure.add_edges([(1, 2), (2, 3), (4, 5)])
+    assert set(news) == { (1, 3) }
+    news = closure.add_edges([(3, 4), (5, 1)])
+    assert len(set(news)) == len(news)
+    assert { (s, o) for s in range(1, 6) for o in range(1, 6) if (s, o) in closure } == { (s, o) for s in range(1, 6) for o in range(1, 6) }
+    assert len(closure) == 25
+    
+  def test_reduced_is_a_1(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        classes = [types.new_class("C%s" % i, (Thing,)) for i in range(20)]
+        for i in range(1, 20): classes[i].is_a.append(classes[(i - 1) // 2])
+        class E1(classes[10]): pass
+        class E2(E1): pass
+        classes[10].equivalent_to.append(E2) # Cycle of 3 direct is_a
+      return onto
+    
+    rule_set = semantic2sql.rule.RuleSet()
+    with open(os.path.join(os.path.dirname(semantic2sql.rule.__file__), RULES_FILE)) as f:
+      rule_set.load(f.read() + """\nCOMPLETION HIGH_PRIORITY "is_a_transitivity" BUILTIN "TransitiveClosure" { <http://www.w3.org/2000/01/rdf-schema#subClassOf> }\n""")
+      
+    def get_results(rm):
+      if rm.is_a_storage == "full": is_a = set(rm.cursor.execute("SELECT s,o FROM is_a WHERE s>0 AND o>0 AND s!=o AND l<=2"))
+      else:                         is_a = set(rm.cursor.execute("SELECT s,o FROM is_a_closure WHERE s>0 AND o>0 AND s!=o"))
+      unabbreviate = rm.world._unabbreviate
+      return (
+        { (unabbreviate(s), unabbreviate(o)) for s, o in is_a },
+        { unabbreviate(s) : { unabbreviate(o) for o in os } for s, os in rm.new_equivs.items() },
+      )
+    def count_is_a(rm): return rm.cursor.execute("SELECT COUNT() FROM is_a").fetchone()[0]
+    
+    models = self.assert_same_inferences(create, get_results, full = { "rule_set" : rule_set, "is_a_storage" : "full" }, reduced = { "rule_set" : rule_set, "is_a_storage" : "reduced" })
+    assert len(models["reduced"].new_equivs) == 3
+    assert count_is_a(models["reduced"]) < count_is_a(models["full"])
+    
+    with self.assertRaises(ValueError): ReasonedModel(self.world, rule_set = RULES_FILE, is_a_storage = "compressed")
+    
+    labels = semantic2sql.closure.IntervalLabels([(1, 2), (2, 3), (4, 3), (3, 1)])
+    assert { (s, o) for s in range(1, 5) for o in range(1, 5) if labels.reaches(s, o) } == { (s, o) for s in range(1, 5) for o in range(1, 4) } | { (4, 4) }
+    
+  def test_reduced_is_a_2(self):
+    def create(world):
+      onto = world.get_ontology("http://test.org/onto.owl")
+      with onto:
+        class p(ObjectProperty): pass
+        class Z(Thing): pass
+        class A(Z): pass
+        class A1(A): pass
+        class A2(A1): pass
+        class C(Thing): is_a = [p.some(A2)]
+        class S(Thing): equivalent_to = [p.some(Z)] # C is_a S needs the implied A2 is_a Z
+        class D(Thing): pass
+        class E(Thing): pass
+        AllDisjoint([D, Z])
+        class F(A2, D): pass # F is_a Nothing needs the implied F is_a Z
+      return onto
+    
+    rule_set = semantic2sql.rule.RuleSet()
+    with open(os.path.join(os.path.dirname(semantic2sql.rule.__file__), RULES_FILE)) as f:
+      rule_set.load(f.read() + """\nCOMPLETION HIGH_PRIORITY "is_a_transitivity" BUILTIN "TransitiveClosure" { <http://www.w3.org/2000/01/rdf-schema#subClassOf> }\n""")
+      
+    models = self.assert_same_inferences(create, self.get_inferences,
+      full          = { "rule_set" : rule_set, "is_a_storage" : "full" },
+      reduced       = { "rule_set" : rule_set, "is_a_storage" : "reduced" },
+      reduced_rules = { "is_a_storage" : "reduced" }, # The rules file gets the is_a TransitiveClosure
+    )
+    results = self.get_inferences(models["reduced"])
+    assert ("http://test.org/onto.owl#C", "http://test.org/onto.owl#S") in results[0]
+    assert ("http://test.org/onto.owl#F", "http://www.w3.org/2002/07/owl#Nothing") in results[0]
+    assert "is_a_transitivity" in models["reduced_rules"].rule_set.name_2_rule
+    assert not "is_a_transitivity" in get_rule_set(RULES_FILE).name_2_rule
+    
+    labels = semantic2sql.closure.IntervalLabels([(1, 2), (3, 4)])
+    assert { (s, o) for o, intervals in labels.add_edges([(2, 3), (5, 1)]) for s in labels.nodes(intervals) } == { (1, 3), (1, 4), (2, 3), (2, 4), (5, 1), (5, 2), (5, 3), (5, 4) }
+    assert labels.reaches(5, 4) and not labels.reaches(4, 5)
+    
+    rule_set = semantic2sql.rule.RuleSet()
+    with open(os.path.join(os.path.dirname(semantic2sql.rule.__file__), RULES_FILE)) as f: rule_set.load(f.read())
+    with self.assertRaises(ValueError): ReasonedModel(self.world, rule_set = rule_set, is_a_storage = "reduced") # No is_a TransitiveClosure
+    
+  def test_planner_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): is_a = [p.some(A)]
+      class R(Thing): equivalent_to = [p.some(A)]
+      class S(Thing): equivalent_to = [R]
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE, plan_joins = False)
+    rm.reason()
+    assert rm.planner is None
+    new_parents, new_equivs = dict(rm.new_parents), dict(rm.new_equivs)
+    rm.destroy()
+    
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    assert rm.planner.nb_plans > 0
+    assert dict(rm.new_parents) == new_parents
+    assert dict(rm.new_equivs)  == new_equivs
+    assert any("CROSS JOIN" in sql for rule in rm.rule_set.name_2_rule.values() if isinstance(rule, IfRule) for (sql0, sql1, *others) in rule.join_plans.values() for sql in [sql0, sql1])
+    for rule in rm.rule_set.name_2_rule.values(): # The plans do not modify the static SQL of the rules
+      if isinstance(rule, IfRule) and rule.sql0:
+        assert all(sql_if.join_order is None for sql_if in rule.sql.sql_ifs)
+        assert str(rule.sql) == rule.sql0
+    assert any("CROSS JOIN" in rule.sql0 for rule in rm.rule_set.name_2_rule.values() if isinstance(rule, IfRule) and rule.sql0) # Static order, without planner
+
+  def test_statistics_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      for i in range(20):
+        B = types.new_class("B%s" % i, (A,))
+        types.new_class("C%s" % i, (B,))
+        types.new_class("D%s" % i, (Thing,)).is_a.append(p.some(B))
+
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    assert rm.statistics.nb_analyzes > 0
+    is_a = rm.rule_set.tables["is_a"]
+
+    nb, analyzed_nb, per_keys = rm.statistics.tables[is_a]
+    assert rm.statistics.update(is_a, 3 * analyzed_nb // 2) # No ANALYZE, only the number of rows changes
+    nb_analyzes = rm.statistics.nb_analyzes
+    stats = dict(rm.cursor.execute("""SELECT idx, stat FROM temp.sqlite_stat1 WHERE tbl='is_a'"""))
+    assert stats["is_a_so"] == " ".join([str(3 * analyzed_nb // 2)] + dict(per_keys)["is_a_so"])
+    assert not rm.statistics.update(is_a, 3 * analyzed_nb // 2)
+
+    assert rm.statistics.update(is_a, 2 * analyzed_nb)
+    assert rm.statistics.nb_analyzes == nb_analyzes + 1
+
+  def test_bulk_load_1(self):
+    db = sqlite3.connect(":memory:")
+    cursor = db.cursor()
+    cursor.execute("""CREATE TABLE is_a(s INTEGER NOT NULL, o INTEGER NOT NULL, l INTEGER NOT NULL)""")
+    cursor.execute("""CREATE TABLE some(s INTEGER NOT NULL, prop INTEGER NOT NULL, value INTEGER NOT NULL)""")
+    bulk = BulkLoad(cursor)
+    bulk.add_table("is_a", ["s", "o"], ["""CREATE UNIQUE INDEX is_a_so ON is_a(s,o)"""])
+    bulk.add_select("is_a", """SELECT 3,1,2 UNION ALL SELECT 1,2,?""", (5,))
+    bulk.add_select("is_a", """SELECT 3,1,1""") # Duplicate
+    bulk.add_table("some", ["s"], ["""CREATE UNIQUE INDEX some_s ON some(s)"""])
+    bulk.add_rows("some", [(-5, 1, 1), (-2, 1, 1), (-5, 9, 9)])
+    bulk.finish()
+    assert list(cursor.execute("""SELECT s,o,l FROM is_a ORDER BY rowid""")) == [(1, 2, 5), (3, 1, 1)]
+    assert list(cursor.execute("""SELECT s,prop,value FROM some ORDER BY rowid""")) == [(-5, 1, 1), (-2, 1, 1)]
+    assert bulk.nbs == { "is_a" : 2, "some" : 2 }
+    assert set(bulk.times) == { "is_a", "some" }
+    assert { name for (name,) in cursor.execute("""SELECT name FROM sqlite_master WHERE type='index'""") } == { "is_a_so", "some_s" }
 
-###################################################################
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(A): pass
+      class C(Thing): is_a = [p.some(B)]
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    assert { "types", "is_a", "prop_is_a", "some", "only" } <= set(rm.rule_usage()["setup_times"])
+
+  def test_work_store_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class C(Thing): is_a = [p.some(A)]
+      class D(Thing): equivalent_to = [p.some(A)]
+
+    tables = { name for (name,) in self.world.graph.db.execute("""SELECT name FROM main.sqlite_master""") }
+    work_store = WorkStore(directory = tempfile.gettempdir())
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE, work_store = work_store)
+    rm.reason()
+    filename = work_store.filename
+    assert os.path.exists(filename)
+    assert rm.cursor.execute("""SELECT 1 FROM s2s_work.sqlite_master WHERE name='is_a_so'""").fetchone()
+    assert { name for (name,) in self.world.graph.db.execute("""SELECT name FROM main.sqlite_master""") } == tables
+    assert dict(rm.new_parents) == { C.storid : [D.storid] }
+    rm.destroy()
+    assert not os.path.exists(filename)
+
+    with self.assertRaises(ValueError): ReasonedModel(self.world, rule_set = RULES_FILE, persistent = True, work_store = "x.sqlite3")
+
+  def test_work_store_2(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class C(Thing): is_a = [p.some(A)]
+      class D(Thing): equivalent_to = [p.some(A)]
+
+    ReasonedModel(self.world, rule_set = RULES_FILE, persistent = True).run() # Leaves the derived tables in main
+    with self.onto:
+      class E(Thing): is_a = [p.some(A)]
+    tables = { name for (name,) in self.world.graph.db.execute("""SELECT name FROM main.sqlite_master""") }
+    nb     = self.world.graph.db.execute("""SELECT COUNT() FROM main.is_a""").fetchone()[0]
+
+    work_store = WorkStore(directory = tempfile.gettempdir())
+    assert work_store.rewrite("""SELECT 1""") == "SELECT 1"
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE, work_store = work_store)
+    rm.reason()
+    assert work_store.rewrite("""SELECT s FROM is_a WHERE o='is_a'""") == "SELECT s FROM s2s_work.is_a WHERE o='is_a'"
+    assert work_store.rewrite("""CREATE INDEX is_a_o ON is_a(o)""") == "CREATE INDEX s2s_work.is_a_o ON is_a(o)"
+    assert dict(rm.new_parents) == { E.storid : [D.storid] }
+    assert { name for (name,) in self.world.graph.db.execute("""SELECT name FROM main.sqlite_master""") } == tables
+    assert self.world.graph.db.execute("""SELECT COUNT() FROM main.is_a""").fetchone()[0] == nb
+    rm.destroy()
+
+  def test_provenance_1(self):
+    import semantic2sql.html_explain
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(A): pass
+      class C(Thing): is_a = [p.some(A)]
+      class D(Thing): is_a = [p.some(B)]
+      class G(Thing): pass
+      AllDisjoint([G, A])
+
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE, explain = True)
+    rm.reason()
+    assert set(rm.cursor.execute("""SELECT typeof(t), typeof(s), typeof(rule) FROM explanations""")) == { ("integer", "integer", "integer") }
+
+    explanations = [(s, o, sources) for (t, s, o, rule, sources) in rm.provenance.explanations() if rule == "some_subprop_subclass"]
+    assert len(explanations) == 1
+    s, o, sources = explanations[0]
+    assert [table for (table, rowid) in sources] == ["some", "some", "prop_is_a", "is_a"]
+    rowid = sources[-1][1]
+    assert rm.provenance.resolve("is_a", [rowid], "s,o") == { rowid : (B.storid, A.storid) }
+
+    explanation = semantic2sql.html_explain.HTMLExplanation(rm)
+    disjoints = [fact for fact in explanation.facts if isinstance(fact, semantic2sql.html_explain.DisjointFact)]
+    assert { frozenset(fact.xs) for fact in disjoints } >= { frozenset([G.storid, A.storid]) }
+
+  def test_insert_batch_1(self):
+    db = sqlite3.connect(":memory:")
+    db.execute("""CREATE TABLE some(s INTEGER NOT NULL, prop INTEGER NOT NULL, value INTEGER NOT NULL)""")
+    db.execute("""INSERT INTO some VALUES (10,1,2)""")
+    cursor = db.cursor()
+    blanks = iter(range(-1, -100, -1))
+    model  = types.SimpleNamespace(_batch = None, is_a_index = None, trace = None, new_blank_node = lambda: next(blanks))
+    rule_set = types.SimpleNamespace(tables = {})
+    table    = semantic2sql.rule.Table(rule_set, "some", ["s", "prop", "value"])
+    X = semantic2sql.rule.Variable("?X")
+    Y = semantic2sql.rule.Variable("?Y")
+    sql_insert = types.SimpleNamespace(xs = [X, 1, Y], has_non_condition_var = True, list = None)
+    added_nb_inferences = defaultdict(int)
+    batch = model._batch = semantic2sql.rule.InsertBatch(model, cursor, added_nb_inferences)
+    
+    table.prefetch(batch, cursor, sql_insert, [{ Y : 2 }, { Y : 3 }, { Y : 4 }]) # One JOIN for all the lookups
+    
+    queries = []
+    db.set_trace_callback(queries.append)
+    var_2_value = { Y : 2 }
+    assert table.add(model, cursor, added_nb_inferences, var_2_value, sql_insert)
+    assert var_2_value[X] == 10
+    var_2_value = { Y : 3 }
+    assert table.add(model, cursor, added_nb_inferences, var_2_value, sql_insert) # The miss is cached
+    assert var_2_value[X] == -1
+    assert not [query for query in queries if query.startswith("SELECT")]
+    
+    cursor.execute("""INSERT INTO some VALUES (11,1,4)""")
+    batch.inserted(table, (11, 1, 4)) # Invalidates the cached miss
+    var_2_value = { Y : 4 }
+    assert table.add(model, cursor, added_nb_inferences, var_2_value, sql_insert)
+    assert var_2_value[X] == 11
+    
+  def test_extraction_chunks_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B1(Thing): is_a = [p.some(A)]
+      class B2(Thing): is_a = [p.some(A)]
+      class B3(Thing): is_a = [p.some(A)]
+      class R(Thing): equivalent_to = [p.some(A)]
+      class S(Thing): equivalent_to = [R]
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    new_parents, new_equivs, entity_2_type = dict(rm.new_parents), dict(rm.new_equivs), dict(rm.entity_2_type)
+    assert set(new_parents) == { B1.storid, B2.storid, B3.storid }
+    assert new_equivs == { R.storid : [S.storid], S.storid : [R.storid] }
+    
+    chunks = list(rm.iter_inferences(chunk_size = 1))
+    assert len(chunks) == 4 # Equivalences first, then one entity per chunk
+    assert all(len(chunk_new_parents) <= 1 for chunk_new_parents, chunk_new_equivs, chunk_entity_2_type in chunks)
+    assert { s : os for chunk_new_parents, chunk_new_equivs, chunk_entity_2_type in chunks for s, os in chunk_new_parents.items() } == new_parents
+    assert { s : t  for chunk_new_parents, chunk_new_equivs, chunk_entity_2_type in chunks for s, t  in chunk_entity_2_type.items() } == entity_2_type
+    assert (rm.nb_new_is_a, rm.nb_new_equiv) == (3, 2)
+    
+    rm.destroy()
+    
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.run(chunk_size = 1, debug = 0)
+    assert rm.new_parents is None # Not kept in memory by default
+    assert set(B1.is_a) == set(B2.is_a) == set(B3.is_a) == { p.some(A), R }
+    assert S in R.equivalent_to
+    
+  def test_sinks_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): is_a = [p.some(A)]
+      class R(Thing): equivalent_to = [p.some(A)]
+      class S(Thing): equivalent_to = [R]
+      
+    parents = []
+    equivalences = []
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.run(sink = CallbackSink(lambda s, o, type: parents.append((s, o, type)), lambda ss, types: equivalences.append((ss, types))))
+    assert parents == [(B.iri, R.iri, "class")]
+    assert equivalences == [([R.iri, S.iri], ["class", "class"])]
+    assert not R in B.is_a # The world is not modified
+    rm.destroy()
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+      rm.run(sink = SQLiteSink(os.path.join(tmp_dir, "results.sqlite3"), iris = False))
+      rm.destroy()
+      db = sqlite3.connect(os.path.join(tmp_dir, "results.sqlite3"))
+      assert db.execute("SELECT * FROM is_a").fetchall() == [(B.storid, R.storid, "class")]
+      assert db.execute("SELECT * FROM equivalences ORDER BY entity").fetchall() == [(R.storid, R.storid, "class"), (R.storid, S.storid, "class")]
+      db.close()
+      
+      rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+      rm.run(sink = CSVSink(tmp_dir))
+      rm.destroy()
+      with open(os.path.join(tmp_dir, "is_a.csv")) as f:
+        assert f.read().split() == ["child,parent,type", "%s,%s,class" % (B.iri, R.iri)]
+      with open(os.path.join(tmp_dir, "equivalences.csv")) as f:
+        assert f.read().split() == ["class,entity,type", "%s,%s,class" % (R.iri, R.iri), "%s,%s,class" % (R.iri, S.iri)]
+        
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.run(sink = WorldSink(debug = 0, keep_results = True))
+    assert set(B.is_a) == { p.some(A), R }
+    assert dict(rm.new_parents) == { B.storid : [R.storid] } # As before the sinks
+    assert set(rm.new_equivs[R.storid]) == { S.storid }
     
+  def test_blank_allocator_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): pass
+      class C(Thing): is_a = [p.some(A & B), p.some(A | B)]
+      class D(Thing): equivalent_to = [p.some(A) & p.some(B)]
+      
+    current_blank = self.world.graph.execute("SELECT current_blank FROM store").fetchone()[0]
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    assert rm.current_blank > current_blank # The reasoner creates blank nodes...
+    assert self.world.graph.execute("SELECT current_blank FROM store").fetchone()[0] >= rm.current_blank # ...reserved in the quadstore
+    assert self.world.new_blank_node() < -rm.current_blank
+    
+    blanks = semantic2sql.blank_allocator.BlankAllocator(self.world.graph, block_size = 4)
+    ids    = [blanks.new_blank_node() for i in range(3)] + list(blanks.new_blank_nodes(6)) + [blanks.new_blank_node()]
+    assert len(set(ids)) == 10
+    assert list(blanks.new_blank_nodes(3)) == [ids[-1] - 1, ids[-1] - 2, ids[-1] - 3]
+    
+    ranges = semantic2sql.blank_allocator.reserve_blank_ranges(self.world.graph, 3, 5)
+    assert all(ranges[i][1] == ranges[i + 1][0] for i in range(2))
+    assert ranges[0][0] >= blanks.limit
+    blanks = semantic2sql.blank_allocator.BlankAllocator(self.world.graph, reserved = ranges[1])
+    assert list(blanks.new_blank_nodes(5)) == list(range(-ranges[1][0] - 1, -ranges[1][1] - 1, -1))
+    with self.assertRaises(RuntimeError): blanks.new_blank_node()
+    
+  def test_construct_catalog_1(self):
+    with self.onto:
+      class p(ObjectProperty): pass
+      class A(Thing): pass
+      class B(Thing): pass
+      class C(Thing): is_a = [p.some(A & B), p.only(A | B)]
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    catalog = rm._get_constructs()
+    assert rm._get_constructs() is catalog
+    descriptions = { str(catalog[s]) for s in catalog if s < 0 }
+    assert "(p some (A and B))" in descriptions
+    assert "(p only (A or B))"  in descriptions
+    assert str(catalog[A.storid]) == "A"
+    assert not catalog[A.storid].is_new
+    assert catalog.get(B.storid + 1000, "???") == "???"
+    
+    rm.cursor.execute("INSERT INTO some VALUES (?,?,?)", (-999999, p.storid, C.storid))
+    assert rm._get_constructs() is not catalog
+    assert str(rm._get_constructs()[-999999]) == "(p some C)"
+    assert rm._get_constructs()[-999999].is_new
+    
+  def test_linked_lists_factorization_1(self):
+    with self.onto:
+      class has(ObjectProperty): pass
+      tests  = [types.new_class("T%s" % i, (Thing,)) for i in range(40)]
+      for i in range(6): # Panels of 30 tests, 20 of them in common
+        panel = types.new_class("P%s" % i, (Thing,))
+        panel.equivalent_to = [And([has.some(test) for test in tests[:20] + tests[20 + i * 3 : 30 + i * 3]])]
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    linked = { s : (o1, o2) for s, o1, o2 in rm.cursor.execute("SELECT s,o1,o2 FROM linked_lists_%s" % owl_intersectionof) }
+    def leaves(s):
+      if not s in linked: return { s }
+      return leaves(linked[s][0]) | leaves(linked[s][1])
+    flat = defaultdict(set)
+    for s, o in rm.cursor.execute("SELECT s,o FROM flat_lists_%s" % owl_intersectionof): flat[s].add(o)
+    assert len(flat) == 6
+    for s, os in flat.items(): assert leaves(s) == os
+    assert len(linked) < 6 * 29 // 2 # The 20 common elements are shared
+    
+    builtin = rm.rule_set.name_2_rule["and_linked_list"]
+    pairs   = dict(builtin.pairs)
+    builtin.restore(rm, rm.cursor) # A restored session factorizes as a fresh one
+    assert builtin.pairs == pairs
+    assert len(pairs) < len(linked) # The balanced nodes are not pairs
+    
+  def test_key_lists_1(self):
+    with self.onto:
+      class A(Thing): pass
+      class B(Thing): pass
+      class C(Thing): pass
+      class D(Thing): equivalent_to = [A | B]
+      class E(Thing): is_a = [A | B | C]
+      
+    rm = ReasonedModel(self.world, rule_set = RULES_FILE)
+    rm.reason()
+    key = rm.rule_set.get_list(owl_unionof).key
+    assert set(k for (k,) in rm.cursor.execute("SELECT typeof(k) FROM %s" % key.table.name)) == { "integer" }
+    s_ab  = key.get(rm.cursor, sorted([A.storid, B.storid]))
+    s_abc = key.get(rm.cursor, sorted([A.storid, B.storid, C.storid]))
+    assert s_ab and s_abc and (s_ab != s_abc)
+    assert key.get(rm.cursor, sorted([A.storid, C.storid])) is None
+    
+    k = key.key(sorted([A.storid, C.storid]))
+    key._add_k_s(k, s_ab) # Simulated collision, rejected by the verification
+    assert key.get(rm.cursor, sorted([A.storid, C.storid])) is None
+    key._add_k_s(key.key(sorted([A.storid, B.storid])), s_abc)
+    assert key.get(rm.cursor, sorted([A.storid, B.storid])) == s_ab
+    
+###################################################################
+
 class Exp(BaseTest):
 
   def test_yyy(self):
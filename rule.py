@@ -18,20 +18,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
 sys.path.append("./")
-import os.path
+import os, os.path, io, re, hashlib, pickle, tempfile, struct, sqlite3
 from collections import defaultdict, Counter
+import owlready2
 from owlready2 import *
 from semantic2sql.pattern import *
 from semantic2sql.rule_parser import *
+from semantic2sql.closure import *
 
 #SQUASHED_LIST_PROPS = {owl_unionof, owl_intersectionof, owl_oneof, owl_members, owl_distinctmembers}
 #CONSTRUCT_PROPS = {rdfs_subclassof, owl_unionof, owl_intersectionof, owl_oneof, owl_complementof, owl_inverse_property, SOME, VALUE, ONLY, EXACTLY, MIN, MAX, owl_onproperty, owl_onclass, owl_ondatarange, owl_withrestrictions}
 #NON_INFERRABLE_TYPES = { owl_restriction, owl_alldisjointclasses, owl_alldifferent, owl_alldisjointproperties }
 
 _RESTRICTION_TABLES = { "some", "only", "exactly" }
-
-SHOW_NEW_CONSTRUCTS = False
-SHOW_NEW_CONSTRUCTS = True
+_BATCHABLE_TABLES   = { "is_a", "types", "prop_is_a", "infer_descendants", "infer_ancestors", "concrete" }
 
 
 class Table(object):
@@ -46,26 +46,58 @@ class Table(object):
     
   def __repr__(self): return "<Table '%s'>" % self.name
   
+  def _lookup(self, sql_insert, var_2_value): # The search for an existing row, when the insertion has non-condition variables
+    selects  = []
+    new_vars = []
+    wheres   = []
+    values   = []
+    for column, x in zip(self.columns, sql_insert.xs):
+      if isinstance(x, Variable):
+        if x in var_2_value:
+          wheres.append(column)
+          values.append(var_2_value[x])
+        else:
+          selects .append(column)
+          new_vars.append(x)
+      else:
+        wheres.append(column)
+        values.append(x)
+        
+    sql = ("""SELECT %s FROM %s WHERE %s LIMIT 1""" % (",".join(selects), self.search_name, " AND ".join("%s=?" % where for where in wheres)))
+    return sql, tuple(values), selects, wheres, new_vars
+  
+  def prefetch(self, batch, cursor, sql_insert, var_2_values): # Resolves the lookups of many SELECT results with a single JOIN
+    keys = {}
+    for var_2_value in var_2_values:
+      sql, values, selects, wheres, new_vars = self._lookup(sql_insert, var_2_value)
+      if not (sql, values) in batch.lookups: keys[values] = None
+    if (not keys) or (not wheres): return
+    
+    key_table = "lookup_keys_%s" % len(wheres)
+    cursor.execute("""CREATE TEMPORARY TABLE IF NOT EXISTS %s(%s)""" % (key_table, ",".join("k%s" % i for i in range(len(wheres)))))
+    cursor.executemany("""INSERT INTO %s VALUES (%s)""" % (key_table, ",".join("?" for where in wheres)), list(keys))
+    found = {}
+    for r in cursor.execute("""SELECT %s,%s FROM %s k JOIN %s t ON %s""" % (
+        ",".join("k.k%s" % i for i in range(len(wheres))), ",".join("t.%s" % select for select in selects),
+        key_table, self.search_name, " AND ".join("t.%s=k.k%s" % (where, i) for i, where in enumerate(wheres)))):
+      found.setdefault(r[:len(wheres)], r[len(wheres):])
+    cursor.execute("""DELETE FROM %s""" % key_table)
+    
+    for values in keys: batch.cache(self, wheres, (sql, values), found.get(values)) # Misses are cached too
+    
   def add(self, model, cursor, added_nb_inferences, var_2_value, sql_insert):
+    batch = model._batch
     if sql_insert.has_non_condition_var:
-      selects  = []
-      new_vars = []
-      wheres   = []
-      values   = []
-      for column, x in zip(self.columns, sql_insert.xs):
-        if isinstance(x, Variable):
-          if x in var_2_value:
-            wheres.append(column)
-            values.append(var_2_value[x])
-          else:
-            selects .append(column)
-            new_vars.append(x)
+      sql, values, selects, wheres, new_vars = self._lookup(sql_insert, var_2_value)
+      if batch:
+        lookup = (sql, values)
+        if lookup in batch.lookups: new_values = batch.lookups[lookup]
         else:
-          wheres.append(column)
-          values.append(x)
-          
-      sql = ("""SELECT %s FROM %s WHERE %s LIMIT 1""" % (",".join(selects), self.search_name, " AND ".join("%s=?" % where for where in wheres)))
-      new_values = cursor.execute(sql, values).fetchone()
+          batch.flush(self)
+          new_values = cursor.execute(sql, values).fetchone()
+          batch.cache(self, wheres, lookup, new_values)
+      else:
+        new_values = cursor.execute(sql, values).fetchone()
       if new_values:
         for new_var, new_value in zip(new_vars, new_values): var_2_value[new_var] = new_value
         return True
@@ -87,13 +119,20 @@ class Table(object):
       if isinstance(x, Variable): values.append(var_2_value[x])
       else:                       values.append(int(x))
       
-    sql = """INSERT OR IGNORE INTO %s VALUES (%s)""" % (self.name, ",".join("?" for i in range(len(self.columns))))
-    cursor.execute(sql, values)
-    added_nb_inferences[self] += cursor.rowcount
+    if (self.name == "is_a") and (not model.is_a_index is None) and model._has_is_a(values[0], values[1]): return True
     
-    if SHOW_NEW_CONSTRUCTS and self.name != "is_a":
-      print()
-      print(values[0], ":", model._get_constructs()[values[0]])
+    if batch and (self.name in _BATCHABLE_TABLES) and (not sql_insert.has_non_condition_var):
+      batch.add(self, tuple(values))
+    else:
+      sql = """INSERT OR IGNORE INTO %s VALUES (%s)""" % (self.name, ",".join("?" for i in range(len(self.columns))))
+      cursor.execute(sql, values)
+      added_nb_inferences[self] += cursor.rowcount
+      if self.name == "is_a": model._add_is_a(values[0], values[1])
+      if batch:
+        batch.inserted(self, values)
+        if sql_insert.has_non_condition_var: batch.lookups[lookup] = tuple(var_2_value[new_var] for new_var in new_vars)
+        
+    if model.trace and not self.name in _BATCHABLE_TABLES: model.trace.record(self.name, values[0])
       
     return True
   
@@ -135,6 +174,7 @@ class List(object):
     
     elements = set(elements0)
     assert isinstance(elements, set) or isinstance(elements, frozenset)
+    e_2_extra_is_a = {} # Only computed for new unions, s being given for the unions normalized in persistent sessions
     
     if not s:
       if   (self.rel == owl_intersectionof) or (self.rel == owl_unionof):
@@ -166,7 +206,7 @@ class List(object):
           for e1 in elements_copy:
             for e2 in elements_copy:
               if (e1 == e2) or (e1 in removeds) or (e2 in removeds): continue
-              r = cursor.execute("""SELECT 1 FROM is_a WHERE s=? and o=? LIMIT 1""", (e1, e2)).fetchone()
+              r = model._has_is_a(e1, e2)
               if r:
                 elements.discard(e2); removeds.add(e2)
                 model._increment_extra("A and B with B is a A")
@@ -200,20 +240,20 @@ class List(object):
               e1_extra_is_a = e_2_extra_is_a[e1]
               e2_extra_is_a = e_2_extra_is_a[e2]
               
-              r = (e2 in e1_extra_is_a) or cursor.execute("""SELECT 1 FROM is_a WHERE s=? and o=? LIMIT 1""", (e1, e2)).fetchone()
+              r = (e2 in e1_extra_is_a) or model._has_is_a(e1, e2)
               
               if not r:
                 #print("!!!", e1, e1_extra_is_a, "  ", e2, e2_extra_is_a)
                 if   e1_extra_is_a and not e2_extra_is_a:
                   for extra_is_a1 in e1_extra_is_a:
-                    r2 = cursor.execute("""SELECT 1 FROM is_a WHERE s=? and o=? LIMIT 1""", (extra_is_a1, e2)).fetchone()
+                    r2 = model._has_is_a(extra_is_a1, e2)
                     if r2:
                       r = True
                       break
                     
                 elif e2_extra_is_a and not e1_extra_is_a:
                   for extra_is_a2 in e2_extra_is_a:
-                    r2 = cursor.execute("""SELECT 1 FROM is_a WHERE s=? and o=? LIMIT 1""", (e1, extra_is_a2)).fetchone()
+                    r2 = model._has_is_a(e1, extra_is_a2)
                     if not r2: break
                   else:
                     r = True
@@ -222,7 +262,7 @@ class List(object):
                   r = True
                   for extra_is_a2 in e2_extra_is_a:
                     for extra_is_a1 in e1_extra_is_a:
-                      r2 = cursor.execute("""SELECT 1 FROM is_a WHERE s=? and o=? LIMIT 1""", (extra_is_a1, extra_is_a2)).fetchone()
+                      r2 = model._has_is_a(extra_is_a1, extra_is_a2)
                       if r2: break
                     else:
                       r = False
@@ -268,8 +308,7 @@ class List(object):
     elif (len(elements) == 1) and (not self.flat.single_element):
       s = elements[0]
       if (s < 0) and self.is_a_thing: # Ensure that s is a thing and a clause
-        r = cursor.execute("""SELECT 1 FROM is_a WHERE s=? AND o=? LIMIT 1""", (s, owl_thing)).fetchone()
-        if not r:
+        if not model._has_is_a(s, owl_thing):
           cursor.execute("""INSERT OR IGNORE INTO types VALUES (?,?)""", (s, owl_class))
           added_nb_inferences[model.rule_set.tables["types"]] += cursor.rowcount
           if cursor.rowcount: model._trigger_create(rdf_type)
@@ -280,11 +319,10 @@ class List(object):
     linked_ok = False
     if not s:
       if   self.key:
-        k = ",".join(str(e) for e in elements)
-        r = cursor.execute("""SELECT s FROM %s WHERE k=? LIMIT 1""" % self.key.table.name, (k,)).fetchone()
+        r = self.key.get(cursor, elements)
         if r:
-          model._list_cache[self][elements0] = r[0]
-          return r[0]
+          model._list_cache[self][elements0] = r
+          return r
         
       elif self.flat.single_element:
         assert len(elements) == 1
@@ -324,9 +362,7 @@ class List(object):
       cursor.executemany("""INSERT INTO %s VALUES (?,?)""" % self.flat.table.name, ((s, e) for e in elements))
       added_nb_inferences[self.flat.table] += len(elements)
       
-    if self.key:
-      k = ",".join(str(e) for e in elements)
-      cursor.execute("""INSERT INTO %s VALUES (?,?)""" % self.key.table.name, (k, s))
+    if self.key: self.key.add(cursor, elements, s)
       
     if self.is_a_thing:
       cursor.execute("""INSERT OR IGNORE INTO types VALUES (?,?)""", (s, owl_class))
@@ -344,13 +380,15 @@ class List(object):
         return get_s_extra_is_a(r1[0]) + get_s_extra_is_a(r1[1])
       
       for e in elements:
-        if e_2_extra_is_a[e]: # an intermediary node in a AND => promote it to a full entity
+        if e_2_extra_is_a.get(e): # an intermediary node in a AND => promote it to a full entity
           model._increment_extra("Promote AND intermediary node")
           
           cursor.execute("""INSERT OR IGNORE INTO is_a VALUES (?,?,?)""", (e, e, 3))
           added_nb_inferences[model.rule_set.tables["is_a"]] += cursor.rowcount
           cursor.execute("""INSERT OR IGNORE INTO is_a VALUES (?,?,?)""", (e, owl_thing, 2))
           added_nb_inferences[model.rule_set.tables["is_a"]] += cursor.rowcount
+          model._add_is_a(e, e)
+          model._add_is_a(e, owl_thing)
           
           for child in get_s_extra_is_a(e):
             cursor.execute("""INSERT OR IGNORE INTO flat_lists_31 VALUES (?,?)""", (e, child))
@@ -360,19 +398,61 @@ class List(object):
           #print(model._get_constructs()[s])
           #ezmlfoe
           
-    if SHOW_NEW_CONSTRUCTS:
-      print()
-      print(s, ":", model._get_constructs()[s])
+    if model.trace: model.trace.record(self.flat.table.name if self.flat else "list", s)
       
     model._list_cache[self][elements0] = s
     return s
   
 
+class InsertBatch(object):
+  def __init__(self, model, cursor, added_nb_inferences):
+    self.model               = model
+    self.cursor              = cursor
+    self.added_nb_inferences = added_nb_inferences
+    self.pendings            = defaultdict(dict) # Table => { values : None }, ordered
+    self.is_a_pairs          = set()
+    self.lookups             = {} # (sql, values) => found values, or None if not found
+    self.misses              = defaultdict(lambda: defaultdict(dict)) # Table => where columns => { values : lookup }
+    self.nb_queued           = 0
+    
+  def cache(self, table, wheres, lookup, new_values):
+    self.lookups[lookup] = new_values
+    if new_values is None: self.misses[table][tuple(wheres)][lookup[1]] = lookup
+    
+  def inserted(self, table, values): # The cached misses matching the new row are no longer valid
+    misses = self.misses.get(table)
+    if not misses: return
+    for wheres, lookups in misses.items():
+      lookup = lookups.pop(tuple(values[table.columns.index(where)] for where in wheres), None)
+      if lookup: del self.lookups[lookup]
+      
+  def add(self, table, values):
+    pending = self.pendings[table]
+    if values in pending: return
+    pending[values] = None
+    self.nb_queued += 1
+    self.inserted(table, values)
+    if table.name == "is_a":
+      self.is_a_pairs.add((values[0], values[1]))
+      self.model._add_is_a(values[0], values[1])
+    
+  def flush(self, table = None):
+    if table: tables = [table]
+    else:     tables = list(self.pendings)
+    for table in tables:
+      pending = self.pendings.pop(table, None)
+      if not pending: continue
+      self.cursor.executemany("""INSERT OR IGNORE INTO %s VALUES (%s)""" % (table.name, ",".join("?" for i in table.columns)), list(pending))
+      self.added_nb_inferences[table] += self.cursor.rowcount
+      if table.name == "is_a": self.is_a_pairs.clear()
+      
+      
 class Rule(object):
   creates        = set()
   dependss       = []
   table_creates  = []
   table_dependss = []
+  delta_tables   = []
   table          = None
   complexity     = 100
   priority       = 1
@@ -397,6 +477,7 @@ class Rule(object):
 class Builtin(Rule):
   def copy(self): return self
   def load(self, rule_set, options, type, data): pass
+  def restore(self, model, cursor): pass # Restore the state of a previous execution, for persistent sessions
   
 class BuiltinCreateFlatList(Builtin):
   single_element = False
@@ -412,6 +493,8 @@ class BuiltinCreateFlatList(Builtin):
     model.rule_set.created_tables.add(self.table)
     return 0, None # Flat lists are filled by normalize construct
   
+  def restore(self, model, cursor): model.rule_set.created_tables.add(self.table)
+  
 class BuiltinCreateSingleElementFlatList(BuiltinCreateFlatList):
   single_element = True
   
@@ -420,6 +503,8 @@ class BuiltinNormalizeConstructs(Builtin):
 
   
 class BuiltinCreateKeyList(Builtin):
+  # Index of the lists by their elements: k is a 64-bit hash of the sorted elements, mirrored in memory by
+  # k_2_ss; since hashes may collide, the elements of the candidate lists are verified in the flat list table.
   def load(self, rule_set, options, type, data):
     self.rels  = [default_world._abbreviate(i.value[1:-1]) for i in data]
     table_list = rule_set.get_list(self.rels[0])
@@ -427,20 +512,49 @@ class BuiltinCreateKeyList(Builtin):
     table_list.key = self
     
   def execute(self, model, cursor):
-    cursor.execute("""CREATE %s TABLE %s(k TEXT NOT NULL, s INTEGER NOT NULL)""" % (model.temporary, self.table.name))
+    cursor.execute("""CREATE %s TABLE %s(k INTEGER NOT NULL, s INTEGER NOT NULL)""" % (model.temporary, self.table.name))
     model.rule_set.created_tables.add(self.table)
     model.sql_destroy += """DROP TABLE %s;\n""" % self.table.name
     
-    flat_table = model.rule_set.get_list(self.rels[0]).flat.table
-    cursor.executemany("""INSERT INTO %s VALUES (?,?)""" % self.table.name, [
-      (",".join(str(o) for o in sorted(int(o) for o in os.split(","))), s)
-      for s, os in cursor.execute("""SELECT s,group_concat(o) FROM %s GROUP BY s""" % flat_table.name)
-    ])
+    self.flat_table = model.rule_set.get_list(self.rels[0]).flat.table
+    self.k_2_ss     = {}
+    rows            = []
+    for s, os in cursor.execute("""SELECT s,group_concat(o) FROM %s GROUP BY s""" % self.flat_table.name):
+      k = self.key(sorted(int(o) for o in os.split(",")))
+      self._add_k_s(k, s)
+      rows.append((k, s))
+    cursor.executemany("""INSERT INTO %s VALUES (?,?)""" % self.table.name, rows)
     
-    cursor.execute("""CREATE UNIQUE INDEX %s_k ON %s(k)""" % (self.table.name, self.table.name))
+    cursor.execute("""CREATE INDEX %s_k ON %s(k)""" % (self.table.name, self.table.name))
     return 0, None # Not counted since not used in depends
-
-
+  
+  def restore(self, model, cursor):
+    model.rule_set.created_tables.add(self.table)
+    self.flat_table = model.rule_set.get_list(self.rels[0]).flat.table
+    self.k_2_ss     = {}
+    for k, s in cursor.execute("""SELECT k,s FROM %s""" % self.table.name): self._add_k_s(k, s)
+    
+  def key(self, elements): # elements must be sorted
+    return int.from_bytes(hashlib.blake2b(struct.pack("<%sq" % len(elements), *elements), digest_size = 8).digest(), "little", signed = True)
+  
+  def _add_k_s(self, k, s):
+    ss = self.k_2_ss.get(k)
+    if   ss is None:            self.k_2_ss[k] = s
+    elif isinstance(ss, tuple): self.k_2_ss[k] = ss + (s,) # Collision
+    else:                       self.k_2_ss[k] = (ss, s)
+    
+  def get(self, cursor, elements): # Returns the list with the given (sorted) elements, or None
+    ss = self.k_2_ss.get(self.key(elements))
+    if ss is None: return None
+    for s in (ss if isinstance(ss, tuple) else (ss,)):
+      if [o for (o,) in cursor.execute("""SELECT o FROM %s WHERE s=? ORDER BY o""" % self.flat_table.name, (s,))] == elements: return s
+      
+  def add(self, cursor, elements, s):
+    k = self.key(elements)
+    self._add_k_s(k, s)
+    cursor.execute("""INSERT INTO %s VALUES (?,?)""" % self.table.name, (k, s))
+    
+    
 def all_combinations(l):
   """returns all the combinations of the sublist in the given list (i.e. l[0] x l[1] x ... x l[n])."""
   if len(l) == 0: return [[]]
@@ -449,24 +563,13 @@ def all_combinations(l):
   for a in l[0]: r.extend(a + b for b in all_combinations(l[1:]))
   return r
 
-def all_subsets(s):
-  """returns all the subsets included in this set."""
-  r = [frozenset()]
-  for i in s:
-    for j in r[:]:
-      x = j | frozenset([i])
-      r.append(x)
-  r = [x for x in r if len(x) >= 2]
-  r.sort(key = lambda x: -len(x))
-  return r
-
-
 class BuiltinCreateLinkedList(Builtin):
   def load(self, rule_set, options, type, data):
     self.rels  = [default_world._abbreviate(i.value[1:-1]) for i in data]
     table_list = rule_set.get_list(self.rels[0])
     table_list.linked = self
     self.table = Table(rule_set, "linked_lists_%s" % self.rels[0], ["s", "o1", "o2"], list = table_list)
+    self.pairs_table_name = "linked_pairs_%s" % self.rels[0] # The pair nodes of the factorization, for restore()
     rule_set.create_2_tables[self.rels[0]].append(self.table)
     
     if owl_intersectionof in self.rels:
@@ -479,7 +582,8 @@ class BuiltinCreateLinkedList(Builtin):
     self.priority_cache = {}
     
     cursor.execute("""CREATE %s TABLE %s(s INTEGER NOT NULL, o1 INTEGER NOT NULL, o2 INTEGER NOT NULL)""" % (model.temporary, self.table.name))
-    model.sql_destroy += """DROP TABLE %s;\n""" % self.table.name
+    cursor.execute("""CREATE %s TABLE %s(o1 INTEGER NOT NULL, o2 INTEGER NOT NULL, s INTEGER NOT NULL)""" % (model.temporary, self.pairs_table_name))
+    model.sql_destroy += """DROP TABLE %s;\nDROP TABLE %s;\n""" % (self.table.name, self.pairs_table_name)
     
     flat_list = model.rule_set.get_list(self.rels[0]).flat
     if owl_intersectionof in self.rels:
@@ -495,6 +599,7 @@ class BuiltinCreateLinkedList(Builtin):
     self.occurrences = dict(cursor.execute("""SELECT o, COUNT() FROM %s GROUP BY o""" % flat_list.table.name))
     self.l_2_bn = {}
     self.bn_2_l = {}
+    self.pairs  = {} # (o1, o2) => node
     
     if s_lists: nb, last_linked_list = self.adds(s_lists)
     else:       nb = 0
@@ -505,6 +610,26 @@ class BuiltinCreateLinkedList(Builtin):
     model.rule_set.created_tables.add(self.table)
     #return nb, None
   
+  def restore(self, model, cursor):
+    self.model          = model
+    self.priority_cache = {}
+    
+    flat_list = model.rule_set.get_list(self.rels[0]).flat
+    self.occurrences = dict(cursor.execute("""SELECT o, COUNT() FROM %s GROUP BY o""" % flat_list.table.name))
+    
+    bn_2_o1o2 = { s : (o1, o2) for (s, o1, o2) in cursor.execute("""SELECT s,o1,o2 FROM %s""" % self.table.name) }
+    self.bn_2_l = {}
+    def get_l(bn):
+      l = self.bn_2_l.get(bn)
+      if l is None:
+        l = self.bn_2_l[bn] = frozenset(j for i in bn_2_o1o2[bn] for j in (get_l(i) if i in bn_2_o1o2 else (i,)))
+      return l
+    for bn in bn_2_o1o2: get_l(bn)
+    self.l_2_bn = { l : bn for (bn, l) in self.bn_2_l.items() }
+    self.pairs  = { (o1, o2) : s for (o1, o2, s) in cursor.execute("""SELECT o1,o2,s FROM %s""" % self.pairs_table_name) } # Only the pairs, as in adds()
+    
+    model.rule_set.created_tables.add(self.table)
+    
   def _split_list_by_priority_and(self, l):
     l1 = []
     l2 = []
@@ -520,11 +645,24 @@ class BuiltinCreateLinkedList(Builtin):
     return frozenset(l1), frozenset(l2)
   
   def adds(self, s_lists):
-    insertions  = []
+    # The lists are factorized all at once, Re-Pair style: the elements of each list are sorted by decreasing
+    # number of occurrences, so as the frequent elements come first and are aligned, and each pair of adjacent
+    # symbols found in several lists (or already created) is replaced by a shared node, until no pair repeats.
+    # The remaining symbols of each list are then joined by balanced nodes.
+    insertions = []
+    pairs      = self.pairs
+    created    = set() # Pair nodes created here, which can still take the s of a list
+    renamed    = {}
+    new_pairs  = []
     
     def create_balanced_linked_list(l, s = None):
       l2 = frozenset(j for i in l for j in self.bn_2_l.get(i) or (i,))
       bn = self.l_2_bn.get(l2)
+      if bn and s and (bn in created): # The list's node is a pair node created for it, rename it to s
+        created.discard(bn)
+        renamed[bn] = self.l_2_bn[l2] = s
+        self.bn_2_l[s] = self.bn_2_l.pop(bn)
+        return s
       if not bn:
         bn = self.l_2_bn[l2] = s or self.model.new_blank_node()
         self.bn_2_l[bn] = l2
@@ -536,88 +674,261 @@ class BuiltinCreateLinkedList(Builtin):
           split_point = int(len(l) / 2)
           insertions.append((bn, create_balanced_linked_list(l[:split_point]), create_balanced_linked_list(l[split_point:])))
       return bn
-      
-    def do_exponential(l):
-      r = []
-      alreadys = set()
-      for subset in all_subsets(l):
-        previous = self.l_2_bn.get(subset)
-        if previous:
-          if len(subset) == len(l): return [previous]
-          if subset.issubset(alreadys): continue
-          r.append(previous)
-          alreadys.update(subset)
-      if r: 
-        
-        #return [*r, *sorted(l - alreadys)]
-        return [*r, *sorted(set(l) - alreadys)]
-      return sorted(l)
     
-    def do_heuristic(l):
-      sl = sorted(l, key = lambda i: (self.occurrences[i], i))
-      return sl[:-13] + do_exponential(sl[-13:])
+    def create_pair(x, y):
+      l2 = frozenset(j for i in (x, y) for j in self.bn_2_l.get(i) or (i,))
+      bn = self.l_2_bn.get(l2)
+      if not bn:
+        bn = self.l_2_bn[l2] = self.model.new_blank_node()
+        self.bn_2_l[bn] = l2
+        insertions.append((bn, x, y))
+        created.add(bn)
+      pairs[x, y] = bn
+      new_pairs.append((x, y))
+      return bn
     
+    def factorize(seqs):
+      while True:
+        counts = defaultdict(int)
+        for seq in seqs:
+          for i in range(len(seq) - 1): counts[seq[i], seq[i + 1]] += 1
+        replaced = False
+        for k, seq in enumerate(seqs):
+          if len(seq) < 2: continue
+          new_seq = []
+          i       = 0
+          while i < len(seq):
+            if i + 1 < len(seq):
+              pair = (seq[i], seq[i + 1])
+              bn   = pairs.get(pair)
+              if (bn is None) and (counts[pair] >= 2): bn = create_pair(*pair)
+              if not bn is None:
+                new_seq.append(bn)
+                replaced = True
+                i += 2
+                continue
+            new_seq.append(seq[i])
+            i += 1
+          seqs[k] = new_seq
+        if not replaced: return seqs
+        
+    occurrences = self.occurrences
+    sort_key    = lambda i: (-occurrences.get(i, 0), i)
+    groupss     = []
     for s, l in s_lists:
+      if self._split_list_by_priority: groupss.append((s, [i for i in self._split_list_by_priority(l) if i])) # remove empty lists
+      else:                            groupss.append((s, [l]))
+    seqs = factorize([sorted(group, key = sort_key) for s, groups in groupss for group in groups])
+    
+    seqs = iter(seqs)
+    for s, groups in groupss:
+      group_seqs = [next(seqs) for group in groups]
       if self._split_list_by_priority:
-        l_prios = [i for i in self._split_list_by_priority(l) if i] # remove empty lists
-        l_merged = []
         linked_list = None
-        for l_prio in reversed(l_prios):
-          if len(l_prio) < 12: ll = do_exponential(l_prio)
-          else:                ll = do_heuristic  (l_prio)
+        for seq in reversed(group_seqs):
+          ll = [renamed.get(i, i) for i in seq]
           if linked_list: ll.append(linked_list)
           if ll:
-            if l_prio is l_prios[0]:
+            if seq is group_seqs[0]:
               linked_list = create_balanced_linked_list(ll, s)
             else:
               if len(ll) == 1: linked_list = ll[0]
               else:            linked_list = create_balanced_linked_list(ll)
               
       else:
-        if len(l) < 14: linked_list = create_balanced_linked_list(do_exponential(l), s)
-        else:           linked_list = create_balanced_linked_list(do_heuristic  (l), s)
+        linked_list = create_balanced_linked_list([renamed.get(i, i) for i in group_seqs[0]], s)
       #if s and (linked_list != s): print(s_lists, s, linked_list); assert False
       
+    if renamed:
+      insertions = [(renamed.get(bn, bn), renamed.get(o1, o1), renamed.get(o2, o2)) for (bn, o1, o2) in insertions]
+      for k, (x, y) in enumerate(new_pairs):
+        bn = pairs.pop((x, y))
+        new_pairs[k] = (renamed.get(x, x), renamed.get(y, y))
+        pairs[new_pairs[k]] = renamed.get(bn, bn)
+        
+    self.model.cursor.executemany("""INSERT INTO %s VALUES (?,?,?)""" % self.pairs_table_name, [(x, y, pairs[x, y]) for (x, y) in new_pairs])
     self.model.cursor.executemany("""INSERT INTO %s VALUES (?,?,?)""" % self.table.name, insertions)
     
     return self.model.cursor.rowcount, linked_list
 
   
   
+_CLOSURE_TABLES = { rdfs_subclassof : ("is_a", " AND l<=2", ",2"), rdfs_subpropertyof : ("prop_is_a", "", "") } # table, loaded rows, inserted level
+
+class BuiltinTransitiveClosure(Builtin):
+  # Transitive closure of is_a or prop_is_a, computed in Python (see closure.py) instead of a SQL self-join
+  # repeated until fixpoint. The closure is kept by the model, and only the rows added since the previous
+  # execution are loaded. For is_a, only asserted / inferred rows (level <= 2) are closed, as in is_a_transitivity_1.
+  def load(self, rule_set, options, type, data):
+    self.rels  = [default_world._abbreviate(i.value[1:-1]) for i in data]
+    table_name, self.sql_where, self.sql_level = _CLOSURE_TABLES[self.rels[0]]
+    self.table           = rule_set.tables[table_name]
+    self.dependss        = [{ self.rels[0] }]
+    self.creates         = { self.rels[0] }
+    self.delta_tables    = [self.table]
+    self.last_inferences = {}
+    for option in options:
+      if   option.value == "HIGHEST_PRIORITY": self.priority = -100
+      elif option.value == "HIGH_PRIORITY":    self.priority = -50
+      elif option.value == "LOW_PRIORITY":     self.priority =  50
+      elif option.value == "LOWEST_PRIORITY":  self.priority =  100
+      # RECURSIVE is not needed, the closure is complete after each execution
+      
+  def copy(self):
+    clone = Rule.copy(self)
+    clone.last_inferences = {}
+    return clone
+  
+  def execute(self, model, cursor):
+    if (self.table.name == "is_a") and (model.is_a_storage == "reduced"): return self._execute_reduced(model, cursor)
+    
+    closure = model.closures.get(self.table)
+    if closure is None: closure = model.closures[self.table] = TransitiveClosure()
+    
+    edges = cursor.execute("""SELECT rowid,s,o FROM %s WHERE rowid>?%s""" % (self.table.name, self.sql_where), (closure.last_rowid,)).fetchall()
+    if not edges: return 0, None
+    closure.last_rowid = max(edges)[0]
+    news = closure.add_edges((s, o) for (rowid, s, o) in edges)
+    if not news: return 0, None
+    
+    cursor.executemany("""INSERT OR IGNORE INTO %s VALUES (?,?%s)""" % (self.table.name, self.sql_level), news)
+    nb = cursor.rowcount
+    closure.last_rowid = cursor.execute("""SELECT MAX(rowid) FROM %s""" % self.table.name).fetchone()[0] # Our own rows are already in the closure
+    if model.explain and (self.table.name == "is_a"): model.provenance.add_many("is_a", self.name, news)
+    return nb, None
+  
+  def restore(self, model, cursor): model.execute_rule(self) # Only the missing pairs are inserted
+  
+  def _execute_reduced(self, model, cursor):
+    # The closure is labelled (see IntervalLabels), and only the implied is_a towards the targets are inserted in
+    # is_a: the entities the rules join is_a with, i.e. the constructs, their values and members, and Nothing.
+    # The other implied is_a are answered by the labels, for _has_is_a (so as the rules do not insert them) and by
+    # the is_a_closure view stored when extracting the results. The labels are updated with the rows added since
+    # the previous execution, and computed again when they have doubled (the new numbers fragment the intervals).
+    labels = model.is_a_labels
+    if labels is None:
+      labels = model.is_a_labels = IntervalLabels(cursor.execute("""SELECT s,o FROM is_a WHERE 1%s""" % self.sql_where).fetchall())
+      labels.last_rowid = cursor.execute("""SELECT MAX(rowid) FROM is_a""").fetchone()[0] or 0
+      grown = [(node, intervals) for node, intervals in labels.node_2_intervals.items()]
+    else:
+      edges = cursor.execute("""SELECT rowid,s,o FROM is_a WHERE rowid>?%s""" % self.sql_where, (labels.last_rowid,)).fetchall()
+      if edges: labels.last_rowid = max(edges)[0]
+      grown = labels.add_edges((s, o) for (rowid, s, o) in edges)
+      if labels.nb_added_edges > labels.nb_edges:
+        previous_labels = labels
+        labels = model.is_a_labels = IntervalLabels(cursor.execute("""SELECT s,o FROM is_a WHERE 1%s""" % self.sql_where).fetchall())
+        labels.last_rowid    = previous_labels.last_rowid
+        labels.targets       = previous_labels.targets
+        labels.target_rowids = previous_labels.target_rowids
+        grown = [(node, labels.node_2_intervals[node]) for node, intervals in grown] # Same closure, but new numbers
+        
+    news = set()
+    for node, intervals in grown:
+      if (node < 0) or (node in labels.targets): news.update((s, node) for s in labels.nodes(intervals) if s != node)
+    for target in self._new_targets(model, cursor, labels):
+      intervals = labels.node_2_intervals.get(target)
+      if intervals: news.update((s, target) for s in labels.nodes(intervals) if s != target)
+    if not news: return 0, None
+    
+    cursor.executemany("""INSERT OR IGNORE INTO is_a VALUES (?,?,2)""", news)
+    nb = cursor.rowcount
+    labels.last_rowid = cursor.execute("""SELECT MAX(rowid) FROM is_a""").fetchone()[0] # Our own rows are already labelled
+    return nb, None
+  
+  def _new_targets(self, model, cursor, labels):
+    targets = []
+    if not owl_nothing in labels.targets: targets.append(owl_nothing)
+    tables = [(table.name, "value") for table in model.rule_set.tables.values() if isinstance(table, ObjectRestrictionTable)]
+    tables.extend((l.flat.table.name, "o") for l in model.rule_set.lists.values() if l.flat)
+    for table_name, column in tables:
+      try:
+        rows = cursor.execute("""SELECT rowid,%s FROM %s WHERE rowid>? AND %s>0""" % (column, table_name, column), (labels.target_rowids.get(table_name, 0),)).fetchall()
+      except sqlite3.OperationalError: continue # Not created, e.g. when the list builtin is not in the rule set
+      if not rows: continue
+      labels.target_rowids[table_name] = max(rows)[0]
+      targets.extend(target for (rowid, target) in rows if not target in labels.targets)
+    labels.targets.update(targets)
+    return targets
+  
+  
 class BuiltinRemoveSingleParentClass(Builtin):
   def execute(self, model, cursor):
     max_rowid = cursor.execute("""SELECT max(rowid) FROM is_a""").fetchone()[0]
     r = cursor.execute("""SELECT rowid,s,o FROM is_a WHERE s>0 AND rowid!=? GROUP BY s HAVING COUNT(o)=1""", (max_rowid,)).fetchall()
     rowids = [(i[0],) for i in r]
     cursor.executemany("""DELETE FROM is_a WHERE rowid=?""", rowids)
+    model._reset_delta_tables()
     
     nb = -2 * len(rowids)
     return nb, None
     
 #############    SQL CLASSES  ##################
 
+def _col_ref(x):
+  if isinstance(x, SQLColRef): return x
+  if isinstance(x, Variable) and x.refs: return x.refs[0]
+  
+def _is_indexed_column(table, column):
+  # Leading columns of the indexes created by ReasonedModel and the builtins
+  if column == "s": return not table.name.startswith("linked_lists_")
+  return column in ("o", "value", "o1", "o2")
+
 
 class SQLBase(object):
   def __repr__(self):
     return "<%s %s>" % (self.__class__.__name__, str(self))
   
-class SQLRequest(SQLBase): pass
-
+class SQLRequest(SQLBase):
+  def _prepare_selects(self): pass
+  
+  def _union(self, selects): return "\n  UNION ALL\n".join(selects)
+  
+  def with_last_inference_conditions(self, rule_set, rule):
+    self._prepare_selects()
+    self.last_inference_tables  = []
+    self.last_inference_sql_ifs = []
+    selects = []
+    for sql_if in self.sql_ifs:
+      sql_if_selects = sql_if.with_last_inference_conditions(self.last_inference_tables, rule_set, rule)
+      selects.extend(sql_if_selects)
+      self.last_inference_sql_ifs.extend(sql_if for select in sql_if_selects)
+    return self._union(selects)
+  
+  def with_delta_tables(self, rule_set, rule):
+    self._prepare_selects()
+    self.delta_tables       = []
+    self.delta_param_tables = []
+    self.delta_sql_ifs      = []
+    self.delta_complete     = True # True if all the branches depend on a delta table
+    self.delta_selects      = [] # The branches depending on a delta table only, see ReasonedModel._dred_over_delete()
+    selects = []
+    for sql_if in self.sql_ifs:
+      sql_if_selects = sql_if.with_delta_tables(self.delta_tables, self.delta_param_tables, rule_set)
+      if not sql_if_selects: # No inferrable table => the full select is needed
+        sql_if_selects = [str(sql_if)]
+        self.delta_complete = False
+      else:
+        self.delta_selects.extend(sql_if_selects)
+      selects.extend(sql_if_selects)
+      self.delta_sql_ifs.extend(sql_if for select in sql_if_selects)
+    return self._union(selects)
+  
 class SQLInsertRequest(SQLRequest):
   def __init__(self):
     self.sql_inserts = []
     self.sql_ifs     = []
     
   def __str__(self):
-    if (len(self.sql_inserts) == 1) and self.sql_inserts[0].table: return "%s\n%s" % (self.sql_inserts[0], "\n  UNION ALL\n".join(str(i) for i in self.sql_ifs))
-    for i in self.sql_ifs: i.sql_select.select_only_vars = True
-    return "\n  UNION ALL\n".join(str(i) for i in self.sql_ifs)
+    self._prepare_selects()
+    return self._union([str(i) for i in self.sql_ifs])
   
-  def with_last_inference_conditions(self, rule_set, rule):
-    self.last_inference_tables = []
-    if (len(self.sql_inserts) == 1) and self.sql_inserts[0].table: return "%s\n%s" % (self.sql_inserts[0], "\n  UNION ALL\n".join(i.with_last_inference_conditions(self.last_inference_tables, rule_set, rule) for i in self.sql_ifs))
+  def _prepare_selects(self):
+    if (len(self.sql_inserts) == 1) and self.sql_inserts[0].table: return
     for i in self.sql_ifs: i.sql_select.select_only_vars = True
-    return "\n  UNION ALL\n".join(i.with_last_inference_conditions(self.last_inference_tables, rule_set, rule) for i in self.sql_ifs)
+    
+  def _union(self, selects):
+    if (len(self.sql_inserts) == 1) and self.sql_inserts[0].table: return "%s\n%s" % (self.sql_inserts[0], "\n  UNION ALL\n".join(selects))
+    return "\n  UNION ALL\n".join(selects)
     
 class SQLSelectRequest(SQLRequest):
   def __init__(self):
@@ -625,10 +936,6 @@ class SQLSelectRequest(SQLRequest):
     
   def __str__(self): return "\n  UNION ALL\n".join(str(i) for i in self.sql_ifs)
   
-  def with_last_inference_conditions(self, rule_set, rule):
-    self.last_inference_tables = []
-    return "\n  UNION ALL\n".join(i.with_last_inference_conditions(self.last_inference_tables, rule_set, rule) for i in self.sql_ifs)
-    
 class SQLInsert(SQLBase):
   def __init__(self, table, list = None):
     self.table                    = table
@@ -644,6 +951,9 @@ class SQLInsert(SQLBase):
 
   
 class SQLIf(SQLBase):
+  join_order = None # Set by the JoinPlanner while generating the SQL
+  planner    = None
+  
   def __init__(self):
     self.sql_select = SQLSelect()
     self.sql_froms     = []
@@ -675,7 +985,8 @@ class SQLIf(SQLBase):
     if self.sql_not_is_as: s += ("".join("\nAND   %s" % i for i in self.sql_not_is_as))
     return s
   
-  def ordered_sql_from(self):
+  def ordered_sql_from(self): # Without a JoinPlanner (explain or plan_joins = False), the static priorities of IfRule.load() order the joins
+    if self.join_order: return " CROSS JOIN ".join(str(x) for x in self.join_order)
     remnants = set(self.sql_froms)
     for sql_froms, priority in self.sql_from_priorities: remnants.difference_update(sql_froms)
     remnants = [sql_from for sql_from in self.sql_froms if sql_from in remnants]
@@ -700,8 +1011,8 @@ class SQLIf(SQLBase):
     for sql_from in self.sql_froms:
       if sql_from.i == i: return sql_from
       
-  def with_last_inference_conditions(self, last_inference_tables, rule_set, rule):
-    last_inference_conditions = []
+  def _last_inference_froms(self, rule_set):
+    last_inference_froms = []
     
     is_a_i = { sql_from.i for sql_from in self.sql_froms if sql_from.table.name == "is_a" }
     
@@ -732,11 +1043,13 @@ class SQLIf(SQLBase):
                       needed = False
                       break
                     
-      if needed:
-        last_inference_tables.append(sql_from.table)
-        last_inference_condition = "q%s.rowid>?" % sql_from.i
-        last_inference_conditions.append(last_inference_condition)
-        
+      if needed: last_inference_froms.append(sql_from)
+    return last_inference_froms
+  
+  def with_last_inference_conditions(self, last_inference_tables, rule_set, rule):
+    last_inference_froms      = self._last_inference_froms(rule_set)
+    last_inference_conditions = ["q%s.rowid>?" % sql_from.i for sql_from in last_inference_froms]
+    
     s = "%s" % self.sql_select
     if self.sql_froms:
       s += "\nFROM %s" % self.ordered_sql_from()
@@ -745,19 +1058,18 @@ class SQLIf(SQLBase):
       if self.sql_wheres: s0 = s + "\nWHERE " + (" AND ".join(str(i) for i in self.sql_wheres)) + "\nAND  "
       else:               s0 = s + "\nWHERE"
       
-      last_inference_tables0 = list(last_inference_tables)
-      last_inference_tables2 = []
       l = []
       conditions = []
       for i, last_inference_condition in enumerate(last_inference_conditions):
         l.append("%s %s" % (s0, " AND ".join(conditions + [last_inference_condition])))
         conditions.append(last_inference_condition.replace(">", "<="))
-        last_inference_tables2.extend(last_inference_tables0[:i + 1])
-      last_inference_tables.__init__(last_inference_tables2)
+        last_inference_tables.extend(sql_from.table for sql_from in last_inference_froms[:i + 1])
+        
+      if self.sql_not_is_as: l = [select + ("".join("\nAND   %s" % i for i in self.sql_not_is_as)) for select in l]
+      return l
     
-      s = """\n  UNION ALL\n""".join(l)
-      
-    elif last_inference_conditions:
+    last_inference_tables.extend(sql_from.table for sql_from in last_inference_froms)
+    if last_inference_conditions:
       if self.sql_wheres:
         s += "\nWHERE " + (" AND ".join(str(i) for i in self.sql_wheres)) + "\nAND   (%s)" % " OR ".join(last_inference_conditions)
       else:
@@ -766,9 +1078,64 @@ class SQLIf(SQLBase):
       if self.sql_wheres:
         s += "\nWHERE " + (" AND ".join(str(i) for i in self.sql_wheres))
     if self.sql_not_is_as: s += ("".join("\nAND   %s" % i for i in self.sql_not_is_as))
-    return s
-
-  def explanation_select(self):
+    return [s]
+  
+  def with_delta_tables(self, delta_tables, delta_param_tables, rule_set):
+    # Semi-naive evaluation: one branch per delta position; the positions before it are restricted to old rows,
+    # so as each new match is produced by a single branch.
+    delta_froms = self._last_inference_froms(rule_set)
+    
+    l = []
+    for n, delta_from in enumerate(delta_froms):
+      sql_froms = self._delta_join_order(delta_from)
+      froms     = ["delta_%s q%s" % (delta_from.table.name, delta_from.i)] + [str(sql_from) for sql_from in sql_froms[1:]]
+      # The delta table is shared by the rules and may start before the last inference of this rule
+      wheres    = [str(i) for i in self.sql_wheres] + ["q%s.rowid>?" % delta_from.i] + ["q%s.rowid<=?" % old_from.i for old_from in delta_froms[:n]]
+      delta_param_tables.append(delta_from.table)
+      delta_param_tables.extend(old_from.table for old_from in delta_froms[:n])
+      
+      s = "%s\nFROM %s" % (self.sql_select, " CROSS JOIN ".join(froms))
+      if wheres: s += "\nWHERE " + (" AND ".join(wheres))
+      if self.sql_not_is_as: s += ("".join("\nAND   %s" % i for i in self.sql_not_is_as))
+      l.append(s)
+      
+      if not delta_from.table in delta_tables: delta_tables.append(delta_from.table)
+    return l
+  
+  def _delta_join_order(self, first):
+    # The delta table is small => use it as the outer loop, and then join the other tables
+    # following the conditions, favoring indexed columns and constants
+    if self.planner: return self.planner.join_order(self, first)
+    
+    i_2_links = defaultdict(list)
+    bound_is  = set()
+    for sql_where in self.sql_wheres:
+      if sql_where.operator != "=": continue
+      x1 = _col_ref(sql_where.x1)
+      x2 = _col_ref(sql_where.x2)
+      if x1 and x2:
+        i_2_links[x1.i].append((x2.i, x1.column))
+        i_2_links[x2.i].append((x1.i, x2.column))
+      elif x1: bound_is.add(x1.i)
+      elif x2: bound_is.add(x2.i)
+      
+    sql_froms = [first]
+    remnants  = [sql_from for sql_from in self.sql_froms if not sql_from is first]
+    while remnants:
+      joined_is = { sql_from.i for sql_from in sql_froms }
+      def join_cost(sql_from):
+        indexed = connected = False
+        for i, column in i_2_links[sql_from.i]:
+          if i in joined_is:
+            connected = True
+            if _is_indexed_column(sql_from.table, column): indexed = True
+        return (not connected, not indexed, not sql_from.i in bound_is)
+      sql_from = min(remnants, key = join_cost)
+      sql_froms.append(sql_from)
+      remnants.remove(sql_from)
+    return sql_froms
+  
+  def explanation_sources(self): # (table name, rowid SQL) pairs
       is_a_i = { sql_from.i for sql_from in self.sql_froms if sql_from.table.name == "is_a" }
       
       ref_2_var = {}
@@ -794,9 +1161,9 @@ class SQLIf(SQLBase):
                 needed = False
                 break
         if needed:
-          rowids.append("'%s:'||q%s.rowid" % (sql_from.table.name, sql_from.i))
+          rowids.append((sql_from.table.name, "q%s.rowid" % sql_from.i))
           
-      return ("||','||".join(rowids)).replace(",'||'", ",") or "''"
+      return rowids
 
 class SQLSelect(SQLBase):
   def __init__(self, xs = None):
@@ -875,15 +1242,19 @@ class Variable(object):
 #i
     
 class IfRule(Rule):
-  sql0_explain = sql1_explain = None
+  sql0_explain = sql1_explain = sql_delta_explain = None
+  explanation_vars = None
   def full_repr(self):
     return """    %%%%%% %s %s "%s":\n%s;\n    %% dependss = %s\n    %% creates = %s\n""" % (self.type, self.__class__.__name__, self.name, self.sql1 or "", self.dependss, self.creates)
   
   def copy(self):
     clone = super().copy()
     clone.last_inferences = {}
+    clone.join_plans      = {} # bucket => planned SQL, see JoinPlanner
     return clone
   
+  def _explanation_width(self): return max([len(sql_if.explanation_sources()) for sql_if in self.sql.sql_ifs] or [0]) # Number of sources
+  
   def load(self, rule_set, options, type, *datas):
     self.dependss             = []
     self.creates              = set()
@@ -1231,18 +1602,52 @@ class IfRule(Rule):
     self.sql0 = str(self.sql)
     self.sql1 = self.sql.with_last_inference_conditions(rule_set, self)
     self.last_inference_tables = self.sql.last_inference_tables
-    
-    
+    self.sql_delta          = self.sql.with_delta_tables(rule_set, self)
+    self.delta_tables       = self.sql.delta_tables
+    self.delta_param_tables = self.sql.delta_param_tables
+    self.sql_dred           = "\n  UNION ALL\n".join(self.sql.delta_selects) or None # SELECT only, with the params of sql_delta
+    self.from_tables        = { sql_from.table.name for sql_if in self.sql.sql_ifs for sql_from in sql_if.sql_froms }
+    
+  def _get_sql(self, model, explain = False):
+    if model.planner and self.sql0 and not explain: # The static SQL is kept, e.g. for the session signature
+      sql0, sql1, last_inference_tables, sql_delta, delta_param_tables = model.planner.plan(self)
+    else:
+      sql0, sql1, last_inference_tables, sql_delta, delta_param_tables = self.sql0, self.sql1, self.last_inference_tables, self.sql_delta, self.delta_param_tables
+      
+    if not self.last_inferences:
+      if explain:
+        if not self.sql0_explain: self.sql0_explain = self._build_explain_sql(model, sql0, self.sql.sql_ifs)
+        return self.sql0_explain, ()
+      return sql0, ()
+    
+    if model.semi_naive:
+      has_delta = False
+      for table in self.delta_tables:
+        if model.update_delta_table(table, self): has_delta = True
+      if (not has_delta) and self.sql.delta_complete: return None, None # Nothing new
+      
+      params = tuple(self.last_inferences[table] for table in delta_param_tables)
+      if explain:
+        if not self.sql_delta_explain: self.sql_delta_explain = self._build_explain_sql(model, sql_delta, self.sql.delta_sql_ifs)
+        return self.sql_delta_explain, params
+      return sql_delta, params
+    
+    params = tuple(self.last_inferences[table] for table in last_inference_tables)
+    if explain:
+      if not self.sql1_explain: self.sql1_explain = self._build_explain_sql(model, sql1, self.sql.last_inference_sql_ifs)
+      return self.sql1_explain, params
+    return sql1, params
+  
+  
 class IfRaiseRule(IfRule):
   def execute(self, model, cursor):
     if model.debug:
       self.total_matches += len(cursor.execute(self.sql0[self.sql0.find("SELECT"):]).fetchall())
       
-    if not self.last_inferences:
-      r = cursor.execute(self.sql0).fetchone()
-    else:
-      r = cursor.execute(self.sql1, tuple(self.last_inferences[table] for table in self.last_inference_tables)).fetchone()
-      
+    sql, params = self._get_sql(model)
+    if sql is None: return 0, None
+    
+    r = cursor.execute(sql, params).fetchone()
     if r: raise self.error_class
     return 0, None
   
@@ -1293,45 +1698,35 @@ class IfSingleInferRule(IfRule):
     self.table = self.sql.sql_inserts[0].table
     
   def execute(self, model, cursor):
+    sql, params = self._get_sql(model)
+    if sql is None: return 0, None
+    
     if model.debug:
-      if not self.last_inferences:
-        sql = """WITH matches_found AS (%s) SELECT COUNT() FROM matches_found""" % self.sql0[self.sql0.find("SELECT"):]
-        self.total_matches += cursor.execute(sql).fetchone()[0]
-      else:
-        sql = """WITH matches_found AS (%s) SELECT COUNT() FROM matches_found""" % self.sql1[self.sql1.find("SELECT"):]
-        self.total_matches += cursor.execute(sql, tuple(self.last_inferences[table] for table in self.last_inference_tables)).fetchone()[0]
-        
+      count_sql = """WITH matches_found AS (%s) SELECT COUNT() FROM matches_found""" % sql[sql.find("SELECT"):]
+      self.total_matches += cursor.execute(count_sql, params).fetchone()[0]
+      
     if model.explain and ((self.table.name == "is_a") or (self.table.name == "flat_lists_37")):
-      if not self.last_inferences:
-        if not self.sql0_explain: self.sql0_explain = self._build_explain_sql(self.sql0)
-        cursor.execute(self.sql0_explain)
-      else:
-        if not self.sql1_explain: self.sql1_explain = self._build_explain_sql(self.sql1)
-        cursor.execute(self.sql1_explain, tuple(self.last_inferences[table] for table in self.last_inference_tables))
-
-    if not self.last_inferences:
-      cursor.execute(self.sql0)
-    else:
-      cursor.execute(self.sql1, tuple(self.last_inferences[table] for table in self.last_inference_tables))
-
+      cursor.execute(*self._get_sql(model, True))
+      
+    cursor.execute(sql, params)
     return cursor.rowcount, None
   
-  def _build_explain_sql(self, base_sql):
+  def dred_heads(self, var_values): return [(self.table, var_values)] # The rows inserted for the given SELECT result
+  
+  def _build_explain_sql(self, model, base_sql, sql_ifs):
+    provenance = model.provenance
+    width      = self._explanation_width()
     sql = ""
-    current_if = 0
-    for select in base_sql.split("SELECT")[1:]:
+    for select, sql_if in zip(base_sql.split("SELECT")[1:], sql_ifs):
       select_part, end = select.split("FROM", 1)
       select_part = select_part.split(",")[:-1] # Remove l (=level)
+      if len(select_part) == 1: select_part.append("NULL")
       
-      sql_if = self.sql.sql_ifs[current_if]
-      current_if += 1
-      if current_if >= len(self.sql.sql_ifs): current_if = 0
-      
-      rowids = sql_if.explanation_select()
-      select = """SELECT '%s',%s,'%s',%s FROM %s""" % (self.table.name, "," .join(select_part), self.name, rowids, end)
+      sources = provenance.select_sources(sql_if.explanation_sources(), width)
+      select = """SELECT %s,%s,%s,%s FROM %s""" % (provenance.id(self.table.name), "," .join(select_part), provenance.id(self.name), sources, end)
       sql += select
 
-    return """INSERT INTO explanations %s""" % sql
+    return """%s %s""" % (provenance.insert_sql(width), sql)
     
   
 
@@ -1347,7 +1742,7 @@ class IfMultipleInferRule(IfRule):
     self.already_done = set()
 
     if not self.sql.sql_ifs[0].sql_froms: # empty SQL request
-      self.sql0 = self.sql1 = None
+      self.sql0 = self.sql1 = self.sql_delta = None
     
     self.sql_select_vars = self.sql.sql_ifs[0].sql_select.var_xs
     self.clause_rest_var = self.sql.sql_ifs[0].vars.get("?...")
@@ -1374,41 +1769,77 @@ class IfMultipleInferRule(IfRule):
     if self.sql0:
       if model.debug: t0 = time.time()
       
-      if model.explain:
-        if not self.last_inferences:
-          if not self.sql0_explain: self.sql0_explain = self._build_explain_sql(self.sql0)
-          r = cursor.execute(self.sql0_explain).fetchall()
-        else:
-          if not self.sql1_explain: self.sql1_explain = self._build_explain_sql(self.sql1)
-          r = cursor.execute(self.sql1_explain, tuple(self.last_inferences[table] for table in self.last_inference_tables)).fetchall()
-      else:
-        if not self.last_inferences:
-          r = cursor.execute(self.sql0).fetchall()
-        else:
-          r = cursor.execute(self.sql1, tuple(self.last_inferences[table] for table in self.last_inference_tables)).fetchall()
-          
+      sql, params = self._get_sql(model, model.explain)
+      if sql is None: r = []
+      else:           r = cursor.execute(sql, params).fetchall()
+      
       if model.debug: self.search_time += time.time() - t0
       
     else:
       r = [()] # Assertion with an empty 'if' clause
       
-    if model.debug: self.total_matches += len(r)
+    self.total_matches += len(r) # Free here, contrary to IfSingleInferRule which needs a COUNT() query
+    
+    rows = [var_values for var_values in dict.fromkeys(r) if not var_values in self.already_done]
+    return self.execute_rows(model, cursor, rows)
+  
+  def execute_rows(self, model, cursor, rows):
+    self.already_done.update(rows)
     
     nb_hit = nb_rows = 0
     added_nb_inferences = defaultdict(int)
-    for var_values in r:
-      if var_values in self.already_done: continue
-      self.already_done.add(var_values)
-      
-      self._execute_one_select_result(model, cursor, added_nb_inferences, var_values)
-      nb_rows2 = sum(added_nb_inferences.values())
-      if nb_rows2 != nb_rows:
-        nb_rows = nb_rows2
-        nb_hit += 1
-
+    if not rows: return nb_hit, added_nb_inferences
+    
+    if self.clause_list: clause_rests = self._get_clause_rests(cursor, rows)
+    else:                clause_rests = None
+    blanks = iter(model.new_blank_nodes(len(rows) * len(self.new_vars)))
+    
+    batch = model._batch = InsertBatch(model, cursor, added_nb_inferences)
+    if len(rows) > 1:
+      var_2_values = [dict(zip(self.sql_select_vars, var_values)) for var_values in rows]
+      for sql_insert in self._get_prefetchable_inserts():
+        sql_insert.table.prefetch(batch, cursor, sql_insert, var_2_values)
+    try:
+      for var_values in rows:
+        self._execute_one_select_result(model, cursor, added_nb_inferences, var_values, clause_rests, blanks)
+        nb_rows2 = sum(added_nb_inferences.values()) + batch.nb_queued
+        if nb_rows2 != nb_rows:
+          nb_rows = nb_rows2
+          nb_hit += 1
+    finally:
+      batch.flush()
+      model._batch = None
+      
+    if not sum(added_nb_inferences.values()): nb_hit = 0 # All pending insertions were already present
     return nb_hit, added_nb_inferences
   
-  def _execute_one_select_result(self, model, cursor, added_nb_inferences, var_values):
+  def _get_prefetchable_inserts(self): # The lookups that only depend on the SELECT results
+    select_vars = set(self.sql_select_vars)
+    defined     = select_vars | self.new_vars
+    sql_inserts = []
+    for sql_insert in self.sql_inserts:
+      insert_vars = { x for x in sql_insert.xs if isinstance(x, Variable) }
+      if (not sql_insert.list) and sql_insert.has_non_condition_var and ((insert_vars & defined) <= select_vars): sql_inserts.append(sql_insert)
+      defined.update(insert_vars)
+    return sql_inserts
+  
+  def dred_heads(self, var_values): # The rows inserted in the tables for the given SELECT result, None for the values created during execution
+    var_2_value = dict(zip(self.sql_select_vars, var_values))
+    return [(sql_insert.table, tuple(var_2_value.get(x) if isinstance(x, Variable) else int(x) for x in sql_insert.xs))
+            for sql_insert in self.sql_inserts if not sql_insert.list]
+  
+  def _get_clause_rests(self, cursor, rows):
+    clause_rests = defaultdict(list)
+    for sql_from, var_s, var_o in self.clause_sql_froms_vars:
+      i_s = self.sql_select_vars.index(var_s)
+      i_o = self.sql_select_vars.index(var_o)
+      ss  = sorted({ var_values[i_s] for var_values in rows if var_values[i_s] != var_values[i_o] })
+      for i in range(0, len(ss), 500):
+        for s, o in cursor.execute("""SELECT s,o FROM %s WHERE s IN (%s)""" % (sql_from.table.name, ",".join(str(s) for s in ss[i : i + 500]))):
+          clause_rests[sql_from.table, s].append(o)
+    return clause_rests
+  
+  def _execute_one_select_result(self, model, cursor, added_nb_inferences, var_values, clause_rests, blanks):
     var_2_value = dict(zip(self.sql_select_vars, var_values))
     
     if self.clause_list:
@@ -1417,9 +1848,7 @@ class IfMultipleInferRule(IfRule):
         s = var_2_value[var_s]
         o = var_2_value[var_o]
         if s != o:
-          clause_rest.extend(x[0] for x in
-                             cursor.execute("""SELECT o FROM %s WHERE s=?""" % sql_from.table.name, (s,))
-                             if x[0] != o)
+          clause_rest.extend(x for x in clause_rests[sql_from.table, s] if x != o)
           
       if self.clause_pattern:
         pattern_var_2_value = var_2_value.copy()
@@ -1443,7 +1872,7 @@ class IfMultipleInferRule(IfRule):
     #     d.add("%s=%s" % (var.name, v2))
     #   print(d)
     
-    for var in self.new_vars: var_2_value[var] = model.new_blank_node()
+    for var in self.new_vars: var_2_value[var] = next(blanks)
     
     for sql_insert_i, sql_insert in enumerate(self.sql_inserts):
       if not self._execute_one_sql_insert(model, cursor, added_nb_inferences, var_2_value, sql_insert_i, sql_insert):
@@ -1485,14 +1914,8 @@ class IfMultipleInferRule(IfRule):
       
       var_2_value[sql_insert.xs[0]] = sql_insert.list.add(model, cursor, added_nb_inferences, elements, s)
       
-      if model.explain and (sql_insert.list.rel == owl_members):
-        if self.sql0: sources = var_2_value[self.sql_select_vars[-1]]
-        else:         sources = ""
-        cursor.execute("""INSERT INTO explanations VALUES (?,?,?,?,?)""",
-                       ("flat_lists_37",
-                        s,
-                        ",".join(str(e) for e in elements),
-                        self.name, sources))
+      if model.explain and (sql_insert.list.rel == owl_members): # The elements are those of the list s, in flat_lists_37
+        model.provenance.add("flat_lists_37", var_2_value[sql_insert.xs[0]], None, self.name, self._explanation_sources(var_2_value))
         
     else:
       # reusable_s = None
@@ -1514,29 +1937,29 @@ class IfMultipleInferRule(IfRule):
       if not sql_insert.table.add(model, cursor, added_nb_inferences, var_2_value, sql_insert): return False
       
       if model.explain and (sql_insert.table.name == "is_a"):
-        if self.sql0: sources = var_2_value[self.sql_select_vars[-1]]
-        else:         sources = ""
-        cursor.execute("""INSERT INTO explanations VALUES (?,?,?,?,?)""",
-                       (sql_insert.table.name,
-                        var_2_value.get(sql_insert.xs[0]) or sql_insert.xs[0],
-                        var_2_value.get(sql_insert.xs[1]) or sql_insert.xs[1],
-                        self.name, sources))
+        model.provenance.add(sql_insert.table.name,
+                             var_2_value.get(sql_insert.xs[0]) or sql_insert.xs[0],
+                             var_2_value.get(sql_insert.xs[1]) or sql_insert.xs[1],
+                             self.name, self._explanation_sources(var_2_value))
     return True
           
-  def _build_explain_sql(self, base_sql):
-    if self.sql_select_vars[-1].name != "?_sources": self.sql_select_vars.append(Variable("?_sources"))
-    
+  def _explanation_sources(self, var_2_value): # (table id, rowid) pairs, selected by the explain SQL
+    if not self.sql0: return []
+    values = [var_2_value.get(var) for var in self.explanation_vars]
+    return list(zip(values[0::2], values[1::2]))
+  
+  def _build_explain_sql(self, model, base_sql, sql_ifs):
+    width = self._explanation_width()
+    if not self.explanation_vars:
+      self.explanation_vars = [Variable("?_source_%s" % i) for i in range(2 * width)]
+      self.sql_select_vars  = self.sql_select_vars + self.explanation_vars # Not in place, the SQLSelect is shared
+      
     sql = ""
-    current_if = 0
-    for select in base_sql.split("SELECT")[1:]:
+    for select, sql_if in zip(base_sql.split("SELECT")[1:], sql_ifs):
       select_part, end = select.split("FROM", 1)
       
-      sql_if = self.sql.sql_ifs[current_if]
-      current_if += 1
-      if current_if >= len(self.sql.sql_ifs): current_if = 0
-      
-      rowids = sql_if.explanation_select()
-      select = """SELECT %s,%s FROM %s""" % (select_part, rowids, end)
+      sources = model.provenance.select_sources(sql_if.explanation_sources(), width)
+      select = """SELECT %s,%s FROM %s""" % (select_part, sources, end)
       sql += select
     return sql
         
@@ -1746,6 +2169,15 @@ class RuleSet(object):
       if   decl.value == "PREPROCESS": self.stages[-1].preprocesses.append(rule)
       elif decl.value == "COMPLETION": self.stages[-1].completions .append(rule)
       
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    if "create_2_tables" in state: state["create_2_tables"] = dict(state["create_2_tables"]) # The default factory is a lambda
+    return state
+  
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if "create_2_tables" in state: self.create_2_tables = defaultdict(lambda : [self.tables["inferred_objs"]], state["create_2_tables"])
+    
   def tailor_for(self, model):
     has_prop = { rdf_type : True, rdfs_subclassof : True, rdfs_subpropertyof : True }
 
@@ -1773,13 +2205,87 @@ class RuleSet(object):
 
 
 RULE_SETS = {}
-def get_rule_set(filename):
-  rule_set = RULE_SETS.get(filename)
+
+# The 'reduced' is_a storage keeps the is_a closure as the interval labels of an is_a TransitiveClosure rule
+IS_A_CLOSURE_RULE = """\nCOMPLETION HIGH_PRIORITY "is_a_transitivity" BUILTIN "TransitiveClosure" { <http://www.w3.org/2000/01/rdf-schema#subClassOf> }\n"""
+_IS_A_CLOSURE_RE  = re.compile(r"""BUILTIN\s+"TransitiveClosure"\s*{[^}]*#subClassOf>""")
+def get_rule_set_cache_dir(): # The cache is opt-in, because the cached rule sets are unpickled
+  return os.environ.get("SEMANTIC2SQL_CACHE_DIR") or None
+
+def _rule_set_cache_key(rules_txt):
+  h = hashlib.sha1()
+  h.update(owlready2.VERSION.encode("utf8"))
+  h.update(rules_txt.encode("utf8"))
+  return h.hexdigest()
+
+def _module_digest(module_name):
+  with open(sys.modules[module_name].__file__, "rb") as f: return hashlib.sha1(f.read()).hexdigest()
+
+class _ModuleRecordingPickler(pickle.Pickler):
+  # Records the modules of this package whose classes are pickled; the compiled rules depend on their code
+  def __init__(self, f):
+    pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+    self.modules = set()
+    
+  def reducer_override(self, obj):
+    module = obj.__module__ if isinstance(obj, type) else type(obj).__module__
+    if module.startswith(__package__ + "."): self.modules.add(module)
+    return NotImplemented
+  
+def _load_cached_rule_set(cache_file):
+  # The cache file contains the digests of the modules of the pickled instances and the abbreviated IRIs,
+  # checked before unpickling the rule set
+  try:
+    with open(cache_file, "rb") as f:
+      module_digests, abbreviated_iris = pickle.load(f)
+      for module_name, digest in module_digests.items():
+        if (not module_name in sys.modules) or (_module_digest(module_name) != digest): return None
+      for iri, storid in abbreviated_iris.items():
+        if (local_abbrevs.get(iri) or owlready2.default_world._abbreviate(iri)) != storid: return None
+      return pickle.load(f)
+  except Exception: return None # Missing, or unreadable (e.g. truncated)
+  
+def _save_cached_rule_set(cache_file, abbreviated_iris, rule_set):
+  try:
+    data     = io.BytesIO()
+    pickler  = _ModuleRecordingPickler(data)
+    pickler.dump(rule_set)
+    
+    os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+    fd, tmp_file = tempfile.mkstemp(dir = os.path.dirname(cache_file), suffix = ".tmp")
+    try:
+      with os.fdopen(fd, "wb") as f:
+        module_names = pickler.modules | { __package__ + ".rule", __package__ + ".rule_parser" } # And the compiler
+        pickle.dump(({ module_name : _module_digest(module_name) for module_name in module_names }, abbreviated_iris), f, pickle.HIGHEST_PROTOCOL)
+        f.write(data.getvalue())
+      os.replace(tmp_file, cache_file) # Atomic, for concurrent processes
+    except:
+      os.unlink(tmp_file)
+      raise
+  except Exception: pass # The cache is optional
+  
+def get_rule_set(filename, cache = True, is_a_closure = False):
+  # is_a_closure: adds IS_A_CLOSURE_RULE if the rules have no is_a TransitiveClosure, for the 'reduced' is_a storage
+  key = (filename, "is_a_closure") if is_a_closure else filename
+  rule_set = RULE_SETS.get(key)
   if not rule_set:
     f = open(os.path.join(os.path.dirname(__file__), filename))
-    rule_set = RULE_SETS[filename] = RuleSet()
-    rule_set.load(f.read())
+    rules_txt = f.read()
     f.close()
+    if is_a_closure and not _IS_A_CLOSURE_RE.search(rules_txt): rules_txt += IS_A_CLOSURE_RULE
+    
+    cache_dir = cache and get_rule_set_cache_dir()
+    if cache_dir:
+      cache_file = os.path.join(cache_dir, "%s.pickle" % _rule_set_cache_key(rules_txt))
+      rule_set   = _load_cached_rule_set(cache_file)
+      
+    if not rule_set:
+      ABBREVIATED_IRIS.clear()
+      rule_set = RuleSet()
+      rule_set.load(rules_txt)
+      if cache_dir: _save_cached_rule_set(cache_file, dict(ABBREVIATED_IRIS), rule_set)
+      
+    RULE_SETS[key] = rule_set
   return rule_set
 
 
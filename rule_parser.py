@@ -229,7 +229,7 @@ def get_parsers():
     if p[0].value == "NOT_is_a": return "NOT_is_a"
     p[0].value        = abbrev_2_iri.get(p[0].value, p[0].value)
     iri = p[0].value[1:-1]
-    if iri.startswith("http://"): p[0].storid = local_abbrevs.get(iri) or owlready2.default_world._abbreviate(iri)
+    if iri.startswith("http://"): p[0].storid = ABBREVIATED_IRIS[iri] = local_abbrevs.get(iri) or owlready2.default_world._abbreviate(iri)
     else:                         p[0].storid = 0
     p[0].parsed_value = p[0].storid
     return p[0]
@@ -396,6 +396,8 @@ table_name_without_p = {
   "infer_ancestors",
 }
 
+ABBREVIATED_IRIS = {} # IRI => storid, for the IRIs found while parsing (storids may differ in another process)
+
 local_abbrevs = {
   "http://www.lesfleursdunormal.fr/static/_downloads/owlready_ontology.owl#andor" : andor,
   "http://www.lesfleursdunormal.fr/static/_downloads/owlready_ontology.owl#infer_descendants" : infer_descendants,
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq, itertools
+
+
+class Scheduler(object):
+  # Set of candidate rules, popped by increasing key(rule); the default key is the rule priority.
+  # Keys are computed when a rule is added, and again when a waiting rule is added anew (i.e. the tables it depends on grew),
+  # so as a rule whose key decreased is promoted. Keys are also checked when the rule is popped (lazy update),
+  # for the keys that increase while the rule is waiting (e.g. nb_execution).
+  def __init__(self, model, rules = ()):
+    self.model   = model
+    self.heap    = []
+    self.keys    = {} # Waiting rule => key of its valid heap entry
+    self.counter = itertools.count()
+    for rule in rules: self.add(rule)
+
+  def key(self, rule): return (rule.priority, rule.nb_execution, rule.complexity, rule.name)
+
+  def add(self, rule):
+    key = self.key(rule)
+    old_key = self.keys.get(rule)
+    if (not old_key is None) and (old_key <= key): return # The old entry is popped first anyway
+    self.keys[rule] = key # The old entry, if any, is now stale
+    heapq.heappush(self.heap, (key, next(self.counter), rule))
+
+  def discard(self, rule): self.keys.pop(rule, None) # The heap entry is removed when popped
+
+  def remove(self, rule): del self.keys[rule]
+
+  def __contains__(self, rule): return rule in self.keys
+
+  def __len__(self): return len(self.keys)
+
+  def __iter__(self): return iter(self.keys)
+
+  def pop(self):
+    heap = self.heap
+    while heap:
+      key, i, rule = heapq.heappop(heap)
+      if self.keys.get(rule) != key: continue # Discarded, already popped, or replaced by a newer entry
+      current_key = self.key(rule)
+      if (current_key != key) and heap and (current_key > heap[0][0]):
+        self.keys[rule] = current_key
+        heapq.heappush(heap, (current_key, next(self.counter), rule))
+        continue
+      del self.keys[rule]
+      return rule
+    raise KeyError("pop from an empty scheduler")
+
+
+class PriorityScheduler(Scheduler): pass
+
+class RoundRobinScheduler(Scheduler):
+  def key(self, rule): return (rule.nb_execution, rule.priority, rule.complexity, rule.name)
+
+class DeltaScheduler(Scheduler):
+  # Rules with the most new rows in the tables they depend on first
+  def key(self, rule): return (rule.priority, -self.pending_delta(rule), rule.nb_execution, rule.complexity, rule.name)
+
+  def pending_delta(self, rule):
+    last_inferences = self.model.last_inferences
+    nb = 0
+    for table in set(rule.delta_tables):
+      nb += (last_inferences.get(table) or 0) - (rule.last_inferences.get(table) or 0)
+    return nb
+
+
+SCHEDULERS = {
+  "priority"    : PriorityScheduler,
+  "round_robin" : RoundRobinScheduler,
+  "delta"       : DeltaScheduler,
+}
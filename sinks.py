@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path, csv, sqlite3
+from collections import defaultdict
+from owlready2 import *
+from owlready2.reasoning import _apply_reasoning_results, _INFERRENCES_ONTOLOGY
+
+
+class ResultSink(object):
+  # Receives the inferences of ReasonedModel.run(), chunk by chunk: open(), write() for each chunk, and close().
+  # By default, write() calls add_parent() for each new (child, parent) edge, and the equivalences are gathered
+  # in equivalence classes, given to add_equivalence_class() on close.
+  def __init__(self, iris = True):
+    self.iris = iris
+
+  def open(self, model):
+    self.world           = model.world
+    self.equiv_parents   = {}
+    self.equiv_types     = {}
+
+  def entity(self, storid): # The IRI of the entity, or its storid
+    if self.iris: return self.world._unabbreviate(storid)
+    return storid
+
+  def write(self, new_parents, new_equivs, entity_2_type):
+    for s, parents in new_parents.items():
+      type = entity_2_type[s]
+      for o in parents: self.add_parent(s, o, type)
+    for s, equivs in new_equivs.items():
+      self.equiv_types[s] = entity_2_type[s]
+      for o in equivs: self._union(s, o)
+
+  def _find(self, s):
+    parents = self.equiv_parents
+    root = s
+    while parents.get(root, root) != root: root = parents[root]
+    while s != root: parents[s], s = root, parents[s]
+    return root
+
+  def _union(self, s, o):
+    s = self._find(s)
+    o = self._find(o)
+    if   s < o: self.equiv_parents[o] = s
+    elif o < s: self.equiv_parents[s] = o
+
+  def equivalence_classes(self): # Sorted tuples of storids
+    classes = defaultdict(list)
+    for s in self.equiv_types: classes[self._find(s)].append(s)
+    return [tuple(sorted(c)) for c in classes.values()]
+
+  def add_parent(self, s, o, type): pass
+
+  def add_equivalence_class(self, ss, types): pass
+
+  def close(self):
+    for ss in self.equivalence_classes(): self.add_equivalence_class(ss, [self.equiv_types[s] for s in ss])
+
+
+class WorldSink(ResultSink):
+  # Applies the inferences to the Owlready world and ontology (the default of ReasonedModel.run()).
+  # With keep_results, the inferences are also gathered in new_parents, new_equivs and entity_2_type, as returned
+  # by ReasonedModel.extract_inferences(); this keeps the whole results in memory, hence it is off by default.
+  def __init__(self, ontology = None, debug = 1, keep_results = False):
+    ResultSink.__init__(self, False)
+    self.ontology      = ontology
+    self.debug         = debug
+    self.keep_results  = keep_results
+    self.new_parents   = None
+    self.new_equivs    = None
+    self.entity_2_type = None
+
+  def open(self, model):
+    ResultSink.open(self, model)
+    if   isinstance(self.ontology, Ontology): pass
+    elif CURRENT_NAMESPACES.get():            self.ontology = CURRENT_NAMESPACES.get()[-1].ontology
+    else:                                     self.ontology = self.world.get_ontology(_INFERRENCES_ONTOLOGY)
+    if self.keep_results:
+      self.new_parents   = defaultdict(list)
+      self.new_equivs    = defaultdict(list)
+      self.entity_2_type = {}
+
+  def write(self, new_parents, new_equivs, entity_2_type):
+    _apply_reasoning_results(self.world, self.ontology, self.debug, new_parents, new_equivs, entity_2_type)
+    if self.keep_results:
+      self.new_parents  .update(new_parents)
+      for s, os in new_equivs.items(): self.new_equivs[s].extend(os)
+      self.entity_2_type.update(entity_2_type)
+
+  def close(self): pass
+
+
+class CallbackSink(ResultSink):
+  # Calls on_parent(child, parent, type) for each new edge, and on_equivalence_class(entities, types) for each
+  # equivalence class
+  def __init__(self, on_parent = None, on_equivalence_class = None, iris = True):
+    ResultSink.__init__(self, iris)
+    self.on_parent            = on_parent
+    self.on_equivalence_class = on_equivalence_class
+
+  def add_parent(self, s, o, type):
+    if self.on_parent: self.on_parent(self.entity(s), self.entity(o), type)
+
+  def add_equivalence_class(self, ss, types):
+    if self.on_equivalence_class: self.on_equivalence_class([self.entity(s) for s in ss], types)
+
+
+class CSVSink(ResultSink):
+  # Writes is_a.csv (child, parent, type) and equivalences.csv (class, entity, type) in the directory;
+  # the class of an equivalence is its first entity
+  def __init__(self, directory, iris = True):
+    ResultSink.__init__(self, iris)
+    self.directory = directory
+
+  def open(self, model):
+    ResultSink.open(self, model)
+    os.makedirs(self.directory, exist_ok = True)
+    self.is_a_file = open(os.path.join(self.directory, "is_a.csv"), "w", newline = "")
+    self.is_a      = csv.writer(self.is_a_file)
+    self.is_a.writerow(["child", "parent", "type"])
+
+  def add_parent(self, s, o, type): self.is_a.writerow([self.entity(s), self.entity(o), type])
+
+  def close(self):
+    self.is_a_file.close()
+    with open(os.path.join(self.directory, "equivalences.csv"), "w", newline = "") as f:
+      self.equivalences = csv.writer(f)
+      self.equivalences.writerow(["class", "entity", "type"])
+      ResultSink.close(self)
+
+  def add_equivalence_class(self, ss, types):
+    c = self.entity(ss[0])
+    for s, type in zip(ss, types): self.equivalences.writerow([c, self.entity(s), type])
+
+
+class ParquetSink(ResultSink):
+  # Writes is_a.parquet and equivalences.parquet (same columns as CSVSink) in the directory, one row group
+  # per chunk. Requires pyarrow.
+  def __init__(self, directory, iris = True):
+    import pyarrow, pyarrow.parquet
+    ResultSink.__init__(self, iris)
+    self.directory = directory
+    self.pa        = pyarrow
+    self.pq        = pyarrow.parquet
+
+  def _schema(self, name):
+    column_type = self.pa.string() if self.iris else self.pa.int64()
+    return self.pa.schema([(name, column_type), ("parent" if name == "child" else "entity", column_type), ("type", self.pa.string())])
+
+  def open(self, model):
+    ResultSink.open(self, model)
+    os.makedirs(self.directory, exist_ok = True)
+    self.is_a = self.pq.ParquetWriter(os.path.join(self.directory, "is_a.parquet"), self._schema("child"))
+
+  def write(self, new_parents, new_equivs, entity_2_type):
+    self.columns = ([], [], [])
+    ResultSink.write(self, new_parents, new_equivs, entity_2_type)
+    if self.columns[0]: self.is_a.write_table(self.pa.Table.from_arrays([self.pa.array(column) for column in self.columns], schema = self.is_a.schema))
+
+  def add_parent(self, s, o, type):
+    self.columns[0].append(self.entity(s))
+    self.columns[1].append(self.entity(o))
+    self.columns[2].append(type)
+
+  def add_equivalence_class(self, ss, types):
+    c = self.entity(ss[0])
+    for s, type in zip(ss, types):
+      self.columns[0].append(c)
+      self.columns[1].append(self.entity(s))
+      self.columns[2].append(type)
+
+  def close(self):
+    self.is_a.close()
+    self.columns = ([], [], [])
+    ResultSink.close(self)
+    schema = self._schema("class")
+    self.pq.write_table(self.pa.Table.from_arrays([self.pa.array(column) for column in self.columns], schema = schema), os.path.join(self.directory, "equivalences.parquet"))
+
+
+class SQLiteSink(ResultSink):
+  # Writes the is_a(child, parent, type) and equivalences(class, entity, type) tables in a separate SQLite file
+  def __init__(self, filename, iris = True):
+    ResultSink.__init__(self, iris)
+    self.filename = filename
+
+  def open(self, model):
+    ResultSink.open(self, model)
+    column_type = "TEXT" if self.iris else "INTEGER"
+    self.db = sqlite3.connect(self.filename)
+    self.db.executescript("""
+DROP TABLE IF EXISTS is_a;
+DROP TABLE IF EXISTS equivalences;
+CREATE TABLE is_a (child %s NOT NULL, parent %s NOT NULL, type TEXT NOT NULL);
+CREATE TABLE equivalences (class %s NOT NULL, entity %s NOT NULL, type TEXT NOT NULL);
+""" % (column_type, column_type, column_type, column_type))
+
+  def write(self, new_parents, new_equivs, entity_2_type):
+    self.rows = []
+    ResultSink.write(self, new_parents, new_equivs, entity_2_type)
+    self.db.executemany("""INSERT INTO is_a VALUES (?,?,?)""", self.rows)
+
+  def add_parent(self, s, o, type): self.rows.append((self.entity(s), self.entity(o), type))
+
+  def add_equivalence_class(self, ss, types):
+    c = self.entity(ss[0])
+    self.db.executemany("""INSERT INTO equivalences VALUES (?,?,?)""", [(c, self.entity(s), type) for s, type in zip(ss, types)])
+
+  def close(self):
+    ResultSink.close(self)
+    self.db.execute("""CREATE INDEX is_a_child ON is_a(child)""")
+    self.db.execute("""CREATE INDEX equivalences_entity ON equivalences(entity)""")
+    self.db.commit()
+    self.db.close()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Owlready2
+# Copyright (C) 2019 Jean-Baptiste LAMY
+# LIMICS (Laboratoire d'informatique médicale et d'ingénierie des connaissances en santé), UMR_S 1142
+# University Paris 13, Sorbonne paris-Cité, Bobigny, France
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, re, tempfile
+
+
+_CREATE_TABLE   = re.compile(r"\bCREATE\s+(?:TEMP\s+|TEMPORARY\s+)?(TABLE|INDEX|UNIQUE\s+INDEX)\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)\b(?!\.)", re.I)
+_CREATE_VIEW    = re.compile(r"\bCREATE\s+(?:TEMP\s+|TEMPORARY\s+)?VIEW\b", re.I)
+_UNQUALIFIED    = re.compile(r"""'(?:[^']|'')*'|\bON\s+\w+\s*\(|(?<![.\w])([A-Za-z_]\w*)(?![\w.])""", re.I) # Strings and the table of CREATE INDEX are kept
+_CREATE_TRIGGER = re.compile(r"\s*CREATE\s+(?:TEMP\s+|TEMPORARY\s+)?TRIGGER\b", re.I)
+_DROP_TABLE     = re.compile(r"\bDROP\s+TABLE\s+(IF\s+EXISTS\s+)?(\w+)\b(?!\.)", re.I)
+_PRAGMA         = re.compile(r"\s*PRAGMA\s+(\w+)\s*\(\s*(\w+)\s*\)\s*$", re.I)
+
+
+class WorkStore(object):
+  # A scratch SQLite file, attached to the quadstore as schema, that receives all the tables (and indexes) derived
+  # by the reasoner, instead of the temporary database or the quadstore itself. The file is used without journal
+  # nor synchronization, with mmap and a large page cache; it is deleted on detach if it was created here.
+  # The statements are rewritten by the cursor (see wrap_cursor()): tables and indexes are created in the work
+  # store, and views become temporary (a view cannot refer to the objects of another database). The references to
+  # the tables created in the work store are qualified with its schema, because SQLite resolves unqualified names
+  # in temp and main first, where a table of the same name may exist (e.g. left by a persistent session).
+  # The table of CREATE INDEX and the statements of CREATE TRIGGER, that cannot be qualified in SQLite, are not.
+  #
+  # Attaching and detaching the work store is impossible within a transaction: the pending changes of the
+  # quadstore are committed before (see ReasonedModel.reason() and destroy()), as world.save() would.
+  def __init__(self, filename = None, directory = None, schema = "s2s_work", mmap_size = 1 << 34, cache_size = 1 << 20, page_size = 65536):
+    self.filename   = filename
+    self.directory  = directory
+    self.schema     = schema
+    self.mmap_size  = mmap_size  # Bytes
+    self.cache_size = cache_size # KiB
+    self.page_size  = page_size
+    self.db         = None
+    self.created    = False
+    self.tables     = set() # Tables created in the work store
+    self.rewritten  = {}    # SQL => rewritten SQL
+
+  def attach(self, db):
+    if self.db: raise RuntimeError("Work store '%s' is already attached!" % self.schema)
+    if self.filename is None:
+      fd, self.filename = tempfile.mkstemp(suffix = ".sqlite3", prefix = "s2s_work_", dir = self.directory)
+      os.close(fd)
+      self.created = True
+    db.execute("""ATTACH DATABASE ? AS %s""" % self.schema, (self.filename,))
+    self.db = db
+    db.execute("""PRAGMA %s.page_size = %s"""   % (self.schema, self.page_size)) # Only before the first table
+    db.execute("""PRAGMA %s.journal_mode = OFF""" % self.schema)
+    db.execute("""PRAGMA %s.synchronous = OFF"""  % self.schema)
+    db.execute("""PRAGMA %s.mmap_size = %s"""   % (self.schema, self.mmap_size))
+    db.execute("""PRAGMA %s.cache_size = %s"""  % (self.schema, -self.cache_size))
+    self.tables.update(name for (name,) in db.execute("""SELECT name FROM %s.sqlite_master WHERE type='table'""" % self.schema))
+
+  def detach(self): # The pending transaction must have been committed
+    if not self.db: return
+    self.db.execute("""DETACH DATABASE %s""" % self.schema)
+    self.db = None
+    self.tables   .clear()
+    self.rewritten.clear()
+    if self.created:
+      os.unlink(self.filename)
+      self.filename = None
+      self.created  = False
+
+  def rewrite(self, sql):
+    rewritten = self.rewritten.get(sql)
+    if rewritten is None:
+      rewritten = sql
+      if "CREATE" in sql.upper():
+        rewritten = _CREATE_TABLE.sub(self._create, rewritten)
+        rewritten = _CREATE_VIEW.sub("CREATE TEMPORARY VIEW", rewritten)
+      if "DROP" in sql.upper(): # The tables of the reasoner are dropped from the work store, e.g. before being recreated
+        rewritten = _DROP_TABLE.sub(self._drop, rewritten)
+      pragma = _PRAGMA.match(rewritten)
+      if pragma:
+        if pragma.group(2) in self.tables: rewritten = "PRAGMA %s.%s(%s)" % (self.schema, pragma.group(1), pragma.group(2))
+      elif self.tables and not _CREATE_TRIGGER.match(rewritten):
+        rewritten = _UNQUALIFIED.sub(self._qualify, rewritten)
+      if len(self.rewritten) > 10000: self.rewritten.clear() # SQL with inlined values
+      self.rewritten[sql] = rewritten
+    return rewritten
+
+  def _create(self, match):
+    if match.group(1).upper() == "TABLE":
+      if not match.group(3) in self.tables:
+        self.tables.add(match.group(3))
+        self.rewritten.clear()
+    return "CREATE %s %s%s.%s" % (match.group(1), match.group(2) or "", self.schema, match.group(3))
+
+  def _drop(self, match):
+    if match.group(2) in self.tables:
+      self.tables.discard(match.group(2))
+      self.rewritten.clear()
+    return "DROP TABLE %s%s.%s" % (match.group(1) or "", self.schema, match.group(2))
+
+  def _qualify(self, match):
+    name = match.group(1)
+    if name and (name in self.tables): return "%s.%s" % (self.schema, name)
+    return match.group(0)
+
+  def qualify(self, table_name): # Qualified name of the table, if created in the work store
+    if table_name in self.tables: return "%s.%s" % (self.schema, table_name)
+    return table_name
+
+  def wrap_cursor(self, cursor): return WorkStoreCursor(self, cursor)
+
+
+class WorkStoreCursor(object):
+  # Cursor proxy rewriting the CREATE statements for the work store
+  def __init__(self, work_store, cursor):
+    self.work_store = work_store
+    self.cursor     = cursor
+
+  def execute(self, sql, params = ()):
+    self.cursor.execute(self.work_store.rewrite(sql), params)
+    return self
+
+  def executemany(self, sql, params):
+    self.cursor.executemany(self.work_store.rewrite(sql), params)
+    return self
+
+  def executescript(self, sql):
+    self.cursor.executescript(self.work_store.rewrite(sql))
+    return self
+
+  def fetchone(self):            return self.cursor.fetchone()
+  def fetchmany(self, *args):    return self.cursor.fetchmany(*args)
+  def fetchall(self):            return self.cursor.fetchall()
+  def __iter__(self):            return self
+  def __next__(self):            return self.cursor.__next__()
+  def close(self):               self.cursor.close()
+
+  @property
+  def rowcount(self):    return self.cursor.rowcount
+  @property
+  def lastrowid(self):   return self.cursor.lastrowid
+  @property
+  def description(self): return self.cursor.description